@@ -64,6 +64,8 @@ setup(
             'st_dv = starthinker.tool.dv:main',
             'st_bigquery = starthinker.tool.bigquery:main',
             'st_google_api = starthinker.tool.google_api:main',
+            'st_discovery = starthinker.tool.discovery:main',
+            'st_benchmark = starthinker.tool.benchmark:main',
             'st_newsletter = starthinker.tool.newsletter:main'
         ]
     },
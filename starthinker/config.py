@@ -17,6 +17,7 @@
 ###########################################################################
 
 import os
+import json
 
 UI_ROOT = os.environ.get('STARTHINKER_ROOT', 'MISSING RUN deploy.sh TO SET')
 UI_CRON = os.environ.get('STARTHINKER_CRON', '')
@@ -37,6 +38,20 @@ BUFFER_SCALE = int(os.environ.get('STARTHINKER_SCALE', 1))
 # used to write execution trace when debugging
 TRACE_FILE = '/tmp/starthinker_trace.log'
 
+# used to cache discovery documents on disk across processes, ttl in seconds
+DISCOVERY_CACHE_PATH = os.environ.get('STARTHINKER_DISCOVERY', '/tmp/starthinker_discovery')
+DISCOVERY_CACHE_TTL = int(os.environ.get('STARTHINKER_DISCOVERY_TTL', 86400))
+
+# used to rate limit Google API calls, JSON of api name to queries per second, for example {"displayvideo":10}
+API_QPS = json.loads(os.environ.get('STARTHINKER_QPS', '{}'))
+
+# used to share API rate limits between processes on the same host, empty keeps limits per process
+API_RATE_PATH = os.environ.get('STARTHINKER_RATE_PATH', '')
+
+# used to cache CM user profiles, ttl in seconds, set path to share between task processes
+CM_PROFILE_TTL = int(os.environ.get('STARTHINKER_PROFILE_TTL', 3600))
+CM_PROFILE_PATH = os.environ.get('STARTHINKER_PROFILE_PATH', '')
+
 # used for user authentication
 APPLICATION_NAME = 'StarThinker Client'
 APPLICATION_SCOPES = [
@@ -16,128 +16,369 @@
 #
 ###########################################################################
 
-from datetime import date, datetime, timedelta
-import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import base64
+import hashlib
+import hmac
 import re
+import secrets
 
 from googleapiclient.errors import HttpError
 
 from starthinker.util.bigquery import json_to_table
 from starthinker.util.bigquery import query_to_schema
 from starthinker.util.bigquery import query_to_rows
+from starthinker.util.bigquery import query_to_table
 from starthinker.util.bigquery import query_to_view
 from starthinker.util.bigquery import table_to_rows
 from starthinker.util.bigquery import table_to_schema
 from starthinker.util.google_api import API_BigQuery
 
 RE_EMAIL = re.compile(r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)')
-INTEGER_MULTIPLY = random.randint(2, 9)
-INTEGER_OFFSET = random.randint(17, 99)
-DATE_OFFSET = timedelta(days=random.randint(3, 13), weeks=random.randint(3, 23))
 
-STRING_IDS = {}
+# used when the task has no "key", consistent within a run but not across runs
+ANONYMIZE_KEY = secrets.token_bytes(32)
+ANONYMIZE_DIGEST = 12 # hex characters of the keyed hash kept in strings
+ANONYMIZE_BATCH = 10000 # rows anonymized together, one column at a time
+ANONYMIZE_WORKERS = 4 # tables anonymized concurrently
 
+ANONYMIZE_INTEGER = ('INTEGER', 'INT64')
+ANONYMIZE_FLOAT = ('FLOAT', 'FLOAT64')
+ANONYMIZE_STRING = ('STRING',)
+ANONYMIZE_DATE = ('DATE', 'DATETIME', 'TIMESTAMP')
+ANONYMIZE_RECORD = ('RECORD', 'STRUCT')
 
-def anonymize_string(cell, column):
-  global STRING_IDS
-  STRING_IDS.setdefault(column, {})
-  STRING_IDS[column].setdefault(cell, len(STRING_IDS[column]) + 1)
+
+def anonymize_constants(task):
+  """Derives every anonymization parameter from one secret key.
+
+  Values are transformed with keyed hashes (HMAC-SHA256) and constants
+  derived from the key, nothing is remembered between values.  Memory stays
+  constant and the same key gives the same output across runs, tables, and
+  engines.  Set "key" in the task to make runs repeatable.
+
+  Returns:
+    Dictionary of key, integer multiply and offset, and date offset.
+  """
+
+  key = task.get('key')
+  key = key.encode('utf-8') if key else ANONYMIZE_KEY
+  digest = hmac.new(key, b'constants', hashlib.sha256).digest()
+
+  return {
+    'key': key,
+    'multiply': 2 + digest[0] % 8,
+    'offset': 17 + digest[1] % 83,
+    'date': timedelta(days=3 + digest[2] % 11, weeks=3 + digest[3] % 21),
+  }
+
+
+def anonymize_digest(constants, path, value):
+  return hmac.new(
+    constants['key'],
+    ('%s:%s' % (path, value)).encode('utf-8'),
+    hashlib.sha256
+  ).hexdigest()[:ANONYMIZE_DIGEST]
+
+
+def anonymize_factor(constants, path):
+  """Per column float scale in [0.5, 1), keeps 0 - 1 percentages in range."""
+  digest = hmac.new(constants['key'], ('%s:' % path).encode('utf-8'), hashlib.sha256).digest()
+  return 0.5 + int.from_bytes(digest[:8], 'big') / 2**65
+
+
+def anonymize_string(constants, path, cell):
+  name = path.rsplit('.', 1)[-1]
 
   # email
   if RE_EMAIL.match(cell):
-    return '%s_%d@email.com' % (column.rsplit('.',
-                                              1)[-1], STRING_IDS[column][cell])
+    return '%s_%s@email.com' % (name, anonymize_digest(constants, path, cell))
   # any string
   else:
-    return '%s_%d' % (column.rsplit('.', 1)[-1], STRING_IDS[column][cell])
+    return '%s_%s' % (name, anonymize_digest(constants, path, cell))
 
 
-def anonymize_integer(cell, column):
+def anonymize_integer(constants, path, cell):
   # possible date ( legacy Data Studio format )
   if len(str(cell)) == 4 + 2 + 2:
     return cell
   else:
     # integer
-    return (cell * INTEGER_MULTIPLY) + INTEGER_OFFSET
+    return (cell * constants['multiply']) + constants['offset']
 
 
-def anonymize_float(cell, column):
-  # replace integers randonly within float to preserve semaintics ( in case 0 - 1 range is percent )
-  return float(''.join([
-    '.' if char == '.' else str(random.randint(0, 9))
-    for char in str(cell).lstrip('0')
-  ]))
+def anonymize_float(constants, path, cell):
+  return cell * anonymize_factor(constants, path)
 
 
-def anonymize_date(cell, column):
+def anonymize_date(constants, path, cell):
   # shift date back in time to prevent future dates
   # convert to string because its being written back to BigQuery
-  return str(cell - DATE_OFFSET)
-
-
-def anonymize_value(value, column):
-  if isinstance(value, int):
-    return anonymize_integer(value, column)
-  elif isinstance(value, str):
-    return anonymize_string(value, column)
-  elif isinstance(value, float):
-    return anonymize_float(value, column)
-  elif isinstance(value, date):
-    return anonymize_date(value, column)
-  elif isinstance(value, datetime):
-    return anonymize_date(value, column)
-
-
-def anonymize_json(struct, columns, parent=None):
-  if isinstance(struct, dict):
-    for key, value in struct.items():
-      path = '.'.join((parent, key)) if parent else key
-
-      if not columns or path in columns:
-        if isinstance(value, (dict, list)):
-          anonymize_json(value, columns, path)
+  return str(cell - constants['date'])
+
+
+def anonymize_plan(schema, columns, constants, parent=None):
+  """Compiles a schema into the transformation applied to each column.
+
+  Args:
+    schema: (list) BigQuery schema of the rows.
+    columns: (list) Optional column paths to anonymize, default all.
+    constants: (dict) From anonymize_constants.
+    parent: (string) Path of the enclosing record, used in recursion.
+
+  Returns:
+    List of ( name, path, transform or nested plan, repeated ).
+  """
+
+  plan = []
+  for field in schema:
+    path = '.'.join((parent, field['name'])) if parent else field['name']
+    if columns and path not in columns: continue
+    kind = field['type'].upper()
+
+    if kind in ANONYMIZE_RECORD:
+      transform = anonymize_plan(field.get('fields', []), columns, constants, path)
+    elif kind in ANONYMIZE_INTEGER:
+      transform = anonymize_integer
+    elif kind in ANONYMIZE_FLOAT:
+      transform = anonymize_float
+    elif kind in ANONYMIZE_STRING:
+      transform = anonymize_string
+    elif kind in ANONYMIZE_DATE:
+      transform = anonymize_date
+    else:
+      continue
+
+    plan.append((field['name'], path, transform, field.get('mode') == 'REPEATED'))
+  return plan
+
+
+def anonymize_records(records, plan, constants):
+  """Anonymizes a batch of records in place, one column at a time.
+
+  Each column is gathered across the batch and transformed together, so
+  repeated values within a batch are only hashed once.
+  """
+
+  for name, path, transform, repeated in plan:
+    if isinstance(transform, list):
+      nested = []
+      for record in records:
+        value = record.get(name)
+        if value:
+          nested.extend(value if repeated else (value,))
+      anonymize_records(nested, transform, constants)
+
+    else:
+      cache = {}
+
+      def convert(value):
+        if value not in cache:
+          cache[value] = transform(constants, path, value)
+        return cache[value]
+
+      for record in records:
+        value = record.get(name)
+        if value is None:
+          continue
+        elif repeated:
+          record[name] = [convert(v) for v in value]
         else:
-          struct[key] = anonymize_value(value, path)
+          record[name] = convert(value)
 
-  elif isinstance(struct, list):
-    for index, value in enumerate(struct):
-      if isinstance(value, (dict, list)):
-        anonymize_json(value, columns, parent)
-      else:
-        struct[index] = anonymize_value(value, parent)
 
-  return struct
+def anonymize_rows(rows, plan, constants):
+  batch = []
+  for row in rows:
+    batch.append(row)
+    if len(batch) == ANONYMIZE_BATCH:
+      anonymize_records(batch, plan, constants)
+      yield from batch
+      batch = []
+  anonymize_records(batch, plan, constants)
+  yield from batch
 
 
-def anonymize_rows(rows, columns=[]):
-  for row in rows:
-    yield anonymize_json(row, columns)
+def anonymize_sql_string(value):
+  return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def anonymize_sql_digest(path, column):
+  """HMAC-SHA256 written in BigQuery SQL, matches anonymize_digest.
+
+  The key is read from the @anonymize_inner and @anonymize_outer parameters,
+  see anonymize_sql_parameters, so it never appears in the query text.
+  """
+
+  return "SUBSTR(TO_HEX(SHA256(CONCAT(@anonymize_outer, SHA256(CONCAT(@anonymize_inner, CAST(CONCAT(%s, %s) AS BYTES)))))), 1, %d)" % (
+    anonymize_sql_string('%s:' % path),
+    column,
+    ANONYMIZE_DIGEST
+  )
+
+
+def anonymize_sql_parameters(constants):
+  """Query parameters holding the HMAC key pads used by anonymize_sql_digest.
+
+  Passed with the job instead of in the SQL, so the key is not recorded in
+  job history or INFORMATION_SCHEMA.JOBS query text.
+
+  Returns:
+    List of BigQuery QueryParameter dictionaries.
+  """
+
+  key = constants['key']
+  if len(key) > 64:
+    key = hashlib.sha256(key).digest()
+  key = key.ljust(64, b'\0')
+
+  return [{
+    'name': name,
+    'parameterType': { 'type': 'BYTES' },
+    'parameterValue': { 'value': base64.b64encode(bytes(k ^ pad for k in key)).decode('ascii') }
+  } for name, pad in (('anonymize_inner', 0x36), ('anonymize_outer', 0x5c))]
+
+
+def anonymize_sql_value(constants, path, transform, kind, column):
+  """SQL expression equivalent to transform applied to column."""
+
+  if transform is anonymize_string:
+    name = anonymize_sql_string('%s_' % path.rsplit('.', 1)[-1])
+    return "CONCAT(%s, %s, IF(REGEXP_CONTAINS(%s, %s), '@email.com', ''))" % (
+      name,
+      anonymize_sql_digest(path, column),
+      column,
+      "r'%s'" % RE_EMAIL.pattern
+    )
+  elif transform is anonymize_integer:
+    return 'IF(LENGTH(CAST(%s AS STRING)) = 8, %s, %s * %d + %d)' % (
+      column, column, column, constants['multiply'], constants['offset']
+    )
+  elif transform is anonymize_float:
+    return '%s * %r' % (column, anonymize_factor(constants, path))
+  elif transform is anonymize_date:
+    return '%s_SUB(%s, INTERVAL %d DAY)' % (
+      'TIMESTAMP' if kind == 'TIMESTAMP' else kind, column, constants['date'].days
+    )
+
+
+def anonymize_sql_fields(schema, plan, constants, parent, depth=0):
+  """SELECT list for a schema, recursing into records and arrays."""
+
+  transforms = { name: (path, transform, repeated) for name, path, transform, repeated in plan }
+  fields = []
+
+  for field in schema:
+    column = '%s`%s`' % (parent, field['name'])
+    kind = field['type'].upper()
+    kind = {'INTEGER':'INT64', 'FLOAT':'FLOAT64', 'STRUCT':'RECORD'}.get(kind, kind)
+
+    if field['name'] not in transforms:
+      fields.append('%s AS `%s`' % (column, field['name']))
+      continue
+
+    path, transform, repeated = transforms[field['name']]
+    alias = '_anonymize_%d' % depth
+
+    if kind == 'RECORD':
+      if repeated:
+        expression = 'ARRAY(SELECT AS STRUCT %s FROM UNNEST(%s) AS %s WITH OFFSET AS %s_offset ORDER BY %s_offset)' % (
+          anonymize_sql_fields(field.get('fields', []), transform, constants, '%s.' % alias, depth + 1),
+          column, alias, alias, alias
+        )
+      else:
+        expression = 'IF(%s IS NULL, NULL, STRUCT(%s))' % (
+          column,
+          anonymize_sql_fields(field.get('fields', []), transform, constants, '%s.' % column, depth + 1)
+        )
+    elif repeated:
+      expression = 'ARRAY(SELECT %s FROM UNNEST(%s) AS %s WITH OFFSET AS %s_offset ORDER BY %s_offset)' % (
+        anonymize_sql_value(constants, path, transform, kind, alias),
+        column, alias, alias, alias
+      )
+    else:
+      expression = anonymize_sql_value(constants, path, transform, kind, column)
+
+    fields.append('%s AS `%s`' % (expression, field['name']))
+
+  return ', '.join(fields)
+
+
+def anonymize_sql(schema, columns, constants, source):
+  """Builds a standard SQL statement that anonymizes inside BigQuery.
+
+  Produces the same values as the python engine for the same key, without
+  any rows leaving BigQuery.  Must be run with anonymize_sql_parameters.
+
+  Args:
+    schema: (list) BigQuery schema of the source.
+    columns: (list) Optional column paths to anonymize, default all.
+    constants: (dict) From anonymize_constants.
+    source: (string) Table reference or parenthesized query to read.
+
+  Returns:
+    String SQL query.
+  """
+
+  plan = anonymize_plan(schema, columns, constants)
+  return 'SELECT %s FROM %s AS _anonymize' % (
+    anonymize_sql_fields(schema, plan, constants, '_anonymize.'),
+    source
+  )
 
 
 def anonymize_query(config, task):
   if config.verbose:
     print('ANONYMIZE QUERY', task['bigquery']['from']['query'])
 
+  constants = anonymize_constants(task)
+  legacy = task['bigquery']['from'].get('legacy', False)
+
   schema = query_to_schema(
     config,
     task['auth'],
     task['bigquery']['from']['project'],
     task['bigquery']['from']['dataset'],
     task['bigquery']['from']['query'],
-    legacy=task['bigquery']['from'].get('legacy', False),
+    legacy=legacy,
   )
 
+  # legacy SQL cannot be nested in a standard SQL statement
+  if task.get('engine') == 'bigquery' and not legacy:
+    query_to_table(
+      config,
+      task['auth'],
+      task['bigquery']['from']['project'],
+      task['bigquery']['to']['dataset'],
+      task['bigquery']['to']['table'],
+      anonymize_sql(
+        schema,
+        task['bigquery']['to'].get('columns', []),
+        constants,
+        '(%s)' % task['bigquery']['from']['query'].strip().rstrip(';')
+      ),
+      legacy=False,
+      target_project_id=task['bigquery']['to']['project'],
+      parameters=anonymize_sql_parameters(constants)
+    )
+    return
+
   rows = query_to_rows(
     config,
     task['auth'],
     task['bigquery']['from']['project'],
     task['bigquery']['from']['dataset'],
     task['bigquery']['from']['query'],
-    legacy=task['bigquery']['from'].get('legacy', False),
+    legacy=legacy,
     as_object=True
   )
 
-  rows = anonymize_rows(rows, task['bigquery']['to'].get('columns', []))
+  rows = anonymize_rows(
+    rows,
+    anonymize_plan(schema, task['bigquery']['to'].get('columns', []), constants),
+    constants
+  )
 
   json_to_table(
     config,
@@ -151,7 +392,7 @@ def anonymize_query(config, task):
   )
 
 
-def anonymize_table(config, task, table_id):
+def anonymize_table(config, task, table_id, constants):
 
   if config.verbose:
     print(
@@ -168,6 +409,29 @@ def anonymize_table(config, task, table_id):
     table_id
   )
 
+  if task.get('engine') == 'bigquery':
+    query_to_table(
+      config,
+      task['auth'],
+      task['bigquery']['from']['project'],
+      task['bigquery']['to']['dataset'],
+      table_id,
+      anonymize_sql(
+        schema,
+        task['bigquery']['to'].get('columns', []),
+        constants,
+        '`%s.%s.%s`' % (
+          task['bigquery']['from']['project'],
+          task['bigquery']['from']['dataset'],
+          table_id
+        )
+      ),
+      legacy=False,
+      target_project_id=task['bigquery']['to']['project'],
+      parameters=anonymize_sql_parameters(constants)
+    )
+    return
+
   rows = table_to_rows(
     config,
     task['auth'],
@@ -177,7 +441,11 @@ def anonymize_table(config, task, table_id):
     as_object=True
   )
 
-  rows = anonymize_rows(rows, task['bigquery']['to'].get('columns', []))
+  rows = anonymize_rows(
+    rows,
+    anonymize_plan(schema, task['bigquery']['to'].get('columns', []), constants),
+    constants
+  )
 
   json_to_table(
     config,
@@ -233,6 +501,8 @@ def anonymize(config, task):
 
   else:
     views = []
+    tables = []
+    constants = anonymize_constants(task)
 
     for table in API_BigQuery(config, task['auth'], iterate=True).tables().list(
       projectId=task['bigquery']['from']['project'],
@@ -241,7 +511,15 @@ def anonymize(config, task):
       if table['type'] == 'VIEW':
         views.append(table['tableReference']['tableId'])
       else:
-        anonymize_table(config, task, table['tableReference']['tableId'])
+        tables.append(table['tableReference']['tableId'])
+
+    # tables are independent, result() raises the first failure
+    with ThreadPoolExecutor(max_workers=task.get('workers', ANONYMIZE_WORKERS)) as executor:
+      for future in [
+        executor.submit(anonymize_table, config, task, table_id, constants)
+        for table_id in tables
+      ]:
+        future.result()
 
     # views have dependencies, loop through all and create until no more errors or no change in view list
     last_copy = True
@@ -18,6 +18,8 @@
 
 from starthinker.util import has_values
 from starthinker.util.data import get_rows
+from starthinker.util.sheets import sheets_prefetch
+from starthinker.util.sheets import sheets_session
 
 from starthinker.task.cm_to_dv.cm_account import cm_account_clear
 from starthinker.task.cm_to_dv.cm_account import cm_account_load
@@ -73,28 +75,39 @@ def cm_to_dv(config, task):
   print('COMMAND:', task['command'])
 
   if task['command'] == 'Clear':
-
-    dv_line_item_clear(config, task)
-    dv_insertion_order_clear(config, task)
-    dv_campaign_clear(config, task)
-    dv_advertiser_clear(config, task)
-    dv_algorithm_clear(config, task)
-    dv_partner_clear(config, task)
-
-    cm_profile_clear(config, task)
-    cm_account_clear(config, task)
-    cm_advertiser_clear(config, task)
-    cm_campaign_clear(config, task)
-    cm_placement_clear(config, task)
-    cm_placement_group_clear(config, task)
-    cm_site_clear(config, task)
-
-    preview_io_clear(config, task)
-    preview_li_clear(config, task)
-    log_clear(config, task)
+    with sheets_session(config, task['auth_sheets'], task['sheet']):
+
+      dv_line_item_clear(config, task)
+      dv_insertion_order_clear(config, task)
+      dv_campaign_clear(config, task)
+      dv_advertiser_clear(config, task)
+      dv_algorithm_clear(config, task)
+      dv_partner_clear(config, task)
+
+      cm_profile_clear(config, task)
+      cm_account_clear(config, task)
+      cm_advertiser_clear(config, task)
+      cm_campaign_clear(config, task)
+      cm_placement_clear(config, task)
+      cm_placement_group_clear(config, task)
+      cm_site_clear(config, task)
+
+      preview_io_clear(config, task)
+      preview_li_clear(config, task)
+      log_clear(config, task)
 
   elif task['command'] == 'Load':
 
+    # read all filters in one request
+    sheets_prefetch(config, task['auth_sheets'], task['sheet'], [
+      ('CM Profiles', 'A2:A'),
+      ('CM Accounts', 'A2:A'),
+      ('CM Advertisers', 'A2:A'),
+      ('CM Campaigns', 'A2:A'),
+      ('DV Partners', 'A2:A'),
+      ('DV Advertisers', 'A2:A')
+    ])
+
     # load if profile filters are missing
     if not has_values(get_rows(
       config,
@@ -16,11 +16,19 @@
 #
 ###########################################################################
 
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from time import sleep
+from time import time
+
 from starthinker.util.data import put_rows
 from starthinker.util.sheets import sheets_read
 from starthinker.util.csv import pivot_column_to_row
 from starthinker.util.bigquery import table_name_sanitize, query_to_table
-from starthinker.util.cm import report_get, report_delete, report_filter, report_build, report_file, report_to_rows, report_clean, get_account_name, report_schema
+from starthinker.util.cm import report_get, report_delete, report_filter, report_build, report_file_status, report_file_download, report_to_rows, report_clean, get_account_name, report_schema
+
+DCM_REPLICATE_WORKERS = 4
+DCM_REPLICATE_POLL = 60
 
 
 def dcm_replicate_accounts(config, task):
@@ -84,52 +92,114 @@ def dcm_replicate_create(config, task, account, advertisers, name, template):
   #print('BODY', body)
 
   # create and run the report if it does not exist
-  report = report_build(config, task['auth'], account, body)
+  return report_build(config, task['auth'], account, body)
 
 
-def dcm_replicate_download(config, task, account, name):
+def dcm_replicate_download(config, task, account, name, file_json):
 
-  filename, report = report_file(config, task['auth'], account, None, name)
+  filename, report = report_file_download(config, task['auth'], file_json)
 
   if report:
     if config.verbose:
       print('DCM FILE', filename)
 
+    # each account writes its own table, copy so threads do not share out
+    out = deepcopy(task['out'])
+
     # clean up the report
     rows = report_to_rows(report)
     rows = report_clean(rows)
 
     # if bigquery, remove header and determine schema
     schema = None
-    if 'bigquery' in task['out']:
-      task['out']['bigquery']['table'] = table_name_sanitize(name)
-      task['out']['bigquery']['schema'] = report_schema(next(rows))
-      task['out']['bigquery']['skip_rows'] = 0
+    if 'bigquery' in out:
+      out['bigquery']['table'] = table_name_sanitize(name)
+      out['bigquery']['schema'] = report_schema(next(rows))
+      out['bigquery']['skip_rows'] = 0
 
     # write rows using standard out block in json ( allows customization across all scripts )
     if rows:
-      put_rows(config, task['auth'], task['out'], rows)
+      put_rows(config, task['auth'], out, rows)
+
+
+def dcm_replicate_timing(account, timing):
+  print('DCM REPLICATE TIMING %s: create %.1fs, wait %.1fs, load %.1fs, %s' % (
+    account,
+    timing.get('create', 0),
+    timing.get('wait', 0),
+    timing.get('load', 0),
+    timing.get('status', 'PENDING')
+  ))
 
 
 def dcm_replicate(config, task):
+  """Replicate a template report across accounts and load each into BigQuery.
+
+  Reports are created concurrently, then every report's file status is
+  polled in one loop and each ready file is downloaded and loaded while the
+  others are still processing.  Use "workers" to set concurrency, default is
+  DCM_REPLICATE_WORKERS, and "timeout" for minutes to wait for all files.
+  """
+
   if config.verbose:
     print('DCM REPLICATE')
 
   template = dcm_replicate_template(config, task)
   rows = dcm_replicate_accounts(config, task)
+  timeout = task.get('timeout', 60) * 60
+  timings = {}
 
-  # create or update reports
-  for row in rows:
+  def create(row):
     account = row[0]
     advertisers = row[1:]
     name = '%s - Account %s' % (template['name'], account)
-    dcm_replicate_create(config, task, account, advertisers, name, template)
-
-  # download reports
-  for row in rows:
-    account = row[0]
-    name = '%s - Account %s' % (template['name'], account)
-    dcm_replicate_download(config, task, account, name)
+    start = time()
+    report = dcm_replicate_create(config, task, account, advertisers, name, deepcopy(template))
+    timings[account] = { 'create':time() - start, 'start':time() }
+    return account, name, report['id']
+
+  def download(account, name, file_json):
+    start = time()
+    dcm_replicate_download(config, task, account, name, file_json)
+    timings[account]['load'] = time() - start
+    timings[account]['status'] = 'DONE'
+
+  with ThreadPoolExecutor(max_workers=task.get('workers', DCM_REPLICATE_WORKERS)) as executor:
+
+    # create or update reports
+    pending = list(executor.map(create, rows))
+
+    # poll every pending report, load each as soon as its file is ready
+    loads = []
+    start = time()
+    while pending:
+      waiting = []
+      for account, name, report_id in pending:
+        file_json = report_file_status(config, task['auth'], account, report_id)
+        if file_json == True:
+          waiting.append((account, name, report_id))
+        elif file_json:
+          timings[account]['wait'] = time() - timings[account]['start']
+          loads.append(executor.submit(download, account, name, file_json))
+        else:
+          timings[account]['status'] = 'NO FILE'
+      pending = waiting
+
+      if pending:
+        if time() - start > timeout:
+          for account, name, report_id in pending:
+            timings[account]['status'] = 'TIMEOUT'
+          break
+        if config.verbose:
+          print('DCM REPLICATE WAITING ON %d REPORTS' % len(pending))
+        sleep(DCM_REPLICATE_POLL)
+
+    # raise any download errors
+    for load in loads:
+      load.result()
+
+  for account, timing in timings.items():
+    dcm_replicate_timing(account, timing)
 
   # summary table ( combine all data into one table for fast load )
   query_to_table(
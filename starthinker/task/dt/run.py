@@ -19,17 +19,24 @@
 import re
 import zlib
 import gzip
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from itertools import chain
 from datetime import datetime, timedelta
 from googleapiclient.errors import HttpError
 
-from starthinker.util.bigquery import io_to_table, storage_to_table, table_exists, job_wait
+from starthinker.util.bigquery import stream_to_table, storage_to_table, table_list, job_wait
 from starthinker.util.storage import object_list, object_get_chunks
 from starthinker.util.csv import column_header_sanitize
 from starthinker.task.dt.schema.Lookup import DT_Field_Lookup
 
 HEADER_SIZE = 1024 * 10  # 10K should be enough for longest possible DT header
 RE_DT_TIME = re.compile(r'.+?_(\d+)_\d+_\d+_\d+\.csv\.gz')
+DT_PIECE_SIZE = 16 * 1024 * 1024  # maximum decompressed bytes produced per step
+DT_PIECES = 4  # decompressed pieces held ahead of the upload
+DT_WORKERS = 4  # files moved concurrently, override with task "workers"
 
 
 def dt_schema(header):
@@ -75,41 +82,92 @@ def dt_timestamp(config, task, dt_filepath):
   return dt_time
 
 
+def dt_decompress(config, task, dt_file, pieces, stop):
+  """Downloads and decompresses a DT file, runs in a background thread.
+
+  Each decompressed piece is at most DT_PIECE_SIZE and is put on the pieces
+  queue, which is bounded so at most DT_PIECES are held.  A final None
+  signals the end, an exception is passed through the queue so the consumer
+  raises it.  BaseException is caught too, so a sys.exit while loading
+  credentials never leaves the consumer waiting on the queue.
+
+  Args:
+    dt_file: (string) Name of the gzipped file in the task bucket.
+    pieces: (queue.Queue) Bounded queue receiving decompressed bytes.
+    stop: (threading.Event) Set by the consumer to end decompression.
+  """
+
+  def put(piece):
+    while not stop.is_set():
+      try:
+        pieces.put(piece, timeout=1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    # decompression handler for gzip ( must be outside of chunks as it keeps track of stream across multiple calls )
+    gz_handler = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    for data_gz in object_get_chunks(config, task['auth'],
+                                     '%s:%s' % (task['bucket'], dt_file)):
+      while data_gz:
+        if not put(gz_handler.decompress(data_gz, DT_PIECE_SIZE)):
+          return
+        data_gz = gz_handler.unconsumed_tail
+
+    if not put(gz_handler.flush()):
+      return
+    put(None)
+
+  except BaseException as e:
+    put(e)
+
+
+def dt_pieces(config, task, dt_file):
+  """Decompressed bytes of a DT file, decompressed while they are consumed."""
+
+  pieces = queue.Queue(maxsize=DT_PIECES)
+  stop = threading.Event()
+  threading.Thread(
+    target=dt_decompress,
+    args=(config, task, dt_file, pieces, stop),
+    daemon=True
+  ).start()
+
+  try:
+    while True:
+      piece = pieces.get()
+      if isinstance(piece, BaseException):
+        raise piece
+      elif piece is None:
+        break
+      elif piece:
+        yield piece
+  finally:
+    stop.set()
+
+
 def dt_move_large(config, task, dt_file, dt_partition, jobs):
   if config.verbose:
     print('DT TO TABLE LARGE', dt_partition)
 
-  delimiter = '\n'
-  disposition = 'WRITE_TRUNCATE'
-
-  # decompression handler for gzip ( must be outside of chunks as it keeps track of stream across multiple calls )
-  gz_handler = zlib.decompressobj(32 + zlib.MAX_WBITS)
-
-  # sliding view of data flowing out of decompression, used to buffer and delimit rows
-  first_row = True
-  view = ''
+  pieces = dt_pieces(config, task, dt_file)
 
-  # loop all chunks of file, decompress, and find row delimiter
-  for data_gz in object_get_chunks(config, task['auth'],
-                                   '%s:%s' % (task['bucket'], dt_file)):
+  # read just enough to find the header, it is uploaded and skipped by the load
+  head = []
+  for piece in pieces:
+    head.append(piece)
+    if b'\n' in piece:
+      break
+  header = b''.join(head).split(b'\n', 1)[0].decode('utf-8')
 
-    view += gz_handler.decompress(data_gz).decode('utf-8')
-
-    if first_row:
-      end = view.find(delimiter)
-      schema = dt_schema(view[:end].split(','))
-      view = view[(end + 1):]
-      first_row = False
-
-    end = view.rfind(delimiter)
-
-    jobs.append(
-        io_to_table(config, task['auth'], config.project,
-                    task['to']['dataset'], dt_partition,
-                    BytesIO(view[:end].encode()), 'CSV', schema, 0, disposition,
-                    False))
-    disposition = 'WRITE_APPEND'
-    view = view[min(end + 1, len(view)):]
+  jobs.append(
+      stream_to_table(config, task['auth'], config.project,
+                      task['to']['dataset'], dt_partition,
+                      chain(head, pieces), 'CSV', dt_schema(header.split(',')),
+                      1, 'WRITE_TRUNCATE', False))
 
 
 def dt_move_small(config, task, dt_file, dt_partition, jobs):
@@ -132,15 +190,23 @@ def dt_move(config, task, dt_object, dt_partition, jobs):
     dt_move_small(config, task, dt_object['name'], dt_partition, jobs)
 
 
-def dt(config, task):
-  jobs = []
+def dt_plan(config, task):
+  """Lists DT files whose partition is not yet loaded.
 
-  if config.verbose:
-    print('DT To BigQuery')
+  The destination dataset is listed once and compared to the bucket, instead
+  of checking each partition with its own request.
 
-  # legacy deprecated ( do not use )
-  if 'path' in task:
-    task['paths'] = [task['path']]
+  Returns:
+    List of ( storage object, partition ) to move.
+  """
+
+  existing = set(
+    table_id for dataset_id, table_id, table_type in table_list(
+      config, task['to']['auth'], config.project, task['to']['dataset']
+    )
+  )
+
+  moves = []
 
   # loop all dt files to match pattern or match any pattern
   print('PATHS', task['paths'])
@@ -151,7 +217,6 @@ def dt(config, task):
         config, task['auth'],
         '%s:%s' % (task['bucket'], path),
         raw=True):
-      dt_size = dt_object['size']
       dt_file = dt_object['name']
       dt_time = dt_timestamp(config, task, dt_file)
 
@@ -161,13 +226,47 @@ def dt(config, task):
           (dt_time > config.now - timedelta(
               days=task.get('days', 60),
               hours=task.get('hours', 0)))):
-        if not table_exists(config, task['to']['auth'], config.project,
-                            task['to']['dataset'], dt_partition):
-          dt_move(config, task, dt_object, dt_partition, jobs)
+        if dt_partition not in existing:
+          existing.add(dt_partition)
+          moves.append((dt_object, dt_partition))
         else:
           if config.verbose:
             print('DT Partition Exists:', dt_partition)
 
+  return moves
+
+
+def dt(config, task):
+  jobs = []
+
+  if config.verbose:
+    print('DT To BigQuery')
+
+  # legacy deprecated ( do not use )
+  if 'path' in task:
+    task['paths'] = [task['path']]
+
+  moves = dt_plan(config, task)
+
+  print('DT PLAN: %d files, %d bytes' % (
+    len(moves),
+    sum(int(dt_object['size']) for dt_object, dt_partition in moves)
+  ))
+
+  # report only, nothing is moved
+  if task.get('plan'):
+    for dt_object, dt_partition in moves:
+      print('DT Plan:', dt_object['name'], dt_object['size'], dt_partition)
+    return
+
+  # result() raises the first failed move
+  with ThreadPoolExecutor(max_workers=task.get('workers', DT_WORKERS)) as executor:
+    for future in [
+      executor.submit(dt_move, config, task, dt_object, dt_partition, jobs)
+      for dt_object, dt_partition in moves
+    ]:
+      future.result()
+
   for count, job in enumerate(jobs):
     print('Waiting For Job: %d of %d' % (count + 1, len(jobs)))
     job_wait(config, task['to']['auth'], job)
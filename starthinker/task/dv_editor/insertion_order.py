@@ -511,10 +511,17 @@ def insertion_order_insert(config, task, commit=False):
 
 
 def insertion_order_commit(config, task, patches):
+  batch = []
   for patch in patches:
     if not patch.get("insertion_order"):
       continue
     print("API INSERTION ORDER:", patch["action"], patch["insertion_order"])
+
+    # patches are sent together as batch requests below
+    if patch["action"] == "PATCH":
+      batch.append(patch)
+      continue
+
     try:
       if patch["action"] == "DELETE":
         response = API_DV360(
@@ -524,14 +531,6 @@ def insertion_order_commit(config, task, patches):
           **patch["parameters"]
         ).execute()
         patch["success"] = response
-      elif patch["action"] == "PATCH":
-        response = API_DV360(
-          config,
-          task["auth_dv"]
-        ).advertisers().insertionOrders().patch(
-          **patch["parameters"]
-        ).execute()
-        patch["success"] = response["insertionOrderId"]
       elif patch["action"] == "INSERT":
         response = API_DV360(
           config,
@@ -544,4 +543,24 @@ def insertion_order_commit(config, task, patches):
       patch["error"] = str(e)
     finally:
       patch_log(config, task, patch)
+
+  if batch:
+    patch_lookup = { id(patch["parameters"]):patch for patch in batch }
+
+    def patch_callback(kwargs, response, error):
+      patch = patch_lookup[id(kwargs)]
+      if error:
+        patch["error"] = str(error)
+      else:
+        patch["success"] = (response or {}).get("insertionOrderId")
+      patch_log(config, task, patch)
+
+    API_DV360(
+      config,
+      task["auth_dv"]
+    ).advertisers().insertionOrders().patch().execute_many(
+      [patch["parameters"] for patch in batch],
+      callback=patch_callback
+    )
+
   patch_log(config, task)
@@ -573,10 +573,17 @@ def line_item_insert(config, task, commit=False):
 
 
 def line_item_commit(config, task, patches):
+  batch = []
   for patch in patches:
     if not patch.get("line_item"):
       continue
     print("API LINE ITEM:", patch["action"], patch["line_item"])
+
+    # patches are sent together as batch requests below
+    if patch["action"] == "PATCH":
+      batch.append(patch)
+      continue
+
     try:
       if patch["action"] == "DELETE":
         response = API_DV360(
@@ -586,14 +593,6 @@ def line_item_commit(config, task, patches):
           **patch["parameters"]
         ).execute()
         patch["success"] = response
-      elif patch["action"] == "PATCH":
-        response = API_DV360(
-          config,
-          task["auth_dv"]
-        ).advertisers().lineItems().patch(
-          **patch["parameters"]
-        ).execute()
-        patch["success"] = response["lineItemId"]
       elif patch["action"] == "INSERT":
         response = API_DV360(
           config,
@@ -614,4 +613,24 @@ def line_item_commit(config, task, patches):
       patch["error"] = str(e)
     finally:
       patch_log(config, task, patch)
+
+  if batch:
+    patch_lookup = { id(patch["parameters"]):patch for patch in batch }
+
+    def patch_callback(kwargs, response, error):
+      patch = patch_lookup[id(kwargs)]
+      if error:
+        patch["error"] = str(error)
+      else:
+        patch["success"] = (response or {}).get("lineItemId")
+      patch_log(config, task, patch)
+
+    API_DV360(
+      config,
+      task["auth_dv"]
+    ).advertisers().lineItems().patch().execute_many(
+      [patch["parameters"] for patch in batch],
+      callback=patch_callback
+    )
+
   patch_log(config, task)
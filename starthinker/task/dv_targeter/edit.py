@@ -17,6 +17,7 @@
 ###########################################################################
 
 import json
+from time import time
 
 from starthinker.util.bigquery import table_create
 from starthinker.util.data import put_rows
@@ -44,7 +45,8 @@ SCHEMA_LOG = [
 BUFFER_ERROR = []
 BUFFER_SUCCESS = []
 BUFFER_WARNING = []
-BUFFER_LENGTH = 10
+BUFFER_SECONDS = 60 # flush logs at most this often, and always at the end
+BUFFER_FLUSHED = time()
 
 
 def edit_clear(config, task):
@@ -104,6 +106,7 @@ def edit_log(config, task, edit=None):
   global BUFFER_SUCCESS
   global BUFFER_ERROR
   global BUFFER_WARNING
+  global BUFFER_FLUSHED
 
   def _edit_write(rows, kind):
     if not rows:
@@ -155,18 +158,18 @@ def edit_log(config, task, edit=None):
     BUFFER_ERROR.append(edit)
     print('ERROR:', edit['error'])
 
-  if len(BUFFER_SUCCESS) > BUFFER_LENGTH or edit is None:
+  if edit is None or time() - BUFFER_FLUSHED > BUFFER_SECONDS:
     _edit_write(BUFFER_SUCCESS, 'SUCCESS')
     BUFFER_SUCCESS = []
 
-  if len(BUFFER_WARNING) > BUFFER_LENGTH or edit is None:
     _edit_write(BUFFER_WARNING, 'WARNING')
     BUFFER_WARNING = []
 
-  if len(BUFFER_ERROR) > BUFFER_LENGTH or edit is None:
     _edit_write(BUFFER_ERROR, 'ERROR')
     BUFFER_ERROR = []
 
+    BUFFER_FLUSHED = time()
+
 
 def edit_preview(config, task, edits):
   if edits:
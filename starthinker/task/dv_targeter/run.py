@@ -18,6 +18,8 @@
 
 from starthinker.util import has_values
 from starthinker.util.data import get_rows
+from starthinker.util.sheets import sheets_prefetch
+from starthinker.util.sheets import sheets_session
 
 from starthinker.task.dv_targeter.advertiser import advertiser_clear
 from starthinker.task.dv_targeter.advertiser import advertiser_load
@@ -73,26 +75,33 @@ def dv_targeter(config, task):
   print('COMMAND:', task['command'])
 
   if task['command'] == 'Clear':
-    edit_clear(config, task)
-    targeting_clear(config, task)
-    targeting_clear_changes(config, task)
-    channel_clear(config, task)
-    custom_list_clear(config, task)
-    combined_audience_clear(config, task)
-    google_audience_clear(config, task)
-    location_list_clear(config, task)
-    first_and_third_party_audience_clear(config, task)
-    negative_keyword_list_clear(config, task)
-    inventory_source_clear(config, task)
-    inventory_group_clear(config, task)
-    line_item_clear(config, task)
-    insertion_order_clear(config, task)
-    campaign_clear(config, task)
-    advertiser_clear(config, task)
-    partner_clear(config, task)
+    with sheets_session(config, task['auth_sheets'], task['sheet']):
+      edit_clear(config, task)
+      targeting_clear(config, task)
+      targeting_clear_changes(config, task)
+      channel_clear(config, task)
+      custom_list_clear(config, task)
+      combined_audience_clear(config, task)
+      google_audience_clear(config, task)
+      location_list_clear(config, task)
+      first_and_third_party_audience_clear(config, task)
+      negative_keyword_list_clear(config, task)
+      inventory_source_clear(config, task)
+      inventory_group_clear(config, task)
+      line_item_clear(config, task)
+      insertion_order_clear(config, task)
+      campaign_clear(config, task)
+      advertiser_clear(config, task)
+      partner_clear(config, task)
 
   if task['command'] == 'Load':
 
+    # read both filters in one request
+    sheets_prefetch(config, task['auth_sheets'], task['sheet'], [
+      ('Partners', 'A2:A'),
+      ('Advertisers', 'A2:A')
+    ])
+
     # load if partner filters are missing
     if not has_values(get_rows(
       config,
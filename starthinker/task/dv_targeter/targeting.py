@@ -16,6 +16,11 @@
 #
 ###########################################################################
 
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
 from starthinker.util.bigquery import query_to_view
 from starthinker.util.bigquery import table_create
 from starthinker.util.data import get_rows
@@ -29,7 +34,10 @@ from starthinker.task.dv_targeter.edit import edit_log
 from starthinker.task.dv_targeter.edit import edit_preview
 
 from starthinker.util.dv_targeting import Assigned_Targeting
+from starthinker.util.dv_targeting import targeting_invalidate
+
 
+TARGETING_WORKERS = 10 # concurrent API calls, override with task "workers"
 
 TARGETING_TYPES = [
   'TARGETING_TYPE_EXCHANGE',
@@ -44,6 +52,8 @@ TARGETING_TYPES = [
   'TARGETING_TYPE_APP_CATEGORY',
 ]
 
+TARGETING_QUEUE = 10000 # options held between the API and BigQuery upload
+
 
 def targeting_clear(config, task):
   table_create(
@@ -141,6 +151,94 @@ def targeting_clear_changes(config, task):
   )
 
 
+def targeting_options_fetch(config, task, advertiserId, targeting_type, rows, stop):
+  """Puts one paginated list of targeting options on the rows queue.
+
+  Runs in a worker thread.  The queue is bounded, so a slow BigQuery upload
+  pauses the workers instead of buffering every option in memory.  A final
+  None signals the end, an exception is passed through the queue so the
+  consumer raises it.  BaseException is caught because get_credentials
+  calls sys.exit, a worker must never end without posting to the queue.
+
+  Args:
+    advertiserId: (string) Advertiser the options are listed for.
+    targeting_type: (string) One of TARGETING_TYPES.
+    rows: (queue.Queue) Bounded queue receiving options.
+    stop: (threading.Event) Set by the consumer to end fetching.
+  """
+
+  def put(row):
+    while not stop.is_set():
+      try:
+        rows.put(row, timeout=1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    for option in API_DV360(
+      config,
+      task['auth_dv'],
+      iterate=True,
+      qps=task.get('qps')
+    ).targetingTypes().targetingOptions().list(
+      advertiserId=advertiserId,
+      targetingType=targeting_type
+    ).execute():
+      if not put(option):
+        return
+    put(None)
+
+  except BaseException as e:
+    put(e)
+
+
+def targeting_options(config, task, advertisers):
+  """Lists targeting options for every type, concurrently.
+
+  Targeting options do not depend on the advertiser they are listed for, so
+  each type is listed once, through the first advertiser.  Options are
+  yielded in completion order as they arrive.
+
+  Args:
+    advertisers: (list) Advertiser ids as strings.
+
+  Returns:
+    Generator of TargetingOption dictionaries.
+  """
+
+  calls = [
+    (advertisers[0], targeting_type)
+    for targeting_type in dict.fromkeys(TARGETING_TYPES)
+  ] if advertisers else []
+
+  rows = queue.Queue(maxsize=TARGETING_QUEUE)
+  stop = threading.Event()
+  remaining = len(calls)
+
+  executor = ThreadPoolExecutor(max_workers=task.get('workers', TARGETING_WORKERS))
+  try:
+    for advertiserId, targeting_type in calls:
+      executor.submit(
+        targeting_options_fetch,
+        config, task, advertiserId, targeting_type, rows, stop
+      )
+
+    while remaining:
+      row = rows.get()
+      if isinstance(row, BaseException):
+        raise row
+      elif row is None:
+        remaining -= 1
+      else:
+        yield row
+
+  finally:
+    stop.set()
+    executor.shutdown(wait=False)
+
+
 def targeting_load(config, task):
 
   # load multiple from user defined sheet
@@ -156,16 +254,11 @@ def targeting_load(config, task):
       }}
     )
 
-    for advertiser in advertisers:
-      for targeting_type in TARGETING_TYPES:
-        yield from API_DV360(
-          config,
-          task['auth_dv'],
-          iterate=True
-        ).targetingTypes().targetingOptions().list(
-          advertiserId=str(lookup_id(advertiser[0])),
-          targetingType=targeting_type
-        ).execute()
+    yield from targeting_options(
+      config,
+      task,
+      [str(lookup_id(advertiser[0])) for advertiser in advertisers]
+    )
 
   targeting_clear(config, task)
 
@@ -1140,38 +1233,65 @@ def targeting_edit(config, task, commit=False):
     targeting_commit(config, task, edits)
 
 
+def targeting_commit_edit(config, task, edit):
+  """Sends one bulk edit, recording success or error on the edit itself."""
+
+  try:
+    if edit.get("line_item"):
+      print("API LINE ITEM:", edit["line_item"])
+      response = API_DV360(
+        config,
+        task["auth_dv"],
+        qps=task.get("qps")
+      ).advertisers().lineItems().bulkEditLineItemAssignedTargetingOptions(
+        **edit["parameters"]
+      ).execute()
+      edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
+    elif edit.get("advertiser"):
+      print("API ADVERTISER:", edit["advertiser"])
+      response = API_DV360(
+        config,
+        task["auth_dv"],
+        qps=task.get("qps")
+      ).advertisers().bulkEditAdvertiserAssignedTargetingOptions(
+        **edit["parameters"]
+      ).execute()
+      edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
+    elif edit.get("partner"):
+      print("API PARTNER:", edit["partner"])
+      response = API_DV360(
+        config,
+        task["auth_dv"],
+        qps=task.get("qps")
+      ).partners().bulkEditPartnerAssignedTargetingOptions(
+        **edit["parameters"]
+      ).execute()
+      edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
+    targeting_invalidate(
+      config,
+      task["auth_dv"],
+      edit["parameters"].get("partnerId"),
+      edit["parameters"].get("advertiserId"),
+      edit["parameters"].get("lineItemId")
+    )
+  except Exception as e:
+    edit["error"] = str(e)
+  return edit
+
+
 def targeting_commit(config, task, edits):
-  for edit in edits:
-    try:
-      if edit.get("line_item"):
-        print("API LINE ITEM:", edit["line_item"])
-        response = API_DV360(
-          config,
-          task["auth_dv"]
-        ).advertisers().lineItems().bulkEditLineItemAssignedTargetingOptions(
-          **edit["parameters"]
-        ).execute()
-        edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
-      elif edit.get("advertiser"):
-        print("API ADVERTISER:", edit["advertiser"])
-        response = API_DV360(
-          config,
-          task["auth_dv"]
-        ).advertisers().bulkEditAdvertiserAssignedTargetingOptions(
-          **edit["parameters"]
-        ).execute()
-        edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
-      elif edit.get("partner"):
-        print("API PARTNER:", edit["partner"])
-        response = API_DV360(
-          config,
-          task["auth_dv"]
-        ).partners().bulkEditPartnerAssignedTargetingOptions(
-          **edit["parameters"]
-        ).execute()
-        edit["success"] = len(response.get("createdAssignedTargetingOptions", []))
-    except Exception as e:
-      edit["error"] = str(e)
-    finally:
-      edit_log(config, task, edit)
+  """Sends bulk edits concurrently, logging each as it completes.
+
+  Each edit targets a different partner, advertiser, or line item so they
+  are independent.  Calls share the DV360 rate limit, set with the task
+  "qps" option or STARTHINKER_QPS.  Results are buffered by edit_log and
+  written to the log tabs in batches.
+  """
+
+  with ThreadPoolExecutor(max_workers=task.get("workers", TARGETING_WORKERS)) as executor:
+    for future in as_completed([
+      executor.submit(targeting_commit_edit, config, task, edit)
+      for edit in edits
+    ]):
+      edit_log(config, task, future.result())
   edit_log(config, task)
@@ -23,7 +23,7 @@ is required because the reporting response needs additional processing.
 """
 
 from starthinker.util.data import put_rows
-from starthinker.util.ga import GA_Report
+from starthinker.util.ga import GA_Report, GA_WORKERS, GA_SHARD_DAYS
 
 
 def ga(config, task):
@@ -33,10 +33,12 @@ def ga(config, task):
   report = GA_Report(
     config,
     task['auth'],
+    workers=task.get('workers', GA_WORKERS),
+    shard_days=task.get('shard_days', GA_SHARD_DAYS),
     **task['kwargs']
   )
 
-  # be sure to call before get_schema
+  # be sure to call before get_schema, waits for the first shard
   rows = report.get_rows()
 
   if 'bigquery' in task.get('out', {}):
@@ -91,8 +91,47 @@ Example Write Insertion Orders into DV360 from BigQuery:
         }
       }
     }}
+
+Example Read DV360 Line Items for many advertisers concurrently:
+
+    { "google_api": {
+      "auth": "user",
+      "api": "displayvideo",
+      "version": "v1",
+      "function": "advertisers.lineItems.list",
+      "kwargs_remote":{
+        "bigquery":{
+          "dataset":"DV_Targeting_Audit",
+          "table":"DV_Advertiser_Ids"
+        }
+      },
+      "workers": 10,
+      "qps": 5,
+      "ordered": true,
+      "results": {
+        "bigquery": {
+          "dataset": "DV_Targeting_Audit",
+          "table": "DV_LineItems"
+        }
+      }
+    }}
+
+  The workers parameter runs the kwargs calls in a thread pool, qps caps the
+  calls per second to the API across all workers ( see util/rate_limit.py ),
+  and ordered writes the results in the same order as the kwargs ( otherwise
+  as they complete ).
+
+  For large paginated list calls add "prefetch": 2 to fetch up to 2 pages
+  ahead in the background while the current page is written.
 """
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from copy import deepcopy
+from itertools import islice
+
 from googleapiclient.errors import HttpError
 
 from starthinker.util.bigquery import table_create
@@ -237,6 +276,26 @@ def google_api_build_errors(config, auth, api_call, errors):
   return errors
 
 
+def google_api_error(api_call, error):
+  """Translate an API call failure into a row for the errors table.
+
+  Args:
+    api_call (dict): the JSON for the API call as defined in recipe.
+    error (HttpError): the exception raised by the API call.
+
+  Returns (dict):
+    A row matching ERROR_SCHEMA.
+  """
+
+  return {
+    'Error': str(error),
+    'Parameters': [{
+      'Key': k,
+      'Value': str(v)
+    } for k, v in api_call['kwargs'].items()]
+  }
+
+
 def google_api_execute(config, auth, api_call, results, errors, limit=None):
   """Execute the actual API call and write to the end points defined.
 
@@ -279,14 +338,7 @@ def google_api_execute(config, auth, api_call, results, errors, limit=None):
   except HttpError as e:
 
     if errors:
-      rows = [{
-          'Error':
-              str(e),
-          'Parameters': [{
-              'Key': k,
-              'Value': str(v)
-          } for k, v in api_call['kwargs'].items()]
-      }]
+      rows = [google_api_error(api_call, e)]
       put_rows(config, auth, errors, rows)
 
       if 'bigquery' in errors:
@@ -296,6 +348,132 @@ def google_api_execute(config, auth, api_call, results, errors, limit=None):
       raise e
 
 
+def google_api_call(config, auth, api_call, results, errors, alias=None):
+  """Execute a single API call inside a worker thread.
+
+  Same behavior as google_api_execute but instead of writing, the rows are
+  fully fetched ( including all pages ) and returned so a single writer can
+  stream them.  The api_call is copied so workers do not share kwargs.
+
+  If the api_call has a limit, at most limit rows are taken per call and no
+  page ( or prefetched page ) beyond the one holding the last row is fetched.
+
+  Args:
+    auth (string): either "user" or "service" to make the API call.
+    api_call (dict): the JSON for the API call with kwargs set.
+    results (dict): defines where the data will be written
+    errors (dict): defines where the errors will be written
+    alias (string): passed to google_api_initilaize
+
+  Returns (tuple):
+    ( list of result rows, error row or None )
+
+  Raises:
+    HttpError: If the call fails and no errors destination is given.
+  """
+
+  api_call = deepcopy(api_call)
+  google_api_initilaize(config, api_call, alias)
+
+  try:
+    rows = API(config, api_call).execute()
+
+    if not results:
+      return [], None
+
+    # check if single object needs conversion to rows
+    if isinstance(rows, dict):
+      rows = [rows]
+
+    # check if simple string API results
+    elif results.get('bigquery', {}).get('format', 'JSON') == 'CSV':
+      rows = [[r] for r in rows]
+
+    # stop paging as soon as the limit is reached, dropping the iterator ends prefetch
+    if api_call.get('limit') is not None:
+      rows = islice(rows, api_call['limit'])
+
+    # drain the iterator here so paging happens in the worker thread
+    return [Discovery_To_BigQuery.clean(r) for r in rows], None
+
+  except HttpError as e:
+    if errors:
+      return [], google_api_error(api_call, e)
+    else:
+      raise
+
+
+def google_api_execute_concurrent(config, auth, api_call, kwargs_list, results, errors, alias=None, workers=1, ordered=False):
+  """Fan out the API calls for each kwargs over a bounded thread pool.
+
+  All result rows are streamed into one put_rows call from the main thread,
+  so the results table is written by a single writer.  Errors are collected
+  and written once at the end.  At most workers * 2 calls are in flight, which
+  bounds memory to the rows of those calls.
+
+  Args:
+    auth (string): either "user" or "service" to make the API call.
+    api_call (dict): the JSON for the API call as defined in recipe.
+    kwargs_list (iterator): the kwargs for each call.
+    results (dict): defines where the data will be written
+    errors (dict): defines where the errors will be written
+    alias (string): passed to google_api_initilaize
+    workers (int): number of concurrent API calls.
+    ordered (bool): if True, write results in kwargs order.
+
+  Returns:
+    None, all data is transfered between API / BigQuery
+
+  Raises:
+    HttpError: If a call fails and no errors destination is given.
+  """
+
+  error_rows = []
+
+  def results_iterator():
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      pending = deque()
+
+      def drain(count):
+        while len(pending) > count:
+          if ordered:
+            done = [pending.popleft()]
+          else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+              pending.remove(future)
+          for future in done:
+            rows, error = future.result()
+            if error:
+              error_rows.append(error)
+            yield from rows
+
+      try:
+        for kwargs in kwargs_list:
+          pending.append(executor.submit(
+            google_api_call, config, auth, dict(api_call, kwargs=kwargs), results, errors, alias
+          ))
+          yield from drain(workers * 2)
+        yield from drain(0)
+      except:
+        for future in pending:
+          future.cancel()
+        raise
+
+  if results:
+    put_rows(config, auth, results, results_iterator())
+    if 'bigquery' in results:
+      results['bigquery']['disposition'] = 'WRITE_APPEND'
+  else:
+    for row in results_iterator():
+      pass
+
+  if error_rows:
+    put_rows(config, auth, errors, error_rows)
+    if 'bigquery' in errors:
+      errors['bigquery']['disposition'] = 'WRITE_APPEND'
+
+
 def google_api(config, task):
   """Task handler for recipe, delegates all JSON parameters to functions.
 
@@ -311,6 +489,9 @@ def google_api(config, task):
     kwargs - hard coded values for the API call as a dictionary.
     kwargs_remote - values loaded from a source such as BigQuery.
 
+  If workers is greater than 1, the calls are executed concurrently, see
+  google_api_execute_concurrent for the ordered option.
+
   Args:
     None, all parameters are exposed via task.
 
@@ -338,6 +519,8 @@ def google_api(config, task):
     'limit': task.get('limit', None),
     'key': config.key,
     'headers': task.get('headers'),
+    'prefetch': task.get('prefetch', 0),
+    'qps': task.get('qps'),
   }
 
   results = google_api_build_results(
@@ -373,8 +556,23 @@ def google_api(config, task):
   else:
     kwargs_list = [{}]
 
+  # fan out the API calls over a pool of threads
+  if task.get('workers', 1) > 1:
+    google_api_execute_concurrent(
+      config,
+      task['auth'],
+      api_call,
+      kwargs_list,
+      results,
+      errors,
+      task.get('alias'),
+      task['workers'],
+      task.get('ordered', False)
+    )
+
   # loop through paramters and make possibly multiple API calls
-  for kwargs in kwargs_list:
-    api_call['kwargs'] = kwargs
-    google_api_initilaize(config, api_call, task.get('alias'))
-    google_api_execute(config, task['auth'], api_call, results, errors, task.get('limit'))
+  else:
+    for kwargs in kwargs_list:
+      api_call['kwargs'] = kwargs
+      google_api_initilaize(config, api_call, task.get('alias'))
+      google_api_execute(config, task['auth'], api_call, results, errors, task.get('limit'))
@@ -17,9 +17,17 @@
 ###########################################################################
 """Module that centralizes all CM data access."""
 
+from concurrent.futures import ThreadPoolExecutor
+
 from starthinker.util.google_api import API_DCM
 from starthinker.task.traffic.store import store
 
+# concurrent CM calls when pre fetching a feed
+PRE_FETCH_WORKERS = 8
+
+# names sharing a parent above which all children are listed instead of searched
+PRE_FETCH_LIST_MINIMUM = 20
+
 
 class BaseDAO(object):
   """Parent class to all data access objects.
@@ -80,16 +88,18 @@ class BaseDAO(object):
     return self._api().get(
         profileId=self.profile_id, id=feed_item[self._id_field]).execute()
 
-  def get(self, feed_item, required=False, column_name=None):
+  def get(self, feed_item, required=False, column_name=None, persisted=True):
     """Retrieves an item.
 
     Items could be retrieved from a in memory cache in case it has already been
-    retrieved within the current execution. Also, this method is capable of
-    translating 'ext' placeholder IDs with concrete CM ids.
+    retrieved within the current execution, or from the persisted store of a
+    previous execution. Also, this method is capable of translating 'ext'
+    placeholder IDs with concrete CM ids.
 
     Args:
       feed_item: Feed item from the Bulkdozer feed representing the item to
         retrieve.
+      persisted: If False, ignore items cached by previous executions.
 
     Returns:
       The CM object that represents the identified entity.
@@ -109,7 +119,7 @@ class BaseDAO(object):
           store_key = str(feed_item.get(self._parent_filter_field_name,
                                         None)) + store_key
 
-      result = store.get(self._entity, store_key)
+      result = store.get(self._entity, store_key, persisted)
 
       if not result:
         result, key = self._get_by_name(feed_item)
@@ -131,7 +141,7 @@ class BaseDAO(object):
 
       if id_value:
         keys.append(id_value)
-        result = store.get(self._entity, id_value)
+        result = store.get(self._entity, id_value, persisted)
 
         if not result:
           result = self._get(feed_item)
@@ -225,28 +235,181 @@ class BaseDAO(object):
     #print('ITEM', item)
     self._api().update(profileId=self.profile_id, body=item).execute()
 
+  def feed_item_key(self, feed_item):
+    """Identifies the CM entity a feed item creates or updates.
+
+    Feed items with the same key are processed in feed order, all others may
+    be processed concurrently.
+
+    Args:
+      feed_item: Feed item from the Bulkdozer feed.
+
+    Returns:
+      String key, or None if the feed item is independent of all others.
+    """
+    for field in (getattr(self, '_id_field', None), getattr(self, '_search_field', None)):
+      if field and feed_item.get(field):
+        return str(feed_item[field])
+    return None
+
+  def _pre_fetch_ids(self, ids):
+    """Fetches up to 500 items by id into the cache."""
+    results = self._api(iterate=True).list(
+        profileId=self.profile_id, ids=ids).execute()
+    for item in results:
+      store.set(self._entity, [item['id']], item)
+
+  def _pre_fetch_versions(self, persisted, ids):
+    """Validates persisted items against the current lastModifiedInfo in CM.
+
+    Lists only id and lastModifiedInfo for up to 500 ids, items that changed
+    are dropped from the store.  On error nothing is validated, so those
+    items are fetched again as if they were never persisted.
+    """
+    try:
+      current = {}
+      for item in self._api(iterate=True).list(
+          profileId=self.profile_id,
+          ids=ids,
+          fields='nextPageToken,%s(id,lastModifiedInfo)' % self._list_name).execute():
+        current[item['id']] = int(item.get('lastModifiedInfo', {}).get('time', 0))
+      store.validate(self._entity, persisted, current)
+    except Exception:
+      pass
+
+  def _pre_fetch_parent(self, parent_id, names):
+    """Lists all items under a parent once and caches those matching names.
+
+    Names matching more than one item are not cached, so process raises the
+    same duplicate error as a search would.
+
+    Args:
+      parent_id: Value for the parent filter, for example a campaign id.
+      names: Dictionary of stripped name to the store keys to set.
+    """
+    print('pre fetching %s for %s %s' % (self._list_name, self._parent_filter_name, parent_id))
+    matches = {}
+    for item in self._api(iterate=True).list(
+        profileId=self.profile_id,
+        **{self._parent_filter_name: parent_id}).execute():
+      if item['name'] in names:
+        matches.setdefault(item['name'], []).append(item)
+
+    for name, items in matches.items():
+      if len(items) == 1:
+        store.set(self._entity, names[name], items[0])
+
+  def _pre_fetch_name(self, feed_item, keys):
+    """Searches one item by name into the cache.
+
+    Errors such as duplicate names are ignored here, they are raised and
+    logged for the specific feed item when it is processed.
+    """
+    try:
+      item, key = self._get_by_name(feed_item)
+      if item:
+        store.set(self._entity, keys + [key], item)
+    except Exception:
+      pass
+
   def pre_fetch(self, feed):
     """Pre-fetches all required items to be update into the cache.
 
-    This increases performance for update operations.
+    This increases performance for update operations.  Ids, including ext ids
+    already in the store id map, are fetched in chunks of 500.  Names found
+    in the persisted store are validated against CM in chunks of 500, the
+    rest are grouped by parent, large groups are resolved with one paged
+    list of the parent, the rest with individual searches.  All calls run
+    concurrently, so the store is filled before the feed is processed.
 
     Args:
       feed: List of feed items to retrieve
     """
     if hasattr(self, '_list_name') and self._list_name and self._id_field:
       print('pre fetching %s' % self._list_name)
-      ids = [
-          feed_item[self._id_field]
-          for feed_item in feed
-          if isinstance(feed_item[self._id_field], int)
-      ]
-
-      if ids:
-        for i in range(0, len(ids), 500):
-          results = self._api(iterate=True).list(
-              profileId=self.profile_id, ids=ids[i:i + 500]).execute()
-          for item in results:
-            store.set(self._entity, [item['id']], item)
+
+      ids = set()
+      named = []
+      parents = {}
+      searches = {}
+
+      for feed_item in feed:
+        id_value = feed_item.get(self._id_field)
+
+        if isinstance(id_value, str) and id_value.startswith('ext'):
+          id_value = store.translate(self._entity, id_value)
+
+        # CM ids from the id map and the API are strings of digits
+        if isinstance(id_value, str) and id_value.isdigit():
+          id_value = int(id_value)
+
+        if isinstance(id_value, int):
+          ids.add(id_value)
+
+        elif not id_value and getattr(self, '_search_field', None) and feed_item.get(self._search_field):
+          store_key = feed_item[self._search_field]
+          parent_id = None
+
+          if self._parent_filter_name:
+            parent_id = feed_item.get(self._parent_filter_field_name)
+            if parent_id:
+              store_key = str(parent_id) + store_key
+
+          named.append((feed_item, store_key, parent_id))
+
+      # names persisted by a previous run are reused only if unchanged in CM
+      persisted = store.persisted(self._entity, [name[1] for name in named])
+      persisted_ids = sorted(set(
+          identifier for identifier, modified in persisted.values()
+          if identifier is not None))
+
+      with ThreadPoolExecutor(max_workers=PRE_FETCH_WORKERS) as executor:
+        jobs = []
+        for i in range(0, len(persisted_ids), 500):
+          chunk = set(persisted_ids[i:i + 500])
+          jobs.append(executor.submit(
+              self._pre_fetch_versions,
+              dict((key, version) for key, version in persisted.items() if version[0] in chunk),
+              sorted(chunk)))
+
+        for job in jobs:
+          job.result()
+
+      for feed_item, store_key, parent_id in named:
+        if store.get(self._entity, store_key):
+          continue
+
+        # only parents given as CM ids can be grouped, others resolve later
+        if isinstance(parent_id, int):
+          names = parents.setdefault(parent_id, {})
+          names.setdefault(feed_item[self._search_field].strip(), []).append(store_key)
+        elif not self._parent_filter_name:
+          searches.setdefault(store_key, feed_item)
+
+      ids = sorted(ids)
+
+      with ThreadPoolExecutor(max_workers=PRE_FETCH_WORKERS) as executor:
+        jobs = [
+            executor.submit(self._pre_fetch_ids, ids[i:i + 500])
+            for i in range(0, len(ids), 500)
+        ]
+
+        for parent_id, names in parents.items():
+          if len(names) >= PRE_FETCH_LIST_MINIMUM:
+            jobs.append(executor.submit(self._pre_fetch_parent, parent_id, names))
+          else:
+            jobs.extend(
+                executor.submit(self._pre_fetch_name, {
+                    self._search_field: name,
+                    self._parent_filter_field_name: parent_id
+                }, keys) for name, keys in names.items())
+
+        jobs.extend(
+            executor.submit(self._pre_fetch_name, feed_item, [store_key])
+            for store_key, feed_item in searches.items())
+
+        for job in jobs:
+          job.result()
 
   def process(self, feed_item):
     """Processes a Bulkdozer feed item.
@@ -261,7 +424,8 @@ class BaseDAO(object):
     Returns:
       Newly created or updated CM object.
     """
-    item = self.get(feed_item)
+    # fresh copy, updating a persisted one could revert changes made in CM
+    item = self.get(feed_item, persisted=False)
 
     if item:
       self._process_update(item, feed_item)
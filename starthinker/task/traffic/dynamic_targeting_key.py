@@ -73,6 +73,12 @@ class DynamicTargetingKeyDAO(BaseDAO):
       cache_key = str(object_id) + key_name
       self._key_cache[cache_key] = True
 
+  def feed_item_key(self, feed_item):
+    """Items creating the same advertiser level key must run in order."""
+    return '%s%s' % (
+        feed_item.get(FieldMap.ADVERTISER_ID, ''),
+        feed_item.get(FieldMap.DYNAMIC_TARGETING_KEY_NAME, ''))
+
   def process(self, feed_item):
     """Processes a Bulkdozer feed item.
 
@@ -18,6 +18,7 @@
 """Handles logging actions back to the Bulkdozer feed Log tab."""
 
 import datetime
+import threading
 
 from starthinker.util.sheets import sheets_write, sheets_clear
 
@@ -72,6 +73,8 @@ class Logger(object):
     self._buffer = []
     self.buffered = True
     self._flush_threshold = flush_threshold
+    self._lock = threading.RLock()
+    self._local = threading.local()
 
   def clear(self):
     """Clears the log tab in the Bulkdozer feed, useful when a new execution is starting."""
@@ -85,22 +88,55 @@ class Logger(object):
       message: The message to log to the feed, it will be appended at the bottom
         of the log, after the last message that was written.
     """
-    self._buffer.append(
-        [datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.000%z'), message])
+    self.extend(
+        [[datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.000%z'), message]])
 
-    if not self.buffered or (self._flush_threshold and
-                             len(self._buffer) >= self._flush_threshold):
-      self.flush()
+  def extend(self, entries):
+    """Logs entries returned by release, keeping their original timestamps.
+
+    Args:
+      entries: List of [timestamp, message] rows.
+    """
+    captured = getattr(self._local, 'captured', None)
+    if captured is not None:
+      captured.extend(entries)
+      return
+
+    with self._lock:
+      self._buffer.extend(entries)
+
+      if not self.buffered or (self._flush_threshold and
+                               len(self._buffer) >= self._flush_threshold):
+        self.flush()
+
+  def capture(self):
+    """Holds messages logged by the current thread until release is called.
+
+    Used when work runs concurrently, so each unit of work can be written to
+    the Log tab in the original order instead of interleaved.
+    """
+    self._local.captured = []
+
+  def release(self):
+    """Stops capturing for the current thread.
+
+    Returns:
+      The captured [timestamp, message] rows, pass them to extend.
+    """
+    captured = getattr(self._local, 'captured', None) or []
+    self._local.captured = None
+    return captured
 
   def flush(self):
     """Flushes the message buffer writing buffered messages to the sheet."""
-    if self._buffer:
-      sheets_write(
-          self.config, self.auth, self.trix_id, 'Log', 'A1', self._buffer, append=True)
+    with self._lock:
+      if self._buffer:
+        sheets_write(
+            self.config, self.auth, self.trix_id, 'Log', 'A1', self._buffer, append=True)
 
-      self._row += len(self._buffer)
+        self._row += len(self._buffer)
 
-      self._buffer = []
+        self._buffer = []
 
 
 logger = Logger()
@@ -17,7 +17,13 @@
 ###########################################################################
 """Main entry point of Bulkdozer."""
 
+import os
+import hashlib
+import tempfile
 import traceback
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from starthinker.util.cm import get_profile_for_api
 from starthinker.util.sheets import sheets_get
@@ -35,7 +41,7 @@ from starthinker.task.traffic.landing_page import LandingPageDAO
 from starthinker.task.traffic.placement import PlacementDAO
 from starthinker.task.traffic.placement_group import PlacementGroupDAO
 from starthinker.task.traffic.video_format import VideoFormatDAO
-from starthinker.task.traffic.store import store
+from starthinker.task.traffic.store import store, STORE_TTL
 from starthinker.task.traffic.logger import logger
 
 video_format_dao = None
@@ -50,9 +56,13 @@ ad_dao = None
 event_tag_dao = None
 dynamic_targeting_key_dao = None
 spreadsheet = None
+item_executor = None
 
 clean_run = True
 
+# default number of feed items processed concurrently
+TRAFFIC_WORKERS = 8
+
 
 def process_feed(config, task, feed_name, dao, print_field, msg='Processing'):
   """Processes a feed that represents a specific entity in the Bulkdozer feed.
@@ -95,27 +105,74 @@ def execute_feed(feed, dao, print_field, msg='Processing'):
       feed, for instance we display Processing Campaign for campaign, and
       Uploading Asset for assets.
   """
-  global clean_run
-
   try:
     dao.pre_fetch(feed.feed)
 
-    for feed_item in feed.feed:
-      try:
-        value = feed_item[print_field]
-        print('%s %s' % (msg, value))
-        logger.log('%s %s' % (msg, value))
-        dao.process(feed_item)
-      except Exception as error:
-        clean_run = False
-        stack = traceback.format_exc()
-        print(stack)
-        logger.log(str(error))
+    # sequential unless traffic has set up an executor
+    if item_executor is None:
+      for feed_item in feed.feed:
+        execute_item(dao, feed_item, print_field, msg)
+
+    # items for the same entity run in order, distinct entities concurrently
+    else:
+      groups = {}
+      for index, feed_item in enumerate(feed.feed):
+        key = dao.feed_item_key(feed_item)
+        groups.setdefault(index if key is None else key, []).append(feed_item)
+
+      futures = {}
+      for group in groups.values():
+        future = item_executor.submit(execute_group, dao, group, print_field, msg)
+        for feed_item in group:
+          futures[id(feed_item)] = future
+
+      # write the Log tab in feed order as each prefix of the feed completes
+      for feed_item in feed.feed:
+        logger.extend(futures[id(feed_item)].result()[id(feed_item)])
 
   finally:
     feed.update()
 
 
+def execute_item(dao, feed_item, print_field, msg):
+  """Processes one feed item, logging errors instead of raising them.
+
+  Args:
+    dao: The data access object for the feed.
+    feed_item: The feed item to process.
+    print_field: Field that identifies the item in the Log tab.
+    msg: Prefix message for the Log tab.
+  """
+  global clean_run
+
+  try:
+    value = feed_item[print_field]
+    print('%s %s' % (msg, value))
+    logger.log('%s %s' % (msg, value))
+    dao.process(feed_item)
+  except Exception as error:
+    clean_run = False
+    stack = traceback.format_exc()
+    print(stack)
+    logger.log(str(error))
+
+
+def execute_group(dao, group, print_field, msg):
+  """Processes feed items for the same entity in order, in a worker thread.
+
+  Returns:
+    Dictionary of id( feed item ) to its captured Log tab entries.
+  """
+  entries = {}
+  for feed_item in group:
+    logger.capture()
+    try:
+      execute_item(dao, feed_item, print_field, msg)
+    finally:
+      entries[id(feed_item)] = logger.release()
+  return entries
+
+
 def setup(config, task):
   """Sets up Bulkdozer configuration and required object to execute the job."""
 
@@ -154,9 +211,17 @@ def init_daos(config, task):
 
   spreadsheet = sheets_get(config, task['auth'], task['sheet_id'])
 
-  #store.auth = task['auth']
-  #store.trix_id = task.get('store', {}).get('sheet_id', task['sheet_id'])
-  #store.load_id_map()
+  # persist id maps and entities per feed and profile, allows resuming a failed run
+  store.open(
+    task.get('store', {}).get('path') or os.path.join(
+      tempfile.gettempdir(),
+      'bulkdozer_%s_%s.sqlite' % (
+        task['dcm_profile_id'],
+        hashlib.sha256(task['sheet_id'].encode('utf-8')).hexdigest()[:16]
+      )
+    ),
+    task.get('store', {}).get('ttl', STORE_TTL)
+  )
 
   video_format_dao = VideoFormatDAO(config, task['auth'],
                                     task['dcm_profile_id'],
@@ -375,9 +440,81 @@ def dynamic_targeting_keys(config, task):
                'Processing dynamic targeting key')
 
 
+# each stage with the stages whose CM entities it references, in log order
+TRAFFIC_STAGES = (
+    (assets, ()),
+    (landing_pages, ()),
+    (campaigns, (landing_pages,)),
+    (event_tags, (campaigns,)),
+    (placement_groups, (campaigns,)),
+    (placements, (campaigns, placement_groups)),
+    (creatives, (assets, landing_pages, campaigns)),
+    (ads, (campaigns, landing_pages, event_tags, placements, creatives)),
+    (dynamic_targeting_keys, (ads,)),
+)
+
+
+def execute_stages(config, task, stages, workers):
+  """Runs each stage as soon as the stages it depends on are done.
+
+  Independent stages, for example assets and landing pages, run at the same
+  time.  Each stage's Log tab messages are captured and written in the
+  original stage order.  If a stage raises, no new stages are started and
+  the first error is raised once running stages finish.
+
+  Args:
+    stages: Tuple of ( function, dependencies ) like TRAFFIC_STAGES.
+    workers: Maximum number of stages running at the same time.
+  """
+
+  def execute_stage(stage):
+    logger.capture()
+    try:
+      stage(config, task)
+    except Exception as error:
+      return logger.release(), error
+    return logger.release(), None
+
+  done = {}
+  running = {}
+  errors = []
+  logged = 0
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    while True:
+      if not errors:
+        for stage, dependencies in stages:
+          if stage not in done and stage not in running.values() and all(
+              dependency in done for dependency in dependencies):
+            running[executor.submit(execute_stage, stage)] = stage
+
+      if not running:
+        break
+
+      finished, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in finished:
+        stage = running.pop(future)
+        done[stage], error = future.result()
+        if error is not None:
+          errors.append(error)
+
+      # write logs for every completed stage at the front of the order
+      while logged < len(stages) and stages[logged][0] in done:
+        logger.extend(done[stages[logged][0]])
+        logged += 1
+
+  # a failed stage leaves later stages unlogged, write what did run
+  for stage, dependencies in stages[logged:]:
+    logger.extend(done.get(stage, []))
+
+  if errors:
+    raise errors[0]
+
+
 def traffic(config, task):
   """Main function of Bulkdozer, performs the Bulkdozer job"""
   global clean_run
+  global item_executor
   if config.verbose:
     print('traffic')
 
@@ -389,15 +526,14 @@ def traffic(config, task):
     logger.flush()
 
     init_daos(config, task)
-    assets(config, task)
-    landing_pages(config, task)
-    campaigns(config, task)
-    event_tags(config, task)
-    placement_groups(config, task)
-    placements(config, task)
-    creatives(config, task)
-    ads(config, task)
-    dynamic_targeting_keys(config, task)
+
+    workers = task.get('workers', TRAFFIC_WORKERS)
+    if workers > 1:
+      item_executor = ThreadPoolExecutor(max_workers=workers)
+      execute_stages(config, task, TRAFFIC_STAGES, workers)
+    else:
+      for stage, dependencies in TRAFFIC_STAGES:
+        stage(config, task)
 
     #if clean_run:
     #  store.clear()
@@ -409,9 +545,12 @@ def traffic(config, task):
     logger.log(str(error))
 
   finally:
+    if item_executor is not None:
+      item_executor.shutdown()
+      item_executor = None
     logger.log('Bulkdozer traffic job ended')
     logger.flush()
-    #store.save_id_map()
+    store.close()
 
   if clean_run:
     print('Done: Clean run.')
@@ -23,11 +23,25 @@
 
   Caching is important for performance reasons, and to reduce the number of
   calls to the CM API.
+
+  When opened with a path, both are written through to a local SQLite file:
+
+  - The id map is kept forever, so a failed run resumes without re-creating
+    entities it already inserted.
+  - Cached entities are kept for up to ttl seconds and reused by later runs
+    only after validate confirms their lastModifiedInfo still matches CM, so
+    lookups of campaigns, landing pages, etc... by name skip the CM API search.
+    CM entities carry no etag, lastModifiedInfo is the only version available.
+    An entity is never replaced by a copy with an older lastModifiedInfo.
+  - Entities read for an update are always fresh, see get( persisted ).
 """
 
-#import json
+import json
+import sqlite3
+import threading
+from time import time
 
-#from starthinker.util.sheets import sheets_read, sheets_write, sheets_clear
+STORE_TTL = 24 * 60 * 60
 
 
 class Store(object):
@@ -36,51 +50,45 @@ class Store(object):
   def __init__(self):
     """Initializes the store.
 
-    Since this is a sigleton, before the fist usage the trix id and auth scheme
-    must be set.
+    Since this is a sigleton, call open before the first usage to persist.
     """
     self._store = {}
     self._id_map = {}
+    self._db = None
+    self._valid = set()
+    self._lock = threading.Lock()  # guards the maps and the db, stages run concurrently
+    self.ttl = STORE_TTL
 
+  def open(self, path, ttl=STORE_TTL):
+    """Persists the store to a SQLite file, loading any existing id map.
 
-#    self.trix_id = None
-#    self.auth = None
-
-#  def load_id_map(self):
-#    """Loads the ID map from the Bulkdozer feed into the object.
-#
-#    """
-#    if self.trix_id:
-#      data = sheets_read(self.auth, self.trix_id, 'Store', 'A1:Z1')
-#      content = ''
-#      if data and data[0]:
-#        for cell in data[0]:
-#          content += cell
-#
-#        self._id_map = json.loads(content)
-#      else:
-#        self._id_map = {}
-
-#  def save_id_map(self):
-#    """Saves the ID map into the Bulkdozer feed.
-#
-#    """
-#    if self.trix_id:
-#      columns = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'W', 'X', 'Y', 'Z']
-#
-#      data = json.dumps(self._id_map)
-#      data = [data[start:start+49999] for start in range(0, len(data), 49999)]
-#      sheets_write(self.auth, self.trix_id, 'Store', 'A:' + columns[len(data) + 1], [data])
-
-#  def clear(self):
-#    """Clears the store in the Bulkdozer feed.
-#
-#    """
-#    if self.trix_id:
-#      sheets_clear(self.auth, self.trix_id, 'Store', 'A1:Z1')
-#
-#    self._store = {}
-#    self._id_map = {}
+    Args:
+      path: Local file to use, created if it does not exist.
+      ttl: Seconds a persisted entity can be reused by a later run.
+    """
+    self.close()
+    self.ttl = ttl
+
+    with self._lock:
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS id_map (entity TEXT, identifier TEXT, counterpart TEXT, PRIMARY KEY (entity, identifier))'
+      )
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS entities (entity TEXT, key TEXT, item TEXT, modified INTEGER, cached REAL, PRIMARY KEY (entity, key))'
+      )
+      self._db.commit()
+
+      for entity, identifier, counterpart in self._db.execute(
+          'SELECT entity, identifier, counterpart FROM id_map'):
+        self._id_map.setdefault(entity, {})[json.loads(identifier)] = json.loads(counterpart)
+
+  def close(self):
+    """Closes the SQLite file, the in memory store remains usable."""
+    with self._lock:
+      if self._db:
+        self._db.close()
+        self._db = None
 
   def map(self, entity, ext_id, dcm_id):
     """Maps a CM id and an ext id for an entity.
@@ -90,11 +98,18 @@ class Store(object):
       ext_id: Placeholder ext id.
       dcm_id: Real CM id of the object.
     """
-    if not entity in self._id_map:
-      self._id_map[entity] = {}
-
-    self._id_map[entity][ext_id] = dcm_id
-    self._id_map[entity][dcm_id] = ext_id
+    with self._lock:
+      id_map = self._id_map.setdefault(entity, {})
+      id_map[ext_id] = dcm_id
+      id_map[dcm_id] = ext_id
+
+      # commit immediately, this is what allows a failed run to resume
+      if self._db:
+        self._db.executemany(
+            'INSERT OR REPLACE INTO id_map VALUES (?, ?, ?)',
+            [(entity, json.dumps(ext_id), json.dumps(dcm_id)),
+             (entity, json.dumps(dcm_id), json.dumps(ext_id))])
+        self._db.commit()
 
   def translate(self, entity, identifier):
     """Given an id, returns its counterpart.
@@ -105,10 +120,8 @@ class Store(object):
       entity: The name of the entity for which the ID relates.
       identifier: Ext id or actual CM id to map.
     """
-    if entity in self._id_map and identifier in self._id_map[entity]:
-      return self._id_map[entity][identifier]
-
-    return None
+    with self._lock:
+      return self._id_map.get(entity, {}).get(identifier)
 
   def set(self, entity, keys, item):
     """Sets an item in the cache.
@@ -119,21 +132,96 @@ class Store(object):
         and the actual CM id.
       item: The item to cache.
     """
-    if not entity in self._store:
-      self._store[entity] = {}
+    with self._lock:
+      cache = self._store.setdefault(entity, {})
+      for key in keys:
+        cache[str(key)] = item
+
+      if self._db and item and keys:
+        data = json.dumps(item)
+        modified = int(item.get('lastModifiedInfo', {}).get('time', 0))
+        now = time()
+        self._db.executemany(
+            'INSERT INTO entities VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (entity, key) DO UPDATE SET item=excluded.item, modified=excluded.modified, cached=excluded.cached '
+            'WHERE excluded.modified >= entities.modified',
+            [(entity, str(key), data, modified, now) for key in keys])
+        self._db.commit()
+
+  def persisted(self, entity, keys):
+    """Returns the CM versions of persisted items not yet validated this run.
+
+    Args:
+      entity: The entity cache to use.
+      keys: The keys to look up.
+
+    Returns:
+      Dictionary of key to ( CM id, lastModifiedInfo time ) for each key with
+      a persisted item younger than ttl.
+    """
+    versions = {}
 
-    for key in keys:
-      self._store[entity][str(key)] = item
+    with self._lock:
+      if self._db:
+        for key in set(str(key) for key in keys):
+          if (entity, key) in self._valid:
+            continue
+          row = self._db.execute(
+              'SELECT item, modified FROM entities WHERE entity=? AND key=? AND cached>=?',
+              (entity, key, time() - self.ttl)).fetchone()
+          if row:
+            versions[key] = (json.loads(row[0]).get('id'), row[1])
 
-  def get(self, entity, key):
+    return versions
+
+  def validate(self, entity, persisted, current):
+    """Allows reuse of persisted items whose version still matches CM.
+
+    Matching items are loaded into this run's cache, they are as current as
+    a fresh fetch, so get returns them even with persisted=False.  Items
+    changed or deleted in CM since they were persisted are removed.
+
+    Args:
+      entity: The entity cache to use.
+      persisted: Dictionary returned by persisted.
+      current: Dictionary of CM id to current lastModifiedInfo time.
+    """
+    with self._lock:
+      for key, (identifier, modified) in persisted.items():
+        if identifier is not None and current.get(identifier) == modified:
+          self._valid.add((entity, key))
+          row = self._db.execute(
+              'SELECT item FROM entities WHERE entity=? AND key=?',
+              (entity, key)).fetchone() if self._db else None
+          if row:
+            self._store.setdefault(entity, {})[key] = json.loads(row[0])
+        elif self._db:
+          self._db.execute(
+              'DELETE FROM entities WHERE entity=? AND key=?', (entity, key))
+      if self._db:
+        self._db.commit()
+
+  def get(self, entity, key, persisted=True):
     """Gets and item from the cache.
 
     Args:
       entity: The entity cache to use.
       key: The key to use to lookup the cached item.
+      persisted: If False, only return items cached during this run, use
+        when the item will be updated so changes made in CM are not reverted.
+        Persisted items are only returned once validated this run.
     """
-    if entity in self._store:
-      return self._store[entity].get(str(key))
+    with self._lock:
+      item = self._store.get(entity, {}).get(str(key))
+      if item:
+        return item
+
+      if persisted and self._db and (entity, str(key)) in self._valid:
+        row = self._db.execute(
+            'SELECT item FROM entities WHERE entity=? AND key=? AND cached>=?',
+            (entity, str(key), time() - self.ttl)).fetchone()
+        if row:
+          return json.loads(row[0])
 
     return None
 
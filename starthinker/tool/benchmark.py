@@ -0,0 +1,103 @@
+###########################################################################
+#
+#  Copyright 2020 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+###########################################################################
+
+import argparse
+import textwrap
+from time import perf_counter
+
+from starthinker.util.csv import chunks_to_rows, csv_to_rows
+
+
+def csv_sample(megabytes):
+  """Build a CM report like CSV, every 10th row has a quoted newline."""
+
+  header = 'Date,Advertiser,Campaign,Placement,Impressions,Clicks,Cost\n'
+  lines = [header]
+  size = len(header)
+  row = 0
+  while size < megabytes * 1024 * 1024:
+    name = '"Placement, %d\nsecond line"' % row if row % 10 == 0 else 'Placement %d' % row
+    line = '2020-01-%02d,Advertiser %d,Campaign ä %d,%s,%d,%d,%0.2f\n' % (
+      row % 28 + 1, row % 50, row % 500, name, row * 7, row % 13, row / 3.0
+    )
+    lines.append(line)
+    size += len(line)
+    row += 1
+  return ''.join(lines)
+
+
+def csv_chunks(data, chunksize):
+  for position in range(0, len(data), chunksize):
+    yield data[position:position + chunksize]
+
+
+def csv_legacy(chunks):
+  """The stitch and re-parse approach report_to_rows used to take."""
+
+  leftovers = ''
+  for chunk in chunks:
+    data, extra = chunk.rsplit('\n', 1)
+    yield from csv_to_rows(leftovers + data)
+    leftovers = extra
+  yield from csv_to_rows(leftovers)
+
+
+def csv_benchmark(name, rows, megabytes):
+  start = perf_counter()
+  count = sum(1 for _ in rows)
+  seconds = perf_counter() - start
+  print('%-10s %10d rows %12.0f rows/sec %8.1f MB/sec' % (
+    name, count, count / seconds, megabytes / seconds
+  ))
+
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent("""\
+    Measure CSV report parsing throughput in rows/sec and MB/sec.
+
+    Generates a synthetic report with quoted newlines, splits it into chunks
+    like a streamed download, and parses it with chunks_to_rows ( text and
+    bytes ) and with the legacy stitch and re-parse approach.  The legacy
+    row count may differ, it cannot handle newlines split across chunks.
+
+    Examples:
+      Default: `python benchmark.py`
+      Larger report, smaller chunks: `python benchmark.py -size 500 -chunk 1`
+
+  """))
+
+  parser.add_argument('-size', help='report size in MB', default=100, type=int)
+  parser.add_argument('-chunk', help='chunk size in MB', default=10, type=float)
+  args = parser.parse_args()
+
+  data = csv_sample(args.size)
+  encoded = data.encode('utf-8')
+  megabytes = len(encoded) / 1024 / 1024
+  chunksize = int(args.chunk * 1024 * 1024)
+
+  print('REPORT: %.1f MB in %.1f MB chunks' % (megabytes, args.chunk))
+  csv_benchmark('legacy', csv_legacy(csv_chunks(data, chunksize)), megabytes)
+  csv_benchmark('text', chunks_to_rows(csv_chunks(data, chunksize)), megabytes)
+  csv_benchmark('bytes', chunks_to_rows(csv_chunks(encoded, chunksize), 'utf-8'), megabytes)
+
+
+if __name__ == '__main__':
+  main()
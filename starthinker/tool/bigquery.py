@@ -98,7 +98,7 @@ def main():
       rows = csv_to_rows(csv_file.read())
 
       if not schema:
-        rows, schema = get_schema(rows)
+        rows, schema = get_schema(rows, spill=True)
         print('DETECETED SCHEMA', json.dumps(schema))
         print('Please run again with the above schema provided.')
         exit()
@@ -118,7 +118,7 @@ def main():
       rows = excel_to_rows(excel_file, args.excel_sheet)
 
       if not schema:
-        rows, schema = get_schema(rows)
+        rows, schema = get_schema(rows, spill=True)
         print('DETECETED SCHEMA', json.dumps(schema))
         print('Please run again with the above schema provided.')
         exit()
@@ -0,0 +1,138 @@
+###########################################################################
+#
+#  Copyright 2020 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+###########################################################################
+
+import os
+import glob
+import inspect
+import argparse
+import textwrap
+
+from starthinker.config import DISCOVERY_CACHE_PATH
+from starthinker.util import google_api
+from starthinker.util.discovery_cache import discovery_document
+from starthinker.util.discovery_to_bigquery import Discovery_To_BigQuery
+from starthinker.util.recipe import get_recipe
+
+SCRIPTS_PATH = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+  'scripts'
+)
+
+
+def helper_apis():
+  """Return the ( api, version ) of every API_* helper in util/google_api.py."""
+
+  apis = set()
+  for name, function in inspect.getmembers(google_api, inspect.isfunction):
+    if name.startswith('API_') and list(inspect.signature(function).parameters)[:2] == ['config', 'auth']:
+      api = function(None, None)
+      apis.add((api.api, api.version))
+  return apis
+
+
+def recipe_apis(struct):
+  """Recursively find every { "api":..., "version":... } pair in a recipe."""
+
+  apis = set()
+  if isinstance(struct, dict):
+    if isinstance(struct.get('api'), str) and isinstance(struct.get('version'), str):
+      apis.add((struct['api'], struct['version']))
+    for value in struct.values():
+      apis.update(recipe_apis(value))
+  elif isinstance(struct, list):
+    for value in struct:
+      apis.update(recipe_apis(value))
+  return apis
+
+
+def recipe_methods(struct):
+  """Recursively find every { "api":..., "version":..., "function":... } call in a recipe."""
+
+  methods = set()
+  if isinstance(struct, dict):
+    if all(isinstance(struct.get(k), str) for k in ('api', 'version', 'function')):
+      methods.add((struct['api'], struct['version'], struct['function'], bool(struct.get('iterate', False))))
+    for value in struct.values():
+      methods.update(recipe_methods(value))
+  elif isinstance(struct, list):
+    for value in struct:
+      methods.update(recipe_methods(value))
+  return methods
+
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent("""\
+    Pre populate the discovery document cache used by all API calls.
+
+    Scans every recipe in scripts/*.json and every API helper for the APIs
+    used, then fetches each discovery document into the cache directory.
+    Run at deploy time or daily via cron so recipes start without any
+    discovery network calls, and can run offline.
+
+    Also builds the BigQuery schema of every API function called by a recipe,
+    so writing results to BigQuery is a cache lookup instead of a schema walk.
+
+    Examples:
+      Warm all recipe APIs: `python discovery.py`
+      Warm a single API: `python discovery.py -api displayvideo -version v1`
+      Force refresh: `python discovery.py --refresh`
+      Build a single schema: `python discovery.py -api dfareporting -version v3.4 -function sites.list --iterate`
+
+  """))
+
+  parser.add_argument('-api', help='api to cache, name of product api', default=None)
+  parser.add_argument('-version', help='version of api to cache', default=None)
+  parser.add_argument('-key', help='API Key of Google Cloud Project.', default=None)
+  parser.add_argument('-function', help='function schema to build, used with -api', default=None)
+  parser.add_argument('-scripts', help='path to recipe json files', default=SCRIPTS_PATH)
+  parser.add_argument('--iterate', help='build iterable schema, used with -function', action='store_true')
+  parser.add_argument('--refresh', help='fetch even if cache is fresh', action='store_true')
+  args = parser.parse_args()
+
+  if args.api:
+    apis = set([(args.api, args.version)])
+    methods = set([(args.api, args.version, args.function, args.iterate)]) if args.function else set()
+  else:
+    apis = helper_apis()
+    methods = set()
+    for filepath in glob.glob(os.path.join(args.scripts, '*.json')):
+      recipe = get_recipe(filepath)
+      apis.update(recipe_apis(recipe))
+      methods.update(recipe_methods(recipe))
+
+  print('DISCOVERY CACHE:', DISCOVERY_CACHE_PATH)
+  for api, version in sorted(apis):
+    try:
+      discovery_document(api, version, args.key, args.refresh)
+      print('CACHED:', api, version)
+    except Exception as e:
+      print('FAILED:', api, version, str(e))
+
+  for api, version, function, iterate in sorted(methods):
+    try:
+      Discovery_To_BigQuery(api, version, args.key).method_schema(function, iterate)
+      print('SCHEMA:', api, version, function, 'iterate' if iterate else '')
+    except Exception as e:
+      print('SCHEMA FAILED:', api, version, function, str(e))
+
+
+if __name__ == '__main__':
+  main()
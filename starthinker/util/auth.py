@@ -17,23 +17,116 @@
 ###########################################################################
 
 import sys
+import json
 import socket
+import hashlib
 import threading
+from time import time
+from urllib.parse import urlsplit
 
+import httplib2
+from google.auth.credentials import Scoped
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient import discovery
 from googleapiclient.http import HttpRequest
 
 from starthinker.util.auth_wrapper import CredentialsFlowWrapper
 from starthinker.util.auth_wrapper import CredentialsServiceWrapper
 from starthinker.util.auth_wrapper import CredentialsUserWrapper
+from starthinker.util.discovery_cache import discovery_document
 
 # WARNING:  possible issue if switching user credentials mid recipe, not in scope but possible ( need to address using hash? )
 CREDENTIALS_USER_CACHE = None
-DISCOVERY_CACHE = {}
+
+# one connection pool and service cache per thread, shared by every service
+# built in that thread and released with the thread ( never reused by another )
+THREAD_CACHE = threading.local()
+HTTP_METRICS = {}
+HTTP_METRICS_LOCK = threading.Lock()
 
 # set timeout to 10 minutes ( reduce socket.timeout: The read operation timed out )
 socket.setdefaulttimeout(600)
 
+class HttpPooled(httplib2.Http):
+  """Keep-alive connection pool that records per host metrics.
+
+  httplib2 already keeps one persistent connection per scheme and host, but
+  only within a single Http object.  By sharing one HttpPooled across every
+  service built in a thread, BigQuery, Storage, DV360, etc... calls reuse the
+  open TLS sockets instead of handshaking once per service.  Not thread safe,
+  which is why get_http returns one per thread.
+
+  Every request is counted in HTTP_METRICS, see get_http_metrics.
+  """
+
+  def request(self, uri, *args, **kwargs):
+    scheme, host = urlsplit(uri)[:2]
+    key = '%s:%s' % (scheme, host)
+    before = self.connections.get(key)
+    before_sock = getattr(before, 'sock', None)
+    start = time()
+
+    try:
+      return super(HttpPooled, self).request(uri, *args, **kwargs)
+    finally:
+      after = self.connections.get(key)
+      connected = after is not None and (after is not before or after.sock is not before_sock)
+      with HTTP_METRICS_LOCK:
+        metrics = HTTP_METRICS.setdefault(host, {'requests': 0, 'connections': 0, 'seconds': 0.0})
+        metrics['requests'] += 1
+        metrics['connections'] += int(connected)
+        metrics['seconds'] += time() - start
+
+
+def get_http():
+  """Return the connection pool for the current thread, creating it if needed.
+
+  Matches googleapiclient.http.build_http, including the socket timeout and
+  not following 308 redirects which resumable uploads rely on.
+  """
+
+  http = getattr(THREAD_CACHE, 'http', None)
+  if http is None:
+    http = HttpPooled(timeout=socket.getdefaulttimeout())
+    http.redirect_codes = http.redirect_codes - {308}
+    THREAD_CACHE.http = http
+  return http
+
+
+def get_http_authorized(credentials, document):
+  """Wrap the thread's connection pool with credentials for one API.
+
+  Passing http to build_from_document skips its scoping of the credentials,
+  so service credentials are scoped here from the discovery document instead.
+
+  Args:
+    * credentials: (Credentials) From get_credentials.
+    * document: (string) Discovery document JSON.
+
+  Returns:
+    AuthorizedHttp sharing the connections returned by get_http.
+  """
+
+  if isinstance(credentials, Scoped) and credentials.requires_scopes:
+    scopes = json.loads(document).get('auth', {}).get('oauth2', {}).get('scopes', {})
+    credentials = credentials.with_scopes(list(scopes.keys()))
+  return AuthorizedHttp(credentials, http=get_http())
+
+
+def get_http_metrics():
+  """Return a copy of the per host request, connection, and time counters.
+
+  A connection count close to the request count means sockets are not being
+  reused, usually because calls are spread across too many threads.
+
+  Returns:
+    { host: { 'requests': int, 'connections': int, 'seconds': float }}
+  """
+
+  with HTTP_METRICS_LOCK:
+    return { host: dict(metrics) for host, metrics in HTTP_METRICS.items() }
+
+
 def clear_credentials_cache():
   global CREDENTIALS_USER_CACHE
   CREDENTIALS_USER_CACHE = None
@@ -98,6 +191,24 @@ def get_credentials(config, auth):
       sys.exit(1)
 
 
+def get_principal(config, auth):
+  """Short stable hash identifying the credentials behind an auth.
+
+  Used to key process wide caches so different credentials never share them,
+  without putting the credentials themselves into keys or file names.
+
+  Args:
+    * config: (Configuration) Holds the recipe credentials, may be None.
+    * auth: (string) Either user or service.
+
+  Returns:
+    16 character hex string.
+  """
+
+  credentials = config.recipe.get('setup', {}).get('auth', {}).get(auth, '') if config else ''
+  return hashlib.sha256(('%s:%s' % (auth, credentials)).encode('utf-8')).hexdigest()[:16]
+
+
 def get_service(config,
   api='gmail',
   version='v1',
@@ -107,8 +218,6 @@ def get_service(config,
   key=None,
   uri_file=None
 ):
-  global DISCOVERY_CACHE
-
   class HttpRequestCustom(HttpRequest):
 
     def __init__(self, *args, **kwargs):
@@ -119,49 +228,31 @@ def get_service(config,
   if not key:
     key = config.recipe['setup'].get(key, '')
 
-  cache_key = api + version + auth + str(key) + str(threading.current_thread().ident)
+  services = getattr(THREAD_CACHE, 'services', None)
+  if services is None:
+    services = THREAD_CACHE.services = {}
+
+  cache_key = api + version + auth + str(key)
 
-  if cache_key not in DISCOVERY_CACHE:
-    credentials = get_credentials(config, auth)
+  if cache_key not in services:
     if uri_file:
       uri_file = uri_file.strip()
       if uri_file.startswith('{'):
-        DISCOVERY_CACHE[cache_key] = discovery.build_from_document(
-            uri_file,
-            credentials=credentials,
-            developerKey=key,
-            requestBuilder=HttpRequestCustom
-       )
+        document = uri_file
       else:
         with open(uri_file, 'r') as cache_file:
-          DISCOVERY_CACHE[cache_key] = discovery.build_from_document(
-              cache_file.read(),
-              credentials=credentials,
-              developerKey=key,
-              requestBuilder=HttpRequestCustom
-          )
+          document = cache_file.read()
     else:
-      try:
-        DISCOVERY_CACHE[cache_key] = discovery.build(
-          api,
-          version,
-          credentials=credentials,
-          developerKey=key,
-          requestBuilder=HttpRequestCustom,
-          static_discovery=False
-        )
-      # PATCH: static_discovery not present in google-api-python-client < 2, default version in colab
-      # ALTERNATE WORKAROUND: pip install update google-api-python-client==2.3 --no-deps --force-reinstall
-      except TypeError:
-        DISCOVERY_CACHE[cache_key] = discovery.build(
-          api,
-          version,
-          credentials=credentials,
-          developerKey=key,
-          requestBuilder=HttpRequestCustom
-        )
+      document = discovery_document(api, version, key)
+
+    services[cache_key] = discovery.build_from_document(
+      document,
+      http=get_http_authorized(get_credentials(config, auth), document),
+      developerKey=key,
+      requestBuilder=HttpRequestCustom
+    )
 
-  return DISCOVERY_CACHE[cache_key]
+  return services[cache_key]
 
 
 def get_client_type(credentials):
@@ -23,15 +23,21 @@ import base64
 import csv
 import uuid
 import json
+import pickle
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from time import sleep
 from io import BytesIO
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaUpload
 from google.cloud.bigquery._helpers import _row_tuple_from_json
 
 from starthinker.config import BUFFER_SCALE
 from starthinker.util import flag_last
-from starthinker.util.google_api import API_BigQuery, API_Retry
+from starthinker.util.google_api import API_BigQuery
 from starthinker.util.csv import row_header_sanitize
 
 BIGQUERY_BUFFERMAX = 4294967296
@@ -39,6 +45,12 @@ BIGQUERY_CHUNKSIZE = int(200 * 1024000 *
                          BUFFER_SCALE)  # 200 MB * scale in config.py
 BIGQUERY_BUFFERSIZE = min(BIGQUERY_CHUNKSIZE * 4,
                           BIGQUERY_BUFFERMAX)  # 1 GB * scale in config.py
+BIGQUERY_BUFFERS = 2  # buffers held in memory while loading, 1 disables pipelining
+BIGQUERY_UPLOAD_ALIGN = 256 * 1024  # resumable upload chunks must be multiples of this
+BIGQUERY_SCHEMA_SAMPLE = 10000  # suggested get_schema sample for streamed rows
+BIGQUERY_POLL_MIN = 0.5  # seconds before first job status check, doubles each check
+BIGQUERY_POLL_MAX = 30  # maximum seconds between job status checks
+BIGQUERY_POLL_TIMEOUT = 10000  # milliseconds getQueryResults long polls for completion
 
 RE_TABLE_NAME = re.compile(r'[^\w]+')
 RE_INDENT = re.compile(r' {5,}')
@@ -135,20 +147,42 @@ def query_parameters(query, parameters):
 
 
 def job_wait(config, auth, job):
-  if job:
-    if config.verbose:
-      print('BIGQUERY JOB WAIT:', job['jobReference']['jobId'])
+  jobs_wait(config, auth, [job])
 
-    request = API_BigQuery(config, auth).jobs().get(
-        projectId=job['jobReference']['projectId'],
-        jobId=job['jobReference']['jobId'])
 
-    while True:
-      sleep(5)
-      if config.verbose:
-        print('.', end='')
-      sys.stdout.flush()
-      result = API_Retry(request)
+def jobs_wait(config, auth, jobs):
+  """Wait for one or more BigQuery jobs to complete using adaptive polling.
+
+  The first status check happens after BIGQUERY_POLL_MIN seconds, and the wait
+  doubles after each round up to BIGQUERY_POLL_MAX seconds.  Short jobs finish
+  in under a second while long jobs make few status calls.  All pending jobs
+  are checked each round, so many jobs can be tracked at once.
+
+  Args:
+    jobs: (list) Job resources as returned by insert or query, None ignored.
+
+  Raises:
+    Exception: If any job completes with an error.
+  """
+
+  pending = [job['jobReference'] for job in jobs if job]
+  wait = BIGQUERY_POLL_MIN
+
+  if config.verbose:
+    for reference in pending:
+      print('BIGQUERY JOB WAIT:', reference['jobId'])
+
+  while pending:
+    sleep(wait)
+    wait = min(wait * 2, BIGQUERY_POLL_MAX)
+    if config.verbose:
+      print('.', end='')
+    sys.stdout.flush()
+
+    for reference in list(pending):
+      result = API_BigQuery(config, auth).jobs().get(
+          projectId=reference['projectId'],
+          jobId=reference['jobId']).execute()
       if 'errors' in result['status']:
         raise Exception(
             'BigQuery Job Error: %s' %
@@ -159,7 +193,7 @@ def job_wait(config, auth, job):
       elif result['status']['state'] == 'DONE':
         if config.verbose:
           print('JOB COMPLETE:', result['id'])
-        break
+        pending.remove(reference)
 
 
 def datasets_create(config, auth, project_id, dataset_id):
@@ -256,7 +290,8 @@ def query_to_table(config, auth,
                    disposition='WRITE_TRUNCATE',
                    legacy=True,
                    billing_project_id=None,
-                   target_project_id=None):
+                   target_project_id=None,
+                   parameters=None):
   target_project_id = target_project_id or project_id
 
   if not billing_project_id:
@@ -279,6 +314,11 @@ def query_to_table(config, auth,
       }
   }
 
+  # named standard SQL parameters, keeps values such as secrets out of the query text
+  if parameters:
+    body['configuration']['query']['parameterMode'] = 'NAMED'
+    body['configuration']['query']['queryParameters'] = parameters
+
   job_wait(
       config, auth,
       API_BigQuery(config, auth).jobs().insert(projectId=billing_project_id,
@@ -365,70 +405,48 @@ def storage_to_table(config, auth,
     return job
 
 
-def rows_to_table(config, auth,
-                  project_id,
-                  dataset_id,
-                  table_id,
-                  rows,
-                  schema=[],
-                  skip_rows=1,
-                  disposition='WRITE_TRUNCATE',
-                  wait=True):
-  if config.verbose:
-    print('BIGQUERY ROWS TO TABLE: ', project_id, dataset_id, table_id)
+def rows_to_buffers(rows):
+  """Encode rows as CSV into a sequence of buffers of BIGQUERY_BUFFERSIZE.
 
-  buffer_data = BytesIO()
-  buffer_writer = codecs.getwriter('utf-8')
-  writer = csv.writer(
-      buffer_writer(buffer_data),
-      delimiter=',',
-      quotechar='"',
-      quoting=csv.QUOTE_MINIMAL)
-  has_rows = False
+  Each buffer is a new BytesIO positioned at zero, so a buffer can be uploaded
+  while the next one is being written.
+  """
+
+  buffer_data = None
 
   for is_last, row in flag_last(rows):
 
+    if buffer_data is None:
+      buffer_data = BytesIO()
+      writer = csv.writer(
+          codecs.getwriter('utf-8')(buffer_data),
+          delimiter=',',
+          quotechar='"',
+          quoting=csv.QUOTE_MINIMAL)
+
     # write row to csv buffer
     writer.writerow(row)
 
     # write the buffer in chunks
     if is_last or buffer_data.tell() + 1 > BIGQUERY_BUFFERSIZE:
-      if config.verbose:
-        print('BigQuery Buffer Size', buffer_data.tell())
       buffer_data.seek(0)  # reset for read
-      io_to_table(config, auth, project_id, dataset_id, table_id, buffer_data, 'CSV',
-                  schema, skip_rows, disposition)
-
-      # reset buffer for next loop, be sure to do an append to the table
-      buffer_data.seek(0)  #reset for write
-      buffer_data.truncate(
-      )  # reset for write ( yes its needed for EOF marker )
-      disposition = 'WRITE_APPEND'  # append all remaining records
-      skip_rows = 0
-      has_rows = True
+      yield buffer_data
+      buffer_data = None
 
-  # if no rows, clear table to simulate empty write
-  if not has_rows:
-    return io_to_table(config, auth, project_id, dataset_id, table_id, buffer_data,
-                       'CSV', schema, skip_rows, disposition, wait)
 
+def json_to_buffers(json_data):
+  """Encode records as newline delimited JSON into a sequence of buffers.
 
-def json_to_table(config, auth,
-                  project_id,
-                  dataset_id,
-                  table_id,
-                  json_data,
-                  schema=None,
-                  disposition='WRITE_TRUNCATE',
-                  wait=True):
-  if config.verbose:
-    print('BIGQUERY JSON TO TABLE: ', project_id, dataset_id, table_id)
+  Records may already be JSON strings.  Same chunking as rows_to_buffers.
+  """
 
-  buffer_data = BytesIO()
-  has_rows = False
+  buffer_data = None
 
   for is_last, record in flag_last(json_data):
 
+    if buffer_data is None:
+      buffer_data = BytesIO()
+
     # check if json is already string encoded, and write to buffer
     buffer_data.write(
       (record if isinstance(record, str) else json.dumps(record, cls=JSON_To_BigQuery)
@@ -436,27 +454,237 @@ def json_to_table(config, auth,
 
     # write the buffer in chunks
     if is_last or buffer_data.tell() + 1 > BIGQUERY_BUFFERSIZE:
-      if config.verbose:
-        print('BigQuery Buffer Size', buffer_data.tell())
       buffer_data.seek(0)  # reset for read
-      io_to_table(config, auth, project_id, dataset_id, table_id, buffer_data,
-                  'NEWLINE_DELIMITED_JSON', schema, 0, disposition)
-
-      # reset buffer for next loop, be sure to do an append to the table
-      buffer_data.seek(0)  #reset for write
-      buffer_data.truncate(
-      )  # reset for write ( yes its needed for EOF marker )
-      disposition = 'WRITE_APPEND'  # append all remaining records
-      has_rows = True
+      yield buffer_data
+      buffer_data = None
 
     # if not end append newline, for newline delimited json
     else:
       buffer_data.write('\n'.encode('utf-8'))
 
+
+def buffers_to_table(config, auth,
+                     project_id,
+                     dataset_id,
+                     table_id,
+                     buffers,
+                     source_format='CSV',
+                     schema=None,
+                     skip_rows=0,
+                     disposition='WRITE_TRUNCATE',
+                     wait=True,
+                     in_flight=BIGQUERY_BUFFERS):
+  """Load a sequence of buffers into a table, encoding while uploading.
+
+  Each buffer is uploaded as a load job in a background thread while the
+  next buffer is produced by the iterator.  Jobs are submitted without
+  waiting and all are waited on once at the end.  At most in_flight buffers
+  are held in memory at any time.
+
+  The first buffer uses disposition and skip_rows, all others append.  If
+  the first load is not an append, later loads are held until it completes,
+  otherwise a truncate could land after an append.
+
+  Args:
+    buffers: (iterator) BytesIO objects positioned for reading.
+    in_flight: (int) Buffers held in memory at once, 1 uploads serially.
+    See io_to_table for remaining arguments.
+
+  Returns:
+    If wait is False, list of load jobs not waited on.
+  """
+
+  uploads = deque()
+  jobs = []
+  first = None
+  waited = False
+
+  with ThreadPoolExecutor(max_workers=max(1, in_flight - 1)) as executor:
+
+    for buffer_data in buffers:
+      if config.verbose:
+        print('BigQuery Buffer Size', buffer_data.seek(0, 2))
+        buffer_data.seek(0)
+
+      if first is None:
+        first = executor.submit(io_to_table, config, auth, project_id,
+                                dataset_id, table_id, buffer_data,
+                                source_format, schema, skip_rows,
+                                disposition, False)
+        uploads.append(first)
+
+      else:
+        # truncate must complete before any append is submitted
+        if disposition != 'WRITE_APPEND' and not waited:
+          job_wait(config, auth, first.result())
+          waited = True
+        uploads.append(
+            executor.submit(io_to_table, config, auth, project_id, dataset_id,
+                            table_id, buffer_data, source_format, schema, 0,
+                            'WRITE_APPEND', False))
+
+      # bound memory, the buffer being encoded next counts as one
+      while len(uploads) > in_flight - 1:
+        jobs.append(uploads.popleft().result())
+
+    jobs.extend(upload.result() for upload in uploads)
+
   # if no rows, clear table to simulate empty write
-  if not has_rows:
-    return io_to_table(config, auth, project_id, dataset_id, table_id, buffer_data,
-                       'NEWLINE_DELIMITED_JSON', schema, 0, disposition, wait)
+  if first is None:
+    return io_to_table(config, auth, project_id, dataset_id, table_id,
+                       BytesIO(), source_format, schema, skip_rows,
+                       disposition, wait)
+
+  # the first job is already complete if it was waited on above
+  if waited:
+    jobs = jobs[1:]
+
+  if wait:
+    jobs_wait(config, auth, jobs)
+  else:
+    return jobs
+
+
+def rows_to_table(config, auth,
+                  project_id,
+                  dataset_id,
+                  table_id,
+                  rows,
+                  schema=[],
+                  skip_rows=1,
+                  disposition='WRITE_TRUNCATE',
+                  wait=True,
+                  in_flight=BIGQUERY_BUFFERS):
+  if config.verbose:
+    print('BIGQUERY ROWS TO TABLE: ', project_id, dataset_id, table_id)
+
+  return buffers_to_table(config, auth, project_id, dataset_id, table_id,
+                          rows_to_buffers(rows), 'CSV', schema, skip_rows,
+                          disposition, wait, in_flight)
+
+
+def json_to_table(config, auth,
+                  project_id,
+                  dataset_id,
+                  table_id,
+                  json_data,
+                  schema=None,
+                  disposition='WRITE_TRUNCATE',
+                  wait=True,
+                  in_flight=BIGQUERY_BUFFERS):
+  if config.verbose:
+    print('BIGQUERY JSON TO TABLE: ', project_id, dataset_id, table_id)
+
+  return buffers_to_table(config, auth, project_id, dataset_id, table_id,
+                          json_to_buffers(json_data), 'NEWLINE_DELIMITED_JSON',
+                          schema, 0, disposition, wait, in_flight)
+
+
+class Media_Iterator_Upload(MediaUpload):
+  """Resumable upload of an iterator of bytes whose total size is unknown.
+
+  Only enough of the iterator to fill the current chunk is read, into one
+  reusable buffer.  Bytes are dropped once the upload moves past them, so
+  memory stays at about one chunk regardless of the total size.  A short
+  chunk tells the client library the upload is complete.
+  """
+
+  def __init__(self, chunks, mimetype='application/octet-stream', chunksize=BIGQUERY_CHUNKSIZE):
+    super(Media_Iterator_Upload, self).__init__()
+    self._chunks = iter(chunks)
+    self._mimetype = mimetype
+    self._chunksize = max(BIGQUERY_UPLOAD_ALIGN, chunksize - chunksize % BIGQUERY_UPLOAD_ALIGN)
+    self._buffer = bytearray()
+    self._offset = 0
+
+  def chunksize(self):
+    return self._chunksize
+
+  def mimetype(self):
+    return self._mimetype
+
+  def size(self):
+    return None
+
+  def resumable(self):
+    return True
+
+  def has_stream(self):
+    return False
+
+  def getbytes(self, begin, length):
+    # the upload never rewinds past the start of the chunk being retried
+    del self._buffer[:begin - self._offset]
+    self._offset = begin
+
+    while len(self._buffer) < length:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        break
+      self._buffer += chunk
+
+    return bytes(self._buffer[:length])
+
+  def to_json(self):
+    raise NotImplementedError('Iterator uploads cannot be serialized.')
+
+
+def media_to_table(config, auth,
+                   project_id,
+                   dataset_id,
+                   table_id,
+                   media,
+                   source_format='CSV',
+                   schema=None,
+                   skip_rows=0,
+                   disposition='WRITE_TRUNCATE',
+                   wait=True):
+
+  body = {
+      'configuration': {
+          'load': {
+              'destinationTable': {
+                  'projectId': project_id,
+                  'datasetId': dataset_id,
+                  'tableId': table_id,
+              },
+              'sourceFormat': source_format,  # CSV, NEWLINE_DELIMITED_JSON
+              'writeDisposition':
+                  disposition,  # WRITE_TRUNCATE, WRITE_APPEND, WRITE_EMPTY
+              'autodetect': True,
+              'allowJaggedRows': True,
+              'allowQuotedNewlines': True,
+              'ignoreUnknownValues': True,
+          }
+      }
+  }
+
+  if schema:
+    body['configuration']['load']['schema'] = {'fields': schema}
+    body['configuration']['load']['autodetect'] = False
+
+  if disposition == 'WRITE_APPEND':
+    body['configuration']['load']['autodetect'] = False
+
+  if source_format == 'CSV':
+    body['configuration']['load']['skipLeadingRows'] = skip_rows
+
+  job = API_BigQuery(config, auth).jobs().insert(
+      projectId=config.project, body=body, media_body=media).execute(run=False)
+  execution = job.execute()
+
+  response = None
+  while response is None:
+    status, response = job.next_chunk()
+    if config.verbose and status:
+      print('Uploaded %d%%.' % int(status.progress() * 100))
+  if config.verbose:
+    print('Uploaded 100%')
+
+  if wait:
+    job_wait(config, auth, execution)
+  else:
+    return execution
 
 
 def io_to_table(config, auth,
@@ -481,51 +709,9 @@ def io_to_table(config, auth,
         resumable=True,
         chunksize=BIGQUERY_CHUNKSIZE)
 
-    body = {
-        'configuration': {
-            'load': {
-                'destinationTable': {
-                    'projectId': project_id,
-                    'datasetId': dataset_id,
-                    'tableId': table_id,
-                },
-                'sourceFormat': source_format,  # CSV, NEWLINE_DELIMITED_JSON
-                'writeDisposition':
-                    disposition,  # WRITE_TRUNCATE, WRITE_APPEND, WRITE_EMPTY
-                'autodetect': True,
-                'allowJaggedRows': True,
-                'allowQuotedNewlines': True,
-                'ignoreUnknownValues': True,
-            }
-        }
-    }
-
-    if schema:
-      body['configuration']['load']['schema'] = {'fields': schema}
-      body['configuration']['load']['autodetect'] = False
-
-    if disposition == 'WRITE_APPEND':
-      body['configuration']['load']['autodetect'] = False
-
-    if source_format == 'CSV':
-      body['configuration']['load']['skipLeadingRows'] = skip_rows
-
-    job = API_BigQuery(config, auth).jobs().insert(
-        projectId=config.project, body=body, media_body=media).execute(run=False)
-    execution = job.execute()
-
-    response = None
-    while response is None:
-      status, response = job.next_chunk()
-      if config.verbose and status:
-        print('Uploaded %d%%.' % int(status.progress() * 100))
-    if config.verbose:
-      print('Uploaded 100%')
-
-    if wait:
-      job_wait(config, auth, execution)
-    else:
-      return execution
+    return media_to_table(config, auth, project_id, dataset_id, table_id,
+                          media, source_format, schema, skip_rows,
+                          disposition, wait)
 
   # if it does not exist and write, clear the table
   elif disposition == 'WRITE_TRUNCATE':
@@ -534,6 +720,38 @@ def io_to_table(config, auth,
     table_create(config, auth, project_id, dataset_id, table_id, schema)
 
 
+def stream_to_table(config, auth,
+                    project_id,
+                    dataset_id,
+                    table_id,
+                    chunks,
+                    source_format='CSV',
+                    schema=None,
+                    skip_rows=0,
+                    disposition='WRITE_TRUNCATE',
+                    wait=True):
+  """Load an iterator of bytes as one load job with one resumable upload.
+
+  Unlike buffers_to_table, the data is never split into separate jobs, so
+  rows do not need to be aligned to chunk boundaries.  The iterator is read
+  as the upload progresses.
+
+  Args:
+    chunks: (iterator) Bytes, any size, in file order.
+    See io_to_table for remaining arguments.
+
+  Returns:
+    If wait is False, the load job not waited on.
+  """
+
+  if config.verbose:
+    print('BIGQUERY STREAM TO TABLE: ', project_id, dataset_id, table_id)
+
+  return media_to_table(config, auth, project_id, dataset_id, table_id,
+                        Media_Iterator_Upload(chunks), source_format, schema,
+                        skip_rows, disposition, wait)
+
+
 def incremental_rows_to_table(config, auth,
                               project_id,
                               dataset_id,
@@ -777,7 +995,7 @@ def query_to_rows(config, auth,
   body = {
       'kind': 'bigquery#queryRequest',
       'query': query,
-      'timeoutMs': 10000,
+      'timeoutMs': BIGQUERY_POLL_TIMEOUT,
       'dryRun': False,
       'useQueryCache': True,
       'useLegacySql': legacy
@@ -789,15 +1007,15 @@ def query_to_rows(config, auth,
   if dataset_id:
     body['defaultDataset'] = {'projectId': project_id, 'datasetId': dataset_id}
 
-  # wait for query to complete
+  # wait for query to complete, getQueryResults holds the call until done or timeout
 
   response = API_BigQuery(config, auth).jobs().query(
       projectId=project_id, body=body).execute()
   while not response['jobComplete']:
-    sleep(5)
     response = API_BigQuery(config, auth).jobs().getQueryResults(
         projectId=project_id,
-        jobId=response['jobReference']['jobId']).execute(iterate=False)
+        jobId=response['jobReference']['jobId'],
+        timeoutMs=BIGQUERY_POLL_TIMEOUT).execute(iterate=False)
 
   # fetch query results
   schema = response.get('schema', {}).get('fields', None)
@@ -855,16 +1073,34 @@ def make_schema(header):
   } for name in row_header_sanitize(header)]
 
 
-def get_schema(rows, header=True, infer_type=True):
-  """CAUTION: Memory suck.
+def get_schema(rows, header=True, infer_type=True, sample=None, spill=False):
+  """Infer a BigQuery schema from rows, returns the rows with the schema.
+
+  By default every row is scanned and buffered in memory.  For large streamed
+  rows either pass spill=True, which scans every row buffering to a temporary
+  file, or opt in to sampling with sample=BIGQUERY_SCHEMA_SAMPLE.  When
+  sampling only the first sample rows are scanned and buffered, the returned
+  iterator replays that prefix chained with the remaining live rows, so
+  memory is bounded by sample.  Types appearing only after the sample are not
+  seen.
 
-  This function sabotages iteration by iterating thorough the new object and
-  returning a new iterator RECOMMEND: Define the schema yourself, it will
-  also ensure data integrity downstream.
+  RECOMMEND: Define the schema yourself, it will also ensure data integrity
+  downstream.
+
+  Args:
+    rows: (iterator) Lists of values, first row is the header if header.
+    header: (bool) True if first row contains column names.
+    infer_type: (bool) If False all columns are STRING.
+    sample: (int) Number of rows to scan, None ( default ) scans all.
+    spill: (bool) Scan all rows buffering to disk instead of memory.
+
+  Returns:
+    ( rows iterator, schema list )
   """
 
   schema = []
-  row_buffer = []
+  rows = iter(rows)
+  row_buffer = tempfile.TemporaryFile() if spill else []
 
   # everything else defaults to STRING
   type_to_bq = {
@@ -879,11 +1115,14 @@ def get_schema(rows, header=True, infer_type=True):
   first = True
   ct_columns = 0
 
-  for row in rows:
+  for count, row in enumerate(rows, 1):
 
     # buffer the iterator to be returned with schema
     row += [None] * (ct_columns - len(row))
-    row_buffer.append(row)
+    if spill:
+      pickle.dump(row, row_buffer)
+    else:
+      row_buffer.append(row)
 
     # define schema field names and set defaults ( if no header enumerate fields )
     if first:
@@ -922,7 +1161,24 @@ def get_schema(rows, header=True, infer_type=True):
     # no longer first row
     first = False
 
-  return row_buffer, schema
+    # stop at sample, the rest of the rows are passed through unscanned
+    if not spill and sample is not None and count >= sample:
+      break
+
+  def replay_spill():
+    row_buffer.seek(0)
+    try:
+      while True:
+        yield pickle.load(row_buffer)
+    except EOFError:
+      row_buffer.close()
+
+  def pad_rest():
+    for row in rows:
+      row += [None] * (ct_columns - len(row))
+      yield row
+
+  return chain(replay_spill() if spill else row_buffer, pad_rest()), schema
 
 
 def drop_table(config, auth, project_id, dataset_id, table_id, billing_project_id=None):
@@ -16,18 +16,26 @@
 #
 ###########################################################################
 
+import os
+import json
 import pprint
+import tempfile
+import threading
 from time import sleep
+from time import time
 from io import StringIO
 from types import GeneratorType
 from datetime import date, timedelta
 
 from starthinker.config import BUFFER_SCALE
+from starthinker.config import CM_PROFILE_PATH
+from starthinker.config import CM_PROFILE_TTL
 from starthinker.util import flag_last
+from starthinker.util.auth import get_principal
 from starthinker.util.data import get_rows
 from starthinker.util.google_api import API_DCM
 from starthinker.util.storage import media_download
-from starthinker.util.csv import column_header_sanitize, csv_to_rows
+from starthinker.util.csv import column_header_sanitize, csv_to_rows, chunks_to_rows
 from starthinker.util.cm_schema import DCM_Field_Lookup
 
 DCM_CHUNK_SIZE = int(
@@ -35,6 +43,87 @@ DCM_CHUNK_SIZE = int(
     BUFFER_SCALE)  # 200MB minimum recommended by docs * scale in config.py
 DCM_CONVERSION_SIZE = 1000
 
+DCM_PROFILES = {}
+DCM_PROFILES_LOCK = threading.Lock()
+
+
+def get_profiles_path(principal):
+  return os.path.join(CM_PROFILE_PATH, 'cm_profiles_%s.json' % principal)
+
+
+def get_profiles_read(principal):
+  """Load a profile index from CM_PROFILE_PATH, None if missing or expired."""
+
+  if CM_PROFILE_PATH:
+    try:
+      with open(get_profiles_path(principal), 'r') as index_file:
+        index = json.load(index_file)
+      if time() - index['loaded'] <= CM_PROFILE_TTL:
+        index['accounts'] = { int(a): p for a, p in index['accounts'].items() }
+        return index
+    except (IOError, ValueError, KeyError):
+      pass
+  return None
+
+
+def get_profiles_write(principal, index):
+  """Atomically save a profile index to CM_PROFILE_PATH if set."""
+
+  if CM_PROFILE_PATH:
+    try:
+      os.makedirs(CM_PROFILE_PATH, exist_ok=True)
+      handle, temp_path = tempfile.mkstemp(dir=CM_PROFILE_PATH)
+      with os.fdopen(handle, 'w') as index_file:
+        json.dump(index, index_file)
+      os.replace(temp_path, get_profiles_path(principal))
+    except (IOError, OSError) as e:
+      print('CM PROFILE CACHE WRITE FAILED:', str(e))
+
+
+def get_profiles(config, auth):
+  """Return an index of the DCM profiles for the currently supplied credentials.
+
+  The profile list is paged once per CM_PROFILE_TTL and shared by all threads,
+  then optionally by all processes if CM_PROFILE_PATH is set.  Concurrent
+  callers wait for the first load instead of each listing profiles.
+
+  Args:
+    * auth: (string) Either user or service.
+
+  Returns:
+    * { 'loaded':time, 'admin':superuser profile id or None, 'accounts':{ account id:profile id }}
+
+  """
+
+  principal = get_principal(config, auth)
+
+  with DCM_PROFILES_LOCK:
+    index = DCM_PROFILES.get(principal)
+
+    if index is None or time() - index['loaded'] > CM_PROFILE_TTL:
+      index = get_profiles_read(principal)
+
+      if index is None:
+        index = { 'loaded':time(), 'admin':None, 'accounts':{} }
+
+        for p in API_DCM(config, auth, iterate=True).userProfiles().list().execute():
+          p_id = int(p['profileId'])
+          a_id = int(p['accountId'])
+
+          # take the first profile for admin, it applies to every account
+          if a_id == 2515 and 'subAccountId' not in p:
+            index['admin'] = p_id
+            break
+
+          # take the first network profile for each account
+          index['accounts'].setdefault(a_id, p_id)
+
+        get_profiles_write(principal, index)
+
+      DCM_PROFILES[principal] = index
+
+    return index
+
 
 def get_profile_for_api(config, auth, account_id=None):
   """Return a DCM profile ID for the currently supplied credentials.
@@ -44,7 +133,7 @@ def get_profile_for_api(config, auth, account_id=None):
 
   Handles cases of superuser, otherwise chooses the first matched profile.
   Allows DCM jobs to only specify account ID, which makes jobs more portable
-  between accounts.
+  between accounts.  Profiles are listed once and memoized, see get_profiles.
 
   Args:
     * auth: (string) Either user or service.
@@ -59,29 +148,15 @@ def get_profile_for_api(config, auth, account_id=None):
 
   """
 
-  profile_admin = None
-  profile_network = None
-
   if account_id is not None:
     account_id=int(account_id)
 
-  for p in API_DCM(config, auth, iterate=True).userProfiles().list().execute():
-    p_id = int(p['profileId'])
-    a_id = int(p['accountId'])
+  index = get_profiles(config, auth)
 
-    # take the first profile for admin
-    if a_id == 2515 and 'subAccountId' not in p:
-      profile_admin = p_id
-      break
-
-    # try to find first network profile if exists
-    if profile_network is None and a_id == account_id:
-      profile_network = p_id
-
-  if profile_admin:
-    return True, profile_admin
-  elif profile_network:
-    return False, profile_network
+  if index['admin']:
+    return True, index['admin']
+  elif account_id in index['accounts']:
+    return False, index['accounts'][account_id]
   else:
     raise Exception('Add your user profile to DCM account %s.' % account_id)
 
@@ -565,23 +640,66 @@ def report_file(config, auth,
   elif file_json == True:
     return 'report_running.csv', None
   else:
-    filename = '%s_%s.csv' % (file_json['fileName'],
-                              file_json['dateRange']['endDate'].replace(
-                                  '-', ''))
-
-    # streaming
-    if chunksize:
-      return filename, media_download(
-          API_DCM(config, auth).files().get_media(
-              reportId=file_json['reportId'],
-              fileId=file_json['id']).execute(False), chunksize, 'utf-8')
-
-    # single object
-    else:
-      return filename, StringIO(
-          API_DCM(config, auth).files().get_media(
-              reportId=file_json['reportId'],
-              fileId=file_json['id']).execute().decode('utf-8'))
+    return report_file_download(config, auth, file_json, chunksize)
+
+
+def report_file_status(config, auth, account, report_id):
+  """ Returns the status of the most recent DCM file without waiting.
+
+  Same file selection as report_fetch, used to poll many reports in one loop.
+
+  Args:
+    * auth: (string) Either user or service.
+    * account: (string) [account:advertiser@profile] token.
+    * report_id: (int) ID of DCM report to check.
+
+  Returns:
+    * File JSON if the most recent file is ready.
+    * True if the most recent file is in progress.
+    * False if no file exists.
+
+  """
+
+  # loop all files recent to oldest, skipping cancelled or failed
+  for file_json in report_files(config, auth, account, report_id):
+    if file_json['status'] == 'PROCESSING':
+      return True
+    elif file_json['status'] == 'REPORT_AVAILABLE':
+      return file_json
+  return False
+
+
+def report_file_download(config, auth, file_json, chunksize=DCM_CHUNK_SIZE):
+  """ Downloads a ready DCM file given its JSON from report_fetch.
+
+  Args:
+    * auth: (string) Either user or service.
+    * file_json: (dict) File resource with status REPORT_AVAILABLE.
+    * chunksize: (int) number of bytes to download at a time, 0 for all.
+
+  Returns:
+    * (filename, iterator) if chunking is on.
+    * (filename, file) if chunking is off.
+
+  """
+
+  filename = '%s_%s.csv' % (file_json['fileName'],
+                            file_json['dateRange']['endDate'].replace(
+                                '-', ''))
+
+  # streaming
+  if chunksize:
+    return filename, media_download(
+        API_DCM(config, auth).files().get_media(
+            reportId=file_json['reportId'],
+            fileId=file_json['id']).execute(False), chunksize, 'utf-8')
+
+  # single object
+  else:
+    return filename, StringIO(
+        API_DCM(config, auth).files().get_media(
+            reportId=file_json['reportId'],
+            fileId=file_json['id']).execute().decode('utf-8'))
 
 
 def report_list(config, auth, account):
@@ -670,12 +788,7 @@ def report_to_rows(report):
 
   # if reading from stream
   if type(report) is GeneratorType:
-    leftovers = ''
-    for chunk in report:
-      data, extra = chunk.rsplit('\n', 1)
-      for row in csv_to_rows(leftovers + data):
-        yield row
-      leftovers = extra
+    yield from chunks_to_rows(report)
 
   # if reading from buffer
   else:
@@ -78,7 +78,9 @@ import textwrap
 from datetime import datetime
 from importlib import import_module
 
+from starthinker.util.auth import get_http_metrics
 from starthinker.util.debug import starthinker_trace_start
+from starthinker.util.sheets import sheets_flush
 
 class Configuration:
 
@@ -415,8 +417,17 @@ def execute(configuration, tasks, force=False, instance=None):
         import_module('starthinker.task.%s.run' % script),
         script
       )
-      python_callable(configuration, task)
+      try:
+        python_callable(configuration, task)
+      finally:
+        sheets_flush()
     else:
       print(
         'Schedule Skipping: add --force to ignore schedule'
       )
+
+  if configuration.verbose:
+    for host, metrics in sorted(get_http_metrics().items()):
+      print('HTTP %s: %d requests, %d connections, %.1f seconds' % (
+        host, metrics['requests'], metrics['connections'], metrics['seconds']
+      ))
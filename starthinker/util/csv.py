@@ -18,8 +18,10 @@
 
 import re
 import csv
+import codecs
 import ctypes
 from io import StringIO
+from itertools import chain
 
 from xlsx import Workbook
 
@@ -47,24 +49,29 @@ def find_utf8_split(data, offset=None):
   return offset
 
 
-def response_utf8_stream(response, chunksize):
-  leftovers = b''
+def decode_chunks(chunks, encoding='utf-8'):
+  """Decode a stream of byte chunks, characters may be split across chunks.
 
-  while True:
+  Args:
+    * chunks: (iterator) Bytes of any size.
+    * encoding: (string) Any python codec.
 
-    chunk = leftovers + response.read(chunksize)
+  Returns:
+    * Iterator of strings, never empty.
+  """
 
-    position = find_utf8_split(chunk)
-    if position < len(chunk):
-      leftovers = chunk[position:]
-      chunk = chunk[:position]
-    else:
-      leftftovers = b''
+  decoder = codecs.getincrementaldecoder(encoding)()
+  for chunk in chunks:
+    text = decoder.decode(chunk)
+    if text:
+      yield text
+  text = decoder.decode(b'', final=True)
+  if text:
+    yield text
 
-    if chunk:
-      yield chunk.decode('UTF-8')
-    else:
-      break
+
+def response_utf8_stream(response, chunksize):
+  return decode_chunks(iter(lambda: response.read(chunksize), b''), 'UTF-8')
 
 
 def bigquery_date(value):
@@ -105,6 +112,64 @@ def csv_to_rows(csv_string):
       yield row
 
 
+def chunks_to_lines(chunks):
+  """Split a stream of string chunks into lines without joining the chunks.
+
+  Each chunk is cut after its last line feed and its complete lines are read
+  in place, only the partial line left over is stitched onto the next chunk.
+  The per chunk line iterators are chained in C, so no python code runs per
+  line.  Line endings are kept so the csv reader can parse quoted newlines
+  that span lines and chunks.
+
+  Args:
+    * chunks: (iterator) Strings of any size, split anywhere.
+
+  Returns:
+    * Iterator of lines, each ending in a line break except possibly the last.
+  """
+
+  def chunks_to_buffers():
+    leftover = ''
+    for chunk in chunks:
+      cut = chunk.rfind('\n') + 1
+      if not cut:
+        leftover += chunk
+        continue
+
+      lines = StringIO(chunk, newline='')
+      lines.truncate(cut)
+
+      # re-split in case the leftover holds a \r the chunk completes as \r\n
+      if leftover:
+        yield StringIO(leftover + lines.readline(), newline='')
+
+      yield lines
+      leftover = chunk[cut:]
+
+    if leftover:
+      yield StringIO(leftover, newline='')
+
+  return chain.from_iterable(chunks_to_buffers())
+
+
+def chunks_to_rows(chunks, encoding=None):
+  """Parse a stream of CSV chunks with one csv reader, memory efficient.
+
+  Used for streamed report downloads, rows and quoted fields may span chunks.
+
+  Args:
+    * chunks: (iterator) Strings, or bytes if encoding is given.
+    * encoding: (string) Decode byte chunks using this codec.
+
+  Returns:
+    * Iterator of lists representing each row.
+  """
+
+  if encoding:
+    chunks = decode_chunks(chunks, encoding)
+  yield from csv_to_rows(chunks_to_lines(chunks))
+
+
 def rows_to_csv(rows):
   csv_string = StringIO()
   writer = csv.writer(
@@ -0,0 +1,214 @@
+###########################################################################
+#
+#  Copyright 2020 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+###########################################################################
+
+"""Persistent on disk cache for Google API Discovery Documents.
+
+Every recipe task runs in its own process, and every process used to fetch
+the same multi megabyte discovery documents before making a single call.
+This cache stores each document once per host, keyed by api and version,
+and is shared by get_service and Discovery_To_BigQuery.
+
+  * Documents older than DISCOVERY_CACHE_TTL seconds are refetched.
+  * Each entry carries a sha256 checksum, corrupt entries are refetched.
+  * If a refetch fails ( for example offline ), the stale entry is used.
+  * Writes are atomic so concurrent processes never read partial files.
+
+To pre populate the cache for all recipes see: starthinker/tool/discovery.py
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from time import time
+from urllib import request
+from urllib.error import URLError
+
+from starthinker.config import DISCOVERY_CACHE_PATH
+from starthinker.config import DISCOVERY_CACHE_TTL
+
+DISCOVERY_URIS = (
+  'https://%(api)s.googleapis.com/$discovery/rest?version=%(version)s&key=%(key)s',
+  'https://www.googleapis.com/discovery/v1/apis/%(api)s/%(version)s/rest?key=%(key)s',
+)
+
+DISCOVERY_DOCUMENTS = {}
+DISCOVERY_CHECKSUMS = {}
+DISCOVERY_LOCK = threading.Lock()
+
+
+def discovery_checksum(document:str) -> str:
+  return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def discovery_path(api:str, version:str) -> str:
+  return os.path.join(DISCOVERY_CACHE_PATH, '%s_%s.json' % (api, version))
+
+
+def discovery_fetch(api:str, version:str, key:str=None) -> str:
+  """Download a discovery document, trying each known discovery uri.
+
+  Args:
+    api: The API endpoint name, for example dfareporting.
+    version: The API endpoint version, for example v3.4.
+    key: Optional Google API Key.
+
+  Returns:
+    The discovery document as a string.
+
+  Raises:
+    URLError: If the document cannot be fetched from any uri.
+  """
+
+  error = None
+  for uri in DISCOVERY_URIS:
+    url = uri % { 'api':api, 'version':version, 'key':key or '' }
+    print('DISCOVERY FETCH:', url)
+    try:
+      return request.urlopen(url).read().decode('utf-8')
+    except URLError as e:
+      error = e
+  raise error
+
+
+def discovery_read(api:str, version:str) -> dict:
+  """Load a cache entry from disk, returns None if missing or corrupt."""
+
+  try:
+    with open(discovery_path(api, version), 'r') as cache_file:
+      entry = json.load(cache_file)
+    if entry['checksum'] == discovery_checksum(entry['document']):
+      return entry
+    print('DISCOVERY CACHE CHECKSUM MISMATCH:', api, version)
+  except (IOError, ValueError, KeyError):
+    pass
+  return None
+
+
+def discovery_write(api:str, version:str, document:str) -> dict:
+  """Atomically write a cache entry to disk, returns the entry."""
+
+  entry = {
+    'api':api,
+    'version':version,
+    'fetched':time(),
+    'checksum':discovery_checksum(document),
+    'document':document
+  }
+
+  try:
+    os.makedirs(DISCOVERY_CACHE_PATH, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=DISCOVERY_CACHE_PATH)
+    with os.fdopen(handle, 'w') as cache_file:
+      json.dump(entry, cache_file)
+    os.replace(temp_path, discovery_path(api, version))
+  except (IOError, OSError) as e:
+    print('DISCOVERY CACHE WRITE FAILED:', str(e))
+
+  return entry
+
+
+def discovery_document(api:str, version:str, key:str=None, refresh:bool=False) -> str:
+  """Return the discovery document for an API, using the cache when fresh.
+
+  Checks the process memory first, then disk, then the network.
+
+  Args:
+    api: The API endpoint name, for example dfareporting.
+    version: The API endpoint version, for example v3.4.
+    key: Optional Google API Key.
+    refresh: Force a network fetch even if the cache is fresh.
+
+  Returns:
+    The discovery document as a string.
+
+  Raises:
+    URLError: If the document is not cached and cannot be fetched.
+  """
+
+  cache_key = (api, version)
+
+  with DISCOVERY_LOCK:
+    if not refresh and cache_key in DISCOVERY_DOCUMENTS:
+      return DISCOVERY_DOCUMENTS[cache_key]
+
+    entry = None if refresh else discovery_read(api, version)
+
+    if entry is None or time() - entry['fetched'] > DISCOVERY_CACHE_TTL:
+      try:
+        entry = discovery_write(api, version, discovery_fetch(api, version, key))
+      except (URLError, IOError) as e:
+        if entry is None:
+          raise
+        print('DISCOVERY FETCH FAILED, USING STALE CACHE:', api, version, str(e))
+
+    DISCOVERY_DOCUMENTS[cache_key] = entry['document']
+    DISCOVERY_CHECKSUMS[cache_key] = entry['checksum']
+    return entry['document']
+
+
+def discovery_revision(api:str, version:str, key:str=None) -> str:
+  """Return the checksum of the cached discovery document for an API.
+
+  Used to key anything derived from a document, such as BigQuery schemas,
+  so derived values are rebuilt whenever the document is refreshed.
+
+  Args:
+    api: The API endpoint name, for example dfareporting.
+    version: The API endpoint version, for example v3.4.
+    key: Optional Google API Key.
+
+  Returns:
+    The sha256 checksum of the document.
+  """
+
+  discovery_document(api, version, key)
+  return DISCOVERY_CHECKSUMS[(api, version)]
+
+
+def discovery_preload() -> int:
+  """Load every fresh on disk cache entry into process memory.
+
+  Used by long lived processes that fork tasks, so each forked task starts
+  with the documents already parsed from disk.
+
+  Returns:
+    The number of documents loaded.
+  """
+
+  count = 0
+
+  try:
+    filenames = os.listdir(DISCOVERY_CACHE_PATH)
+  except OSError:
+    return count
+
+  for filename in filenames:
+    api, _, version = filename[:-5].partition('_')
+    if not filename.endswith('.json') or not version:
+      continue
+    entry = discovery_read(api, version)
+    if entry and time() - entry['fetched'] <= DISCOVERY_CACHE_TTL:
+      with DISCOVERY_LOCK:
+        DISCOVERY_DOCUMENTS[(api, version)] = entry['document']
+        DISCOVERY_CHECKSUMS[(api, version)] = entry['checksum']
+      count += 1
+
+  return count
@@ -34,26 +34,87 @@ For example:
     indent=2
   ))
 
+Resolved method and resource schemas are memoized in process and on disk
+under DISCOVERY_CACHE_PATH/schemas, keyed by api, version, name, iterate,
+and recursion depth.  Each disk file is tied to the checksum of the discovery
+document it was built from, so a refreshed document rebuilds its schemas.
+
+To pre build schemas for all recipes see: starthinker/tool/discovery.py
+
 """
 
+import os
 import json
 import re
+import tempfile
+import threading
 from copy import deepcopy
 from urllib import request
 from typing import Union
 
 from googleapiclient.schema import Schemas
 
+from starthinker.config import DISCOVERY_CACHE_PATH
+from starthinker.util.discovery_cache import discovery_document
+from starthinker.util.discovery_cache import discovery_revision
+
 DATETIME_RE = re.compile(r'\d{4}[-/]\d{2}[-/]\d{2}[ T]\d{2}:\d{2}:\d{2}\.?\d+Z')
 DESCRIPTION_LENGTH = 1024
 RECURSION_DEPTH = 2
 
+SCHEMA_CACHE_PATH = os.path.join(DISCOVERY_CACHE_PATH, 'schemas')
+SCHEMA_CACHE = {}
+SCHEMA_FILES = set()
+SCHEMA_LOCK = threading.Lock()
+
+
+def schema_path(api:str, version:str, revision:str) -> str:
+  return os.path.join(SCHEMA_CACHE_PATH, '%s_%s_%s.json' % (api, version, revision[:16]))
+
+
+def schema_key(name:str, iterate:bool, recursion_depth:int) -> str:
+  return '%s:%s:%d' % (name, 'iterate' if iterate else 'all', recursion_depth)
+
+
+def schema_read(api:str, version:str, revision:str) -> None:
+  """Load a disk schema file into SCHEMA_CACHE once per process, caller locks."""
+
+  if (api, version, revision) in SCHEMA_FILES:
+    return
+  SCHEMA_FILES.add((api, version, revision))
+
+  try:
+    with open(schema_path(api, version, revision), 'r') as cache_file:
+      for key, schema in json.load(cache_file).items():
+        SCHEMA_CACHE.setdefault((api, version, revision, key), schema)
+  except (IOError, ValueError):
+    pass
+
+
+def schema_write(api:str, version:str, revision:str) -> None:
+  """Atomically write every cached schema for a document to disk, caller locks."""
+
+  schemas = dict(
+    (key[3], schema) for key, schema in SCHEMA_CACHE.items()
+    if key[:3] == (api, version, revision)
+  )
+
+  try:
+    os.makedirs(SCHEMA_CACHE_PATH, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=SCHEMA_CACHE_PATH)
+    with os.fdopen(handle, 'w') as cache_file:
+      json.dump(schemas, cache_file)
+    os.replace(temp_path, schema_path(api, version, revision))
+  except (IOError, OSError) as e:
+    print('SCHEMA CACHE WRITE FAILED:', str(e))
+
 
 class Discovery_To_BigQuery():
   """Collection of Discovery to BigQuery operations on a given API version.
 
   Class is required to maintain a cache between method calls.  The constructor
-  sets up the API endpoint, all other calls translate data.
+  sets up the API endpoint, all other calls translate data.  The discovery
+  document is only parsed if a schema is not already cached.
   """
 
   def __init__(self, api_name:str, api_version:str, key:str=None, recursion_depth:int=RECURSION_DEPTH) -> None:
@@ -72,15 +133,52 @@ class Discovery_To_BigQuery():
       HttpError: If the wrong API values are specified.
     """
 
+    self.api_name = api_name
+    self.api_version = api_version
     self.key = key or ''
     self.recursion_depth = recursion_depth
-    api_url = 'https://%s.googleapis.com/$discovery/rest?version=%s&key=%s' % (
-      api_name,
-      api_version,
-      self.key
-    )
-    print('DISCOVERY FETCH:', api_url)
-    self.api_document = json.load(request.urlopen(api_url))
+    self.revision = discovery_revision(api_name, api_version, self.key)
+    self._api_document = None
+
+
+  @property
+  def api_document(self) -> dict:
+    """The parsed discovery document, loaded on first use."""
+
+    if self._api_document is None:
+      self._api_document = json.loads(discovery_document(self.api_name, self.api_version, self.key))
+    return self._api_document
+
+
+  def cached_schema(self, name:str, iterate:bool, build) -> list:
+    """Return a memoized schema, calling build only if not cached.
+
+    Checks process memory, then the disk file for this document revision.
+    Returns a copy so callers can safely modify the schema.
+
+    Args:
+      name: a unique name for the schema, prefixed by method or resource.
+      iterate: passed through to the cache key.
+      build: function returning the schema if it is not cached.
+
+    Returns:
+      A BigQuery schema object.
+    """
+
+    document = (self.api_name, self.api_version, self.revision)
+    key = document + (schema_key(name, iterate, self.recursion_depth),)
+
+    with SCHEMA_LOCK:
+      schema_read(*document)
+      schema = SCHEMA_CACHE.get(key)
+
+    if schema is None:
+      schema = build()
+      with SCHEMA_LOCK:
+        SCHEMA_CACHE[key] = schema
+        schema_write(*document)
+
+    return deepcopy(schema)
 
 
   @staticmethod
@@ -399,8 +497,11 @@ class Discovery_To_BigQuery():
       A dictionary representation of the resource.
     """
 
-    entry = self.api_document['schemas'][resource]['properties']
-    return self.to_schema(entry)
+    return self.cached_schema(
+      'resource.%s' % resource,
+      False,
+      lambda: self.to_schema(self.api_document['schemas'][resource]['properties'], {})
+    )
 
 
   def resource_struct(self, resource:str) -> str:
@@ -430,6 +531,24 @@ class Discovery_To_BigQuery():
       A dictionary representation of the resource.
     """
 
+    return self.cached_schema(
+      'method.%s' % method,
+      iterate,
+      lambda: self.method_schema_build(method, iterate)
+    )
+
+
+  def method_schema_build(self, method:str, iterate:bool=False) -> dict:
+    """Resolve BigQuery schema for a Discovery API function, not cached.
+
+    Args:
+      method: the dot notation name of the Google API function
+      iterate: if true, return only iterable schema
+
+    Returns:
+      A dictionary representation of the resource.
+    """
+
     endpoint, method = method.rsplit('.', 1)
     resource = self.api_document
 
@@ -439,7 +558,7 @@ class Discovery_To_BigQuery():
 
     # get schema
     properties = self.api_document['schemas'][resource]['properties']
-    schema = self.to_schema(properties)
+    schema = self.to_schema(properties, {})
 
     # List responses wrap their items in a paginated response object
     # Unroll it to return item schema instead of repsonse schema
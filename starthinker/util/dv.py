@@ -30,7 +30,7 @@ from urllib.request import urlopen
 from starthinker.config import BUFFER_SCALE
 from starthinker.util.data import get_rows
 from starthinker.util.storage import object_get_chunks
-from starthinker.util.csv import column_header_sanitize, csv_to_rows, rows_to_csv, response_utf8_stream
+from starthinker.util.csv import column_header_sanitize, csv_to_rows, chunks_to_rows, rows_to_csv, response_utf8_stream
 from starthinker.util.google_api import API_DV360
 from starthinker.util.google_api import API_DBM
 
@@ -356,12 +356,7 @@ def report_to_rows(report):
 
   # if reading from stream
   if type(report) is GeneratorType:
-    leftovers = ''
-    for chunk in report:
-      data, extra = chunk.rsplit('\n', 1)
-      for row in csv_to_rows(leftovers + data):
-        yield row
-      leftovers = extra
+    yield from chunks_to_rows(report)
 
   # if reading from buffer
   else:
@@ -18,12 +18,145 @@
 
 import re
 import json
+import threading
 
 from googleapiclient.errors import HttpError
+from starthinker.util.auth import get_principal
 from starthinker.util.google_api import API_DV360
 
 RE_URL = re.compile(r'^.*://')
 
+# targeting type to ( details field or alternatives, fields identifying a value )
+TARGETING_KEYS = {
+  'TARGETING_TYPE_CHANNEL': ('channelDetails', ('channelId',)),
+  'TARGETING_TYPE_APP_CATEGORY': ('appCategoryDetails', ('displayName',)),
+  'TARGETING_TYPE_APP': ('appDetails', ('displayName',)),
+  'TARGETING_TYPE_URL': ('urlDetails', ('url',)),
+  'TARGETING_TYPE_DAY_AND_TIME': ('dayAndTimeDetails', ('dayOfWeek', 'startHour', 'endHour', 'timeZoneResolution')),
+  'TARGETING_TYPE_AGE_RANGE': ('ageRangeDetails', ('ageRange',)),
+  'TARGETING_TYPE_REGIONAL_LOCATION_LIST': ('regionalLocationListDetails', ('regionalLocationListId',)),
+  'TARGETING_TYPE_PROXIMITY_LOCATION_LIST': ('proximityLocationListDetails', ('proximityLocationListId',)),
+  'TARGETING_TYPE_GENDER': ('genderDetails', ('gender',)),
+  'TARGETING_TYPE_VIDEO_PLAYER_SIZE': ('videoPlayerSizeDetails', ('videoPlayerSize',)),
+  'TARGETING_TYPE_USER_REWARDED_CONTENT': ('userRewardedContentDetails', ('userRewardedContent',)),
+  'TARGETING_TYPE_PARENTAL_STATUS': ('parentalStatusDetails', ('parentalStatus',)),
+  'TARGETING_TYPE_CONTENT_INSTREAM_POSITION': ('contentInstreamPositionDetails', ('contentInstreamPosition',)),
+  'TARGETING_TYPE_CONTENT_OUTSTREAM_POSITION': ('contentOutstreamPositionDetails', ('contentOutstreamPosition',)),
+  'TARGETING_TYPE_DEVICE_TYPE': ('deviceTypeDetails', ('deviceType',)),
+  'TARGETING_TYPE_BROWSER': ('browserDetails', ('displayName',)),
+  'TARGETING_TYPE_HOUSEHOLD_INCOME': ('householdIncomeDetails', ('householdIncome',)),
+  'TARGETING_TYPE_ON_SCREEN_POSITION': ('onScreenPositionDetails', ('onScreenPosition',)),
+  'TARGETING_TYPE_CARRIER_AND_ISP': ('carrierAndIspDetails', ('displayName', 'type')),
+  'TARGETING_TYPE_KEYWORD': ('keywordDetails', ('keyword',)),
+  'TARGETING_TYPE_NEGATIVE_KEYWORD_LIST': ('negativeKeywordListDetails', ('negativeKeywordListId',)),
+  'TARGETING_TYPE_OPERATING_SYSTEM': ('operatingSystemDetails', ('displayName',)),
+  'TARGETING_TYPE_DEVICE_MAKE_MODEL': ('deviceMakeModelDetails', ('displayName',)),
+  'TARGETING_TYPE_ENVIRONMENT': ('environmentDetails', ('environment',)),
+  'TARGETING_TYPE_INVENTORY_SOURCE': ('inventorySourceDetails', ('inventorySourceId',)),
+  'TARGETING_TYPE_INVENTORY_SOURCE_GROUP': ('inventorySourceGroupDetails', ('inventorySourceGroupId',)),
+  'TARGETING_TYPE_CATEGORY': ('categoryDetails', ('displayName',)), # fix add check for negative flag
+  'TARGETING_TYPE_VIEWABILITY': ('viewabilityDetails', ('viewability',)),
+  'TARGETING_TYPE_AUTHORIZED_SELLER_STATUS': ('authorizedSellerStatusDetails', ('authorizedSellerStatus',)),
+  'TARGETING_TYPE_LANGUAGE': ('languageDetails', ('displayName',)),
+  'TARGETING_TYPE_GEO_REGION': ('geoRegionDetails', ('displayName', 'geoRegionType')),
+  'TARGETING_TYPE_DIGITAL_CONTENT_LABEL_EXCLUSION': (('digitalContentLabelExclusionDetails', 'digitalContentLabelDetails'), ('contentRatingTier',)),
+  'TARGETING_TYPE_SENSITIVE_CATEGORY_EXCLUSION': (('sensitiveCategoryExclusionDetails', 'sensitiveCategoryDetails'), ('sensitiveCategory',)),
+  'TARGETING_TYPE_EXCHANGE': ('exchangeDetails', ('exchange',)),
+  'TARGETING_TYPE_SUB_EXCHANGE': ('subExchangeDetails', ('displayName',)),
+  'TARGETING_TYPE_AUDIENCE_GROUP': (None, ()), # single value on lookup
+}
+
+TARGETING_INDEX = {}
+TARGETING_INDEX_LOCK = threading.Lock()
+
+
+def targeting_key(option):
+  """Returns the lookup tuple for an option, the args a caller would pass."""
+
+  details, fields = TARGETING_KEYS.get(option['targetingType'], (None, ()))
+  for name in (details if isinstance(details, tuple) else (details,)):
+    if name in option:
+      return tuple(option[name].get(field) for field in fields)
+  return None
+
+
+def targeting_build(targeting_type, options):
+  """Hashes non inherited options by lookup tuple, first match wins."""
+
+  index = {
+    'type': targeting_type,
+    'arity': len(TARGETING_KEYS.get(targeting_type, (None, ()))[1]),
+    'options': options,
+    'first': None,
+    'lookup': {}
+  }
+
+  for option in options:
+    if option.get('inheritance', 'NOT_INHERITED') != 'NOT_INHERITED': continue
+    if index['first'] is None:
+      index['first'] = option
+    key = targeting_key(option)
+    if key is not None:
+      index['lookup'].setdefault(key, option)
+
+  return index
+
+
+def targeting_index(config, auth, layer, targeting_type, fetch):
+  """Process wide index of targeting options or assignments.
+
+  Options only change with DV360 releases and assignments only change when
+  edited, so the lists are fetched once per process instead of once for
+  every line item that references them.  Entries are keyed by credentials.
+
+  Args:
+    * config: (Configuration) Used to key the index by credentials.
+    * auth: (string) Either user or service.
+    * layer: (tuple) Owner of the list, for example ('options', advertiserId).
+    * targeting_type: (string) One of the DV360 targeting types.
+    * fetch: (function) Returns the list if not already indexed.
+
+  Returns:
+    Dictionary with the raw 'options' list and a hashed 'lookup'.
+  """
+
+  key = (get_principal(config, auth), layer, targeting_type)
+
+  with TARGETING_INDEX_LOCK:
+    index = TARGETING_INDEX.get(key)
+
+  if index is None:
+    index = targeting_build(targeting_type, list(fetch()))
+    with TARGETING_INDEX_LOCK:
+      index = TARGETING_INDEX.setdefault(key, index)
+
+  return index
+
+
+def targeting_invalidate(config, auth, partnerId=None, advertiserId=None, lineItemId=None):
+  """Drops indexed assignments for a layer after they are edited."""
+
+  principal = get_principal(config, auth)
+  layer = targeting_layer(partnerId, advertiserId, lineItemId)
+
+  with TARGETING_INDEX_LOCK:
+    for key in list(TARGETING_INDEX):
+      if key[0] == principal and key[1] == layer:
+        del TARGETING_INDEX[key]
+
+
+def targeting_layer(partnerId=None, advertiserId=None, lineItemId=None):
+  """Identifies the owner of assignments, same precedence as the API calls."""
+
+  if lineItemId:
+    return ('lineitem', str(advertiserId), str(lineItemId))
+  elif partnerId:
+    return ('partner', str(partnerId))
+  elif advertiserId:
+    return ('advertiser', str(advertiserId))
+  return None
+
+
 class Assigned_Targeting:
 
 
@@ -78,138 +211,14 @@ class Assigned_Targeting:
       self.warnings.append('Targeting Error: %s' % str(e))
 
 
-  def _get_id(self, options, key, *args):
-    for option in options:
-      if option.get('inheritance', 'NOT_INHERITED') != 'NOT_INHERITED': continue
-
-      if option['targetingType'] == 'TARGETING_TYPE_CHANNEL':
-        if option['channelDetails']['channelId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_APP_CATEGORY':
-        if option['appCategoryDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_APP':
-        if option['appDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_URL':
-        if option['urlDetails']['url'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_DAY_AND_TIME':
-        if (option['dayAndTimeDetails']['dayOfWeek'] == args[0]
-        and option['dayAndTimeDetails']['startHour'] == args[1]
-        and option['dayAndTimeDetails']['endHour'] == args[2]
-        and option['dayAndTimeDetails']['timeZoneResolution'] == args[3]):
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_AGE_RANGE':
-        if option['ageRangeDetails']['ageRange'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_REGIONAL_LOCATION_LIST':
-        if option['regionalLocationListDetails']['regionalLocationListId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_PROXIMITY_LOCATION_LIST':
-        if option['proximityLocationListDetails']['proximityLocationListId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_GENDER':
-        if option['genderDetails']['gender'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_VIDEO_PLAYER_SIZE':
-        if option['videoPlayerSizeDetails']['videoPlayerSize'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_USER_REWARDED_CONTENT':
-        if option['userRewardedContentDetails']['userRewardedContent'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_PARENTAL_STATUS':
-        if option['parentalStatusDetails']['parentalStatus'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_CONTENT_INSTREAM_POSITION':
-        if not args: # single value on lookup
-          return option[key]
-        elif option['contentInstreamPositionDetails']['contentInstreamPosition'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_CONTENT_OUTSTREAM_POSITION':
-        if not args: # single value on lookup
-          return option[key]
-        elif option['contentOutstreamPositionDetails']['contentOutstreamPosition'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_DEVICE_TYPE':
-        if option['deviceTypeDetails']['deviceType'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_BROWSER':
-        if option['browserDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_HOUSEHOLD_INCOME':
-        if option['householdIncomeDetails']['householdIncome'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_ON_SCREEN_POSITION':
-        if option['onScreenPositionDetails']['onScreenPosition'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_CARRIER_AND_ISP':
-        if option['carrierAndIspDetails']['displayName'] == args[0] and option['carrierAndIspDetails']['type'] == args[1]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_KEYWORD':
-        if option['keywordDetails']['keyword'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_NEGATIVE_KEYWORD_LIST':
-        if option['negativeKeywordListDetails']['negativeKeywordListId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_OPERATING_SYSTEM':
-        if option['operatingSystemDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_DEVICE_MAKE_MODEL':
-        if option['deviceMakeModelDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_ENVIRONMENT':
-        if option['environmentDetails']['environment'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_INVENTORY_SOURCE':
-        if option['inventorySourceDetails']['inventorySourceId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_CATEGORY': # fix add check for negative flag
-        if option['categoryDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_VIEWABILITY':
-        if not args: # single value on lookup
-          return option[key]
-        elif option['viewabilityDetails']['viewability'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_AUTHORIZED_SELLER_STATUS':
-        if not args: # single value on lookup
-          return option[key]
-        elif option['authorizedSellerStatusDetails']['authorizedSellerStatus'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_LANGUAGE':
-        if option['languageDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_GEO_REGION':
-        if (option['geoRegionDetails']['displayName'] == args[0]
-        and option['geoRegionDetails']['geoRegionType'] == args[1]):
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_INVENTORY_SOURCE':
-        if option['inventorySourceGroupDetails']['inventorySourceGroupId'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_DIGITAL_CONTENT_LABEL_EXCLUSION':
-        if 'digitalContentLabelExclusionDetails' in option:
-          if option['digitalContentLabelExclusionDetails']['contentRatingTier'] == args[0]:
-            return option[key]
-        else:
-          if option['digitalContentLabelDetails']['contentRatingTier'] == args[0]:
-            return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_SENSITIVE_CATEGORY_EXCLUSION':
-        if 'sensitiveCategoryExclusionDetails' in option and option['sensitiveCategoryExclusionDetails']['sensitiveCategory'] == args[0]:
-          return option[key]
-        elif 'sensitiveCategoryDetails' in option and option['sensitiveCategoryDetails']['sensitiveCategory'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_EXCHANGE':
-        if option['exchangeDetails'].get('exchange') == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_SUB_EXCHANGE':
-        if option['subExchangeDetails']['displayName'] == args[0]:
-          return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_AUDIENCE_GROUP':
-        return option[key]
-      elif option['targetingType'] == 'TARGETING_TYPE_THIRD_PARTY_VERIFIER':
-        raise NotImplementedError
-    return None
+  def _get_id(self, index, key, *args):
+    if index['type'] == 'TARGETING_TYPE_THIRD_PARTY_VERIFIER':
+      raise NotImplementedError
+    if not args or not index['arity']: # single value on lookup
+      option = index['first']
+    else:
+      option = index['lookup'].get(args[:index['arity']])
+    return option[key] if option else None
 
 
   def already_added(self, targeting_type, *args):
@@ -246,61 +255,80 @@ class Assigned_Targeting:
     return self.exists_cache[token]
 
 
-  def get_option_list(self, targeting_type):
+  def get_option_index(self, targeting_type):
     if targeting_type not in self.options_cache:
-      self.options_cache[targeting_type] = list(API_DV360(
+      self.options_cache[targeting_type] = targeting_index(
         self.config, self.auth,
-        iterate=True
-      ).targetingTypes().targetingOptions().list(
-        advertiserId=str(self.advertiser),
-        targetingType=targeting_type
-      ).execute())
+        ('options', str(self.advertiser)),
+        targeting_type,
+        lambda: API_DV360(
+          self.config, self.auth,
+          iterate=True
+        ).targetingTypes().targetingOptions().list(
+          advertiserId=str(self.advertiser),
+          targetingType=targeting_type
+        ).execute()
+      )
     return self.options_cache[targeting_type]
 
 
+  def get_option_list(self, targeting_type):
+    return self.get_option_index(targeting_type)['options']
+
+
   def get_option_id(self, targeting_type, *args):
     return self._get_id(
-      self.get_option_list(targeting_type),
+      self.get_option_index(targeting_type),
       'targetingOptionId',
       *args
     )
 
 
-  def get_assigned_list(self, targeting_type):
+  def get_assigned_index(self, targeting_type):
     if targeting_type not in self.assigneds_cache:
       if self.lineitem:
-        self.assigneds_cache[targeting_type] = list(API_DV360(
+        fetch = lambda: API_DV360(
           self.config, self.auth,
           iterate=True
         ).advertisers().lineItems().targetingTypes().assignedTargetingOptions().list(
           lineItemId=str(self.lineitem),
           advertiserId=str(self.advertiser),
           targetingType=targeting_type
-        ).execute())
+        ).execute()
       elif self.partner:
-        self.assigneds_cache[targeting_type] = list(API_DV360(
+        fetch = lambda: API_DV360(
           self.config, self.auth,
           iterate=True
         ).partners().targetingTypes().assignedTargetingOptions().list(
           partnerId=str(self.partner),
           targetingType=targeting_type
-        ).execute())
+        ).execute()
       elif self.advertiser:
-        self.assigneds_cache[targeting_type] = list(API_DV360(
+        fetch = lambda: API_DV360(
           self.config, self.auth,
           iterate=True
         ).advertisers().targetingTypes().assignedTargetingOptions().list(
           advertiserId=str(self.advertiser),
           targetingType=targeting_type
-        ).execute())
+        ).execute()
+      self.assigneds_cache[targeting_type] = targeting_index(
+        self.config, self.auth,
+        targeting_layer(self.partner, self.advertiser, self.lineitem),
+        targeting_type,
+        fetch
+      )
     return self.assigneds_cache[targeting_type]
 
 
+  def get_assigned_list(self, targeting_type):
+    return self.get_assigned_index(targeting_type)['options']
+
+
   def get_assigned_id(self, targeting_type, *args):
     if targeting_type == 'TARGETING_TYPE_AUDIENCE_GROUP': return 'audienceGroup'
     else:
       return self._get_id(
-        self.get_assigned_list(targeting_type),
+        self.get_assigned_index(targeting_type),
         'assignedTargetingOptionId',
         *args
       )
@@ -1049,21 +1077,26 @@ class Assigned_Targeting:
     body = self.get_body()
     if body:
       if self.lineitem:
-        return API_DV360(
+        response = API_DV360(
           self.config, self.auth,
         ).advertisers().lineItems().bulkEditLineItemAssignedTargetingOptions(
           lineItemId=str(self.lineitem),
           advertiserId=str(self.advertiser),
+          body=body
         ).execute()
       elif self.partner:
-        return API_DV360(
+        response = API_DV360(
           self.config, self.auth
         ).partners().bulkEditPartnerAssignedTargetingOptions(
           partnerId=str(self.partner),
+          body=body
         ).execute()
       elif self.advertiser:
-        return API_DV360(
+        response = API_DV360(
           self.config, self.auth,
         ).advertisers().bulkEditAdvertiserAssignedTargetingOptions(
           advertiserId=str(self.advertiser),
+          body=body
         ).execute()
+      targeting_invalidate(self.config, self.auth, self.partner, self.advertiser, self.lineitem)
+      return response
@@ -20,10 +20,19 @@
 
 import datetime
 import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 from starthinker.util.csv import column_header_sanitize, csv_to_rows, rows_to_csv, response_utf8_stream
 from starthinker.util.google_api import API_AnalyticsReporting
 
+GA_WORKERS = 5 # API allows 10 concurrent requests per view, leave room for others
+GA_SHARD_DAYS = 7
+GA_DATE_DIMENSIONS = ('ga:date', 'ga:dateHour', 'ga:dateHourMinute')
+GA_DATE_RANGE_DEFAULT = {'startDate':'7daysAgo', 'endDate':'yesterday'}
+GA_TYPES = {'INTEGER':'INTEGER'} # CURRENCY, PERCENT, TIME, and FLOAT are all FLOAT
+
 
 class GA_Report():
   """ Implement report donwload functionality for Google Analytics.
@@ -34,43 +43,25 @@ class GA_Report():
   TODO: Add support for pivot and histogram.
 
   Handles all serialization, and pagination, providing both rows and schema.
+
+  Each reportRequest is fetched as its own shard, requests with a single date
+  range and a daily date dimension are further split into shards of shard_days.
+  Shards are paginated and fetched concurrently, rows are returned in request
+  and date order.
   """
 
-  def __init__(self, config, auth:str, reportRequests:list, useResourceQuotas:bool) -> None:
+  def __init__(self, config, auth:str, reportRequests:list, useResourceQuotas:bool, workers:int=GA_WORKERS, shard_days:int=GA_SHARD_DAYS) -> None:
     self.config = config
     self.auth = auth
     self.body = {
       "reportRequests":reportRequests,
       "useResourceQuotas":useResourceQuotas
     }
+    self.workers = workers
+    self.shard_days = shard_days
     self.schema = None
 
 
-  def get_reports(self) -> typing.Iterator[dict]:
-    response = API_AnalyticsReporting(self.config, self.auth).reports().batchGet(body=self.body).execute()
-
-    while response:
-      next_body = {
-        "reportRequests":[],
-        "useResourceQuotas":self.body["useResourceQuotas"]
-      }
-
-      for index, report in enumerate(response.get('reports', [])):
-        if self.schema is None:
-          self.set_schema(report.get('columnHeader', {}))
-
-        yield report
-
-        if 'nextPageToken' in report:
-          next_body["reportRequests"].append(body["reportRequests"][index])
-
-      if next_body["reportRequests"]:
-        self.body = next_body
-        respone = API_AnalyticsReporting(self.config, self.auth).reports().batchGet(body=self.body).execute()
-      else:
-        response = None
-
-
   def get_date(self, date_string:str) -> datetime.date:
     if date_string == 'today':
       return datetime.date.today()
@@ -82,22 +73,134 @@ class GA_Report():
       return datetime.datetime.strptime(date_string, '%Y-%m-%d').date()
 
 
-  def get_dates(self) -> list:
-    report_dates = []
+  def get_shards(self) -> typing.Iterator[dict]:
+    """Split every reportRequest into independently fetchable shards.
 
-    for report in self.body['reportRequests']:
-      dates = []
-      for date_range in report['dateRanges']:
-        date_start = self.get_date(date_range['startDate'])
-        date_end = self.get_date(date_range['endDate'])
+    Relative dates are resolved once so all shards see the same days.  Only
+    requests with a single date range and a daily date dimension are split
+    by days, splitting any other request would change its aggregation.
 
+    Returns:
+      Iterator of { "request":ReportRequest, "days":[date per dateRange] }.
+    """
+
+    for request in self.body['reportRequests']:
+      date_ranges = [(
+        self.get_date(date_range['startDate']),
+        self.get_date(date_range['endDate'])
+      ) for date_range in request.get('dateRanges') or [GA_DATE_RANGE_DEFAULT]]
+
+      # rows are labeled with the start of the original date range, even when sharded
+      days = [str(date_start) for date_start, date_end in date_ranges]
+
+      daily = any(
+        dimension.get('name') in GA_DATE_DIMENSIONS
+        for dimension in request.get('dimensions', [])
+      )
+
+      if len(date_ranges) == 1 and daily and 'pageToken' not in request:
+        date_start, date_end = date_ranges[0]
         while date_start <= date_end:
-          dates.append(date_start)
-          date_start += datetime.timedelta(days=1)
+          shard_end = min(date_end, date_start + datetime.timedelta(days=self.shard_days - 1))
+          yield {
+            'request':dict(request, dateRanges=[{
+              'startDate':str(date_start),
+              'endDate':str(shard_end)
+            }]),
+            'days':days
+          }
+          date_start = shard_end + datetime.timedelta(days=1)
+
+      else:
+        yield {
+          'request':dict(request, dateRanges=[{
+            'startDate':str(date_start),
+            'endDate':str(date_end)
+          } for date_start, date_end in date_ranges]),
+          'days':days
+        }
+
+
+  def get_shard(self, shard:dict) -> tuple:
+    """Fetch all pages of one shard and convert them to rows.
+
+    Called from worker threads, each call builds its own API service.
+
+    Returns:
+      Tuple of ( columnHeader, [rows] ).
+    """
 
-      report_dates.append(dates)
+    request = shard['request']
+    columnHeader = None
+    rows = []
 
-    return report_dates
+    while request:
+      response = API_AnalyticsReporting(self.config, self.auth).reports().batchGet(body={
+        "reportRequests":[request],
+        "useResourceQuotas":self.body["useResourceQuotas"]
+      }).execute()
+
+      report = response.get('reports', [{}])[0]
+      columnHeader = report.get("columnHeader", {})
+      rows.extend(self.get_report_rows(report, shard['days']))
+
+      if 'nextPageToken' in report:
+        request = dict(request, pageToken=report['nextPageToken'])
+      else:
+        request = None
+
+    return columnHeader, rows
+
+
+  def get_report_rows(self, report:dict, days:list) -> typing.Iterator[dict]:
+    columnHeader = report.get("columnHeader", {})
+    dimensionHeaders = [h.replace('ga:', '') for h in columnHeader.get("dimensions", [])]
+    metricHeaders = [h['name'].replace('ga:', '') for h in columnHeader.get("metricHeader", {}).get("metricHeaderEntries", [])]
+
+    for row in report.get("data", {}).get("rows", []):
+      dimensions = row.get("dimensions", [])
+      dateRangeValues = row.get("metrics", [])
+      row_dimensions = dict(zip(dimensionHeaders, dimensions))
+
+      for i, values in enumerate(dateRangeValues):
+        yield {
+          'Report_Day':days[i],
+          'Dimensions':row_dimensions,
+          'Metrics':dict(zip(metricHeaders, values.get("values")))
+        }
+
+
+  def get_reports(self) -> typing.Iterator[list]:
+    """Fetch shards concurrently, yielding each shard's rows in order.
+
+    At most twice the workers shards are held in memory at once.
+    """
+
+    shards = self.get_shards()
+    pending = deque()
+
+    executor = ThreadPoolExecutor(max_workers=self.workers)
+    try:
+      for shard in shards:
+        pending.append(executor.submit(self.get_shard, shard))
+        if len(pending) >= self.workers * 2:
+          break
+
+      while pending:
+        columnHeader, rows = pending.popleft().result()
+        for shard in shards:
+          pending.append(executor.submit(self.get_shard, shard))
+          break
+
+        if self.schema is None:
+          self.set_schema(columnHeader)
+
+        yield rows
+
+    finally:
+      for future in pending:
+        future.cancel()
+      executor.shutdown(wait=False)
 
 
   def set_schema(self, columnHeader:dict) -> None:
@@ -109,11 +212,15 @@ class GA_Report():
 
     metrics = [{
       'name':m['name'].replace('ga:', ''),
-      'type':m['type'],
+      'type':GA_TYPES.get(m['type'], 'FLOAT'),
       'mode':'NULLABLE',
     } for m in columnHeader.get("metricHeader", {}).get("metricHeaderEntries", [])]
 
-    self.schema = []
+    self.schema = [{
+      "name": "Report_Day",
+      "type": "DATE",
+      "mode": "REQUIRED"
+    }]
     if dimensions:
       self.schema.append({
         "name": "Dimensions",
@@ -135,22 +242,11 @@ class GA_Report():
 
 
   def get_rows(self) -> typing.Iterator[dict]:
+    """Start fetching and return a row iterator.
 
-    for index, report in enumerate(self.get_reports()):
-      columnHeader = report.get("columnHeader", {})
-      dimensionHeaders = [h.replace('ga:', '') for h in columnHeader.get("dimensions", [])]
-      metricHeaders = [h['name'].replace('ga:', '') for h in columnHeader.get("metricHeader", {}).get("metricHeaderEntries", [])]
-      rows = report.get("data", {}).get("rows", [])
-      dates = self.get_dates()
-
-      for row in rows:
-        dimensions = row.get("dimensions", [])
-        dateRangeValues = row.get("metrics", [])
-        row_dimensions = dict(zip(dimensionHeaders, dimensions))
+    Waits for the first shard so get_schema is available on return.
+    """
 
-        for i, values in enumerate(dateRangeValues):
-          yield {
-            'Report_Day':str(dates[index][i]),
-            'Dimensions':row_dimensions,
-            'Metrics':dict(zip(metricHeaders, values.get("values")))
-          }
+    reports = self.get_reports()
+    first = next(reports, [])
+    return chain(first, chain.from_iterable(reports))
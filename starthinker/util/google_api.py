@@ -31,6 +31,9 @@ This does not change or augment the standard API calls other than the following:
 
 import base64
 import json
+import queue
+import random
+import threading
 import traceback
 import httplib2
 from datetime import date
@@ -46,6 +49,7 @@ except:
   import http.client as httplib
 
 from starthinker.util.auth import get_service
+from starthinker.util.rate_limit import get_rate_limiter
 
 RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, httplib.NotConnected,
                         httplib.IncompleteRead, httplib.ImproperConnectionState,
@@ -54,8 +58,42 @@ RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError, httplib.NotConnected,
 
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
 
+# calls per batch HTTP request, 100 is the common Google API limit
+API_BATCH_SIZE = 100
+API_BATCH_SIZES = {
+  'gmail': 50,
+}
 
-def API_Retry(job, key=None, retries=3, wait=31):
+
+def API_Retry_Wait(error, wait, limiter=None):
+  """Sleep before a retry, driven by the Retry-After header when given.
+
+  Adds up to 25% random jitter so workers throttled at the same time do not
+  retry in lockstep.  On 403 / 429 the limiter bucket is paused for the same
+  time so every thread sharing the quota backs off, not just this one.
+
+  Args:
+    * error: (Exception) The error being retried.
+    * wait: (seconds) Back off to use if no Retry-After header.
+    * limiter: (Rate_Limiter) Optional bucket the call was made through.
+  """
+
+  delay = wait
+  if isinstance(error, HttpError):
+    try:
+      delay = float(error.resp.get('retry-after'))
+    except (TypeError, ValueError, AttributeError):
+      pass
+
+  delay += random.uniform(0, delay / 4)
+
+  if limiter and isinstance(error, HttpError) and error.resp.status in (403, 429):
+    limiter.pause(delay)
+
+  sleep(delay)
+
+
+def API_Retry(job, key=None, retries=3, wait=31, limiter=None, tokens=1):
   """ API retry that includes back off and some common error handling.
 
   CAUTION:  Total timeout cannot exceed 5 minutes or the SSL token expires for
@@ -71,11 +109,15 @@ def API_Retry(job, key=None, retries=3, wait=31):
   returns None )
   * Errors raised: ALL OTHERS
 
+  Waits honor the Retry-After header and are jittered, see API_Retry_Wait.
+
   Args:
     * job: (object) Everything before the execute() statement.
     * key: (string) key of value from data to return.
     * retries: (int) Number of times to try the job.
     * wait: (seconds) Time to wait in seconds between retries.
+    * limiter: (Rate_Limiter) Optional, acquired before every attempt.
+    * tokens: (int) Number of calls the job counts as, for batches.
 
   Returns:
     * JSON result of job or key value from JSON result if job succeed.
@@ -87,7 +129,9 @@ def API_Retry(job, key=None, retries=3, wait=31):
   """
 
   try:
-    # try to run the job and return the response
+    # wait for quota then try to run the job and return the response
+    if limiter:
+      limiter.acquire(tokens)
     data = job.execute()
     return data if not key else data.get(key, [])
 
@@ -106,8 +150,8 @@ def API_Retry(job, key=None, retries=3, wait=31):
       elif retries > 0:
         print('API ERROR:', str(e))
         print('API RETRY / WAIT:', retries, wait)
-        sleep(wait)
-        return API_Retry(job, key, retries - 1, wait * 2)
+        API_Retry_Wait(e, wait, limiter)
+        return API_Retry(job, key, retries - 1, wait * 2, limiter, tokens)
       # if no retries, raise
       else:
         print('ERROR DETAILS:', e.content.decode())
@@ -121,8 +165,8 @@ def API_Retry(job, key=None, retries=3, wait=31):
     if retries > 0:
       print('HTTP ERROR:', str(e))
       print('HTTP RETRY / WAIT:', retries, wait)
-      sleep(wait)
-      return API_Retry(job, key, retries - 1, wait * 2)
+      API_Retry_Wait(e, wait, limiter)
+      return API_Retry(job, key, retries - 1, wait * 2, limiter, tokens)
     else:
       raise
 
@@ -133,13 +177,103 @@ def API_Retry(job, key=None, retries=3, wait=31):
     if retries > 0 and 'timed out' in e.message:
       print('SSL ERROR:', str(e))
       print('SSL RETRY / WAIT:', retries, wait)
-      sleep(wait)
-      return API_Retry(job, key, retries - 1, wait * 2)
+      API_Retry_Wait(e, wait, limiter)
+      return API_Retry(job, key, retries - 1, wait * 2, limiter, tokens)
     else:
       raise
 
 
-def API_Iterator(function, kwargs, results=None, limit=None):
+def API_Retriable(e):
+  """Classify an exception the same way API_Retry does.
+
+  Used where calls are not executed through API_Retry, such as batches.
+
+  Args:
+    * e: (Exception) Raised by an API call.
+
+  Returns:
+    * 'ignore' if object already exists ( 409 ).
+    * 'retry' if the error can be overcome by waiting.
+    * 'raise' for all others.
+  """
+
+  if isinstance(e, HttpError):
+    if e.resp.status in [403, 409, 429, 500, 503]:
+      try:
+        content = json.loads(e.content.decode())
+      except ValueError:
+        content = {}
+      if content.get('error', {}).get('code') == 409 or e.resp.status == 409:
+        return 'ignore'
+      elif content.get('error', {}).get('status') == 'PERMISSION_DENIED' or content.get('error', {}).get('errors', [{}])[0].get('reason') == 'forbidden':
+        return 'raise'
+      else:
+        return 'retry'
+    else:
+      return 'raise'
+  elif isinstance(e, RETRIABLE_EXCEPTIONS):
+    return 'retry'
+  elif isinstance(e, SSLError) and 'timed out' in str(e):
+    return 'retry'
+  else:
+    return 'raise'
+
+
+def API_Prefetch(function, kwargs, results, pages, stop, limiter=None):
+  """Fetch pages ahead of the consumer, runs in a background thread.
+
+  Each page is put on the pages queue, which is bounded so at most prefetch
+  pages are held.  A final None signals the end, an exception is passed
+  through the queue so the consumer raises it.  BaseException is caught too,
+  credentials load in this thread and may sys.exit, the consumer must never
+  wait on a queue that will not receive an end.  Does not reference the
+  iterator, so an abandoned iterator can be collected and set stop.
+
+  Args:
+    function: (callable) Returns the API function, called in this thread so it
+      gets its own service and connection from get_service.
+    kwargs: (dict) Arguments of the first page call, copied before paging.
+    results: (dict) The first page, already fetched.
+    pages: (queue.Queue) Bounded queue receiving pages.
+    stop: (threading.Event) Set by the consumer to end prefetching.
+    limiter: (Rate_Limiter) Optional, passed to API_Retry.
+  """
+
+  def put(page):
+    while not stop.is_set():
+      try:
+        pages.put(page, timeout=1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    function = function()
+    kwargs = dict(kwargs)
+    if 'body' in kwargs:
+      kwargs['body'] = dict(kwargs['body'])
+
+    page_token = (results or {}).get('nextPageToken', None)
+    while page_token and not stop.is_set():
+
+      if 'body' in kwargs:
+        kwargs['body']['pageToken'] = page_token
+      else:
+        kwargs['pageToken'] = page_token
+
+      results = API_Retry(function(**kwargs), limiter=limiter)
+      if not put(results):
+        return
+      page_token = results.get('nextPageToken', None)
+
+    put(None)
+
+  except BaseException as e:
+    put(e)
+
+
+def API_Iterator(function, kwargs, results=None, limit=None, prefetch=0, builder=None, limiter=None):
   """ See below API_Iterator_Instance for documentaion, this is just an iter wrapper.
 
       Returns:
@@ -177,21 +311,53 @@ def API_Iterator(function, kwargs, results=None, limit=None):
        kwargs: (dict) arguments to pass to fucntion when making call.
        results: (object) optional / used recursively, prior call results to continue.
        limit: (int) maximum number of records to return
+       prefetch: (int) pages to fetch ahead in a background thread, 0 disables.
+       builder: (function) returns function, required by prefetch so the
+         background thread resolves its own service ( not thread safe ).
+       limiter: (Rate_Limiter) optional, every page fetch is rate limited.
 
     Returns:
       Iterator over JSON objects.
     """
 
-    def __init__(self, function, kwargs, results=None, limit=None):
+    def __init__(self, function, kwargs, results=None, limit=None, prefetch=0, builder=None, limiter=None):
       self.function = function
+      self.limiter = limiter
       self.kwargs = kwargs
       self.limit = limit
       self.results = results
       self.position = 0
       self.count = 0
       self.iterable = None
+      self.prefetch = prefetch if builder else 0
+      self.builder = builder
+      self.pages = None
+      self.stop = None
       self.__find_tag__()
 
+    def __del__(self):
+      if self.stop:
+        self.stop.set()
+
+    def __prefetch_start__(self):
+      self.pages = queue.Queue(maxsize=self.prefetch)
+      self.stop = threading.Event()
+      threading.Thread(
+        target=API_Prefetch,
+        args=(self.builder, self.kwargs, self.results, self.pages, self.stop, self.limiter),
+        daemon=True
+      ).start()
+
+    def __prefetch_next__(self):
+      page = self.pages.get()
+      if isinstance(page, BaseException):
+        self.stop.set()
+        raise page
+      elif page is None:
+        self.stop.set()
+        raise StopIteration
+      return page
+
     def __find_tag__(self):
       # find the only list item for a paginated response, JOSN will only have list type, so ok to be specific
       if self.results:  # None and {} both excluded
@@ -215,20 +381,28 @@ def API_Iterator(function, kwargs, results=None, limit=None):
 
       # if no initial results, get some, empty results {} different
       if self.results is None:
-        self.results = API_Retry(self.function(**self.kwargs))
+        self.results = API_Retry(self.function(**self.kwargs), limiter=self.limiter)
         self.__find_tag__()
 
+      # start fetching following pages in the background
+      if self.prefetch and self.pages is None:
+        self.__prefetch_start__()
+
       # if empty results or exhausted page, get next page
       if self.iterable and self.position >= len(self.results[self.iterable]):
         page_token = self.results.get('nextPageToken', None)
-        if page_token:
+        if page_token and self.prefetch:
+          self.results = self.__prefetch_next__()
+          self.position = 0
+
+        elif page_token:
 
           if 'body' in self.kwargs:
             self.kwargs['body']['pageToken'] = page_token
           else:
             self.kwargs['pageToken'] = page_token
 
-          self.results = API_Retry(self.function(**self.kwargs))
+          self.results = API_Retry(self.function(**self.kwargs), limiter=self.limiter)
           self.position = 0
 
         else:
@@ -243,6 +417,8 @@ def API_Iterator(function, kwargs, results=None, limit=None):
         if self.limit is not None:
           self.count += 1
           if self.count > self.limit:
+            if self.stop:
+              self.stop.set()
             raise StopIteration
 
         # otherwise return next value
@@ -252,7 +428,7 @@ def API_Iterator(function, kwargs, results=None, limit=None):
       else:
         raise StopIteration
 
-  return iter(API_Iterator_Instance(function, kwargs, results, limit))
+  return iter(API_Iterator_Instance(function, kwargs, results, limit, prefetch, builder, limiter))
 
 
 class API():
@@ -277,6 +453,12 @@ class API():
     api = API(config, api).placements().list(profile_id=1234,
     archived=False).execute()
 
+    Optionally "prefetch":2 fetches up to 2 pages ahead in a background thread
+    while the current page is consumed, only applies when iterating.
+
+    Optionally "qps":10 limits calls to this API with these credentials to 10
+    per second across all threads, see util/rate_limit.py.
+
     Args:
       config: (json) see example above, configures all authentication parameters
       api: (json) see example above, configures all API parameters
@@ -301,6 +483,8 @@ class API():
     self.iterate = api.get('iterate', False)
     self.limit = api.get('limit', None)
     self.headers = api.get('headers', {})
+    self.prefetch = api.get('prefetch', 0) or 0
+    self.qps = api.get('qps', None)
 
     self.function = None
     self.job = None
@@ -361,10 +545,9 @@ class API():
       self.function_stack.append(function_name)
     return self
 
-  # matches API execute with built in iteration and retry handlers
-  def execute(self, run=True, iterate=False, limit=None):
-    # start building call sequence with service object
-    self.function = get_service(
+  # service object of the calling thread, see get_service
+  def __service__(self):
+    return get_service(
         config=self.config,
         api=self.api,
         version=self.version,
@@ -373,23 +556,47 @@ class API():
         key=self.key,
         uri_file=self.uri)
 
+  # resolves the function stack against the service of the calling thread
+  def __function__(self):
+    # start building call sequence with service object
+    function = self.__service__()
+
     # build calls along stack
     # do not call functions, as the abstract is necessary for iterator page next calls
     for f_n in self.function_stack:
-      #print(type(self.function), isinstance(self.function, Resource))
-      self.function = getattr(
-          self.function
-          if isinstance(self.function, Resource) else self.function(), f_n)
+      #print(type(function), isinstance(function, Resource))
+      function = getattr(
+          function
+          if isinstance(function, Resource) else function(), f_n)
+
+    return function
+
+  # shared rate limiter for this api and credentials, None if no limit
+  def __limiter__(self):
+    return get_rate_limiter(self.config, self.api, self.auth, self.qps)
+
+  # matches API execute with built in iteration and retry handlers
+  def execute(self, run=True, iterate=False, limit=None):
+    self.function = self.__function__()
 
     # for cases where job is handled manually, save the job
     self.job = self.function(**self.function_kwargs)
 
     if run:
-      self.response = API_Retry(self.job)
+      limiter = self.__limiter__()
+      self.response = API_Retry(self.job, limiter=limiter)
 
       # if expect to iterate through records
       if iterate or self.iterate:
-        return API_Iterator(self.function, self.function_kwargs, self.response, limit or self.limit)
+        return API_Iterator(
+          self.function,
+          self.function_kwargs,
+          self.response,
+          limit or self.limit,
+          self.prefetch,
+          self.__function__,
+          limiter
+        )
 
       # if basic response, return object as is
       else:
@@ -399,6 +606,108 @@ class API():
     else:
       return self.job
 
+  def execute_many(self, kwargs_list, callback=None, retries=3, wait=31):
+    """Execute the same function for many kwargs using batch HTTP requests.
+
+    Groups up to API_BATCH_SIZES[api] calls into a single HTTP request.  Each
+    call is evaluated individually, calls failing with a retriable error ( see
+    API_Retriable ) are retried as a smaller batch with the same back off as
+    API_Retry.  Calls that succeed are never resent.
+
+    For example, patch many line items in one round trip:
+
+      API_DV360(config, 'user').advertisers().lineItems().patch().execute_many([
+        { 'advertiserId':1, 'lineItemId':2, 'updateMask':'displayName', 'body':{...}},
+        { 'advertiserId':1, 'lineItemId':3, 'updateMask':'displayName', 'body':{...}},
+      ], callback=lambda kwargs, response, error: print(response or error))
+
+    Args:
+      * kwargs_list: (iterator) Arguments for each call.
+      * callback: (function) Called as callback(kwargs, response, error) for
+        each call, error is None on success.  Response is None if ignored.
+      * retries: (int) Number of times to retry failed calls.
+      * wait: (seconds) Time to wait before first retry, doubled each retry.
+
+    Returns:
+      * If no callback, list of responses in kwargs_list order.
+      * If callback, None.
+
+    Raises:
+      * If no callback, first error that cannot be retried.
+    """
+
+    service = self.__service__()
+    self.function = self.__function__()
+    limiter = self.__limiter__()
+    size = API_BATCH_SIZES.get(self.api, API_BATCH_SIZE)
+    responses = []
+
+    # one batch HTTP request, returns { index:( response, error ) }
+    def batch_execute(calls):
+      results = {}
+
+      def batch_callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+      batch = service.new_batch_http_request(callback=batch_callback)
+      for index, kwargs in calls.items():
+        batch.add(self.function(**API.__clean__(kwargs)), request_id=str(index))
+      API_Retry(batch, retries=retries, wait=wait, limiter=limiter, tokens=len(calls))
+      return results
+
+    # execute { index:kwargs } as one batch, resending only failed calls
+    def batch_run(calls):
+      calls_retries = retries
+      calls_wait = wait
+
+      while calls:
+        retry = {}
+        retry_error = None
+
+        # if the batch itself fails after API_Retry, every call in it failed
+        try:
+          results = batch_execute(calls)
+        except Exception as e:
+          if not callback:
+            raise
+          results = { index:(None, e) for index in calls }
+          calls_retries = 0
+
+        for index, (response, error) in sorted(results.items()):
+          action = API_Retriable(error) if error else None
+          if action == 'retry' and calls_retries > 0:
+            retry[index] = calls[index]
+            retry_error = error
+            continue
+          elif action == 'ignore':
+            error = None
+
+          if callback:
+            callback(calls[index], response, error)
+          elif error:
+            raise error
+          else:
+            responses.append((index, response))
+
+        if retry:
+          print('API BATCH RETRY / WAIT:', len(retry), calls_retries, calls_wait)
+          API_Retry_Wait(retry_error, calls_wait, limiter)
+          calls_retries -= 1
+          calls_wait *= 2
+
+        calls = retry
+
+    calls = {}
+    for index, kwargs in enumerate(kwargs_list):
+      calls[index] = kwargs
+      if len(calls) == size:
+        batch_run(calls)
+        calls = {}
+    batch_run(calls)
+
+    if not callback:
+      return [response for index, response in sorted(responses, key=lambda r: r[0])]
+
   def upload(self, retries=5, wait=61):
     job = self.execute(run=False)
     response = None
@@ -435,7 +744,7 @@ class API():
         time.sleep(wait)
 
 
-def API_BigQuery(config, auth, iterate=False):
+def API_BigQuery(config, auth, iterate=False, prefetch=0):
   """BigQuery helper configuration for Google API.
 
   Defines agreed upon version.
@@ -445,7 +754,8 @@ def API_BigQuery(config, auth, iterate=False):
       'api': 'bigquery',
       'version': 'v2',
       'auth': auth,
-      'iterate': iterate
+      'iterate': iterate,
+      'prefetch': prefetch
   }
   return API(config, api)
 
@@ -480,7 +790,7 @@ def API_Sheets(config, auth, iterate=False):
   return API(config, api)
 
 
-def API_DCM(config, auth, iterate=False, internal=False):
+def API_DCM(config, auth, iterate=False, internal=False, prefetch=0):
   """DCM helper configuration for Google API.
 
   Defines agreed upon version.
@@ -490,7 +800,8 @@ def API_DCM(config, auth, iterate=False, internal=False):
       'api': 'dfareporting',
       'version': 'v3.4',
       'auth': auth,
-      'iterate': iterate
+      'iterate': iterate,
+      'prefetch': prefetch
   }
 
   if internal:
@@ -620,7 +931,7 @@ def API_Cloud(config, auth, iterate=False):
   return API(config, api)
 
 
-def API_DV360(config, auth, iterate=False):
+def API_DV360(config, auth, iterate=False, prefetch=0, qps=None):
   """Cloud project helper configuration Google API.
 
   Defines agreed upon version.
@@ -630,7 +941,9 @@ def API_DV360(config, auth, iterate=False):
       'api': 'displayvideo',
       'version': 'v1',
       'auth': auth,
-      'iterate': iterate
+      'iterate': iterate,
+      'prefetch': prefetch,
+      'qps': qps
   }
   return API(config, api)
 
@@ -0,0 +1,150 @@
+###########################################################################
+#
+#  Copyright 2020 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+###########################################################################
+
+"""Token bucket rate limiting for Google API calls.
+
+Every API(...).execute() call, page fetch, and batch passes through a limiter
+keyed by API name and credentials, so all threads using the same quota share
+one bucket.  Limits are set per API in queries per second:
+
+  * STARTHINKER_QPS environment variable, JSON, for example {"displayvideo":10}.
+  * "qps" in the API JSON configuration, overrides the environment.
+
+APIs without a limit are not throttled.  When a call is throttled by the API
+( 429 ), API_Retry pauses the whole bucket for the Retry-After duration so all
+threads back off together instead of each hammering the quota.
+
+Set STARTHINKER_RATE_PATH to a directory to share buckets between processes
+on the same host, state is kept in a locked file per bucket.
+"""
+
+import os
+import json
+import fcntl
+import threading
+from time import sleep
+from time import time
+
+from starthinker.config import API_QPS
+from starthinker.config import API_RATE_PATH
+from starthinker.util.auth import get_principal
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class Rate_Limiter():
+  """Thread safe token bucket, optionally shared across processes via a file.
+
+  Tokens refill at qps per second up to burst.  Callers reserve tokens and
+  sleep until the reservation is due, so waiting never holds the lock.
+  """
+
+  def __init__(self, name:str, qps:float, burst:float=None, path:str=None) -> None:
+    self.name = name
+    self.qps = qps
+    self.burst = burst or max(1, qps)
+    self.path = path
+    self.state = {}
+    self.lock = threading.Lock()
+
+  def __update__(self, change):
+    """Apply change(state, now) under thread lock and file lock if shared."""
+
+    with self.lock:
+      if self.path:
+        with open(self.path, 'a+') as state_file:
+          fcntl.flock(state_file, fcntl.LOCK_EX)
+          state_file.seek(0)
+          try:
+            state = json.loads(state_file.read() or '{}')
+          except ValueError:
+            state = {}
+          result = change(state, time())
+          state_file.seek(0)
+          state_file.truncate()
+          state_file.write(json.dumps(state))
+          return result
+      else:
+        return change(self.state, time())
+
+  def __reserve__(self, state, now, tokens):
+    # tokens are those available at updated, updated is in the future when paused
+    available = state.get('tokens', self.burst)
+    updated = state.get('updated', now)
+    if now > updated:
+      available = min(self.burst, available + (now - updated) * self.qps)
+      updated = now
+    available -= tokens
+    state['tokens'] = available
+    state['updated'] = updated
+    return (updated - now) + max(0, -available / self.qps)
+
+  def __pause__(self, state, now, seconds):
+    until = now + seconds
+    if until > state.get('updated', now):
+      state['updated'] = until
+      state['tokens'] = min(state.get('tokens', self.burst), 0)
+
+  def acquire(self, tokens:int=1) -> float:
+    """Block until tokens are available, returns seconds waited."""
+
+    delay = self.__update__(lambda state, now: self.__reserve__(state, now, tokens))
+    if delay > 0:
+      sleep(delay)
+    return delay
+
+  def pause(self, seconds:float) -> None:
+    """Stop all callers of this bucket for seconds, used on 429 Retry-After."""
+
+    self.__update__(lambda state, now: self.__pause__(state, now, seconds))
+
+
+def get_rate_limiter(config, api:str, auth:str, qps:float=None) -> Rate_Limiter:
+  """Return the shared limiter for an API and credentials, None if no limit.
+
+  Args:
+    config: (Configuration) Used to identify the credentials principal.
+    api: (string) The API name, for example displayvideo.
+    auth: (string) Either user or service.
+    qps: (float) Queries per second, overrides STARTHINKER_QPS for this API.
+      The limiter is shared by every caller of the API and credentials, so it
+      runs at the lowest qps any caller asked for.
+
+  Returns:
+    Rate_Limiter or None if the API has no limit.
+  """
+
+  qps = qps or API_QPS.get(api)
+  if not qps:
+    return None
+
+  name = '%s_%s' % (api, get_principal(config, auth))
+
+  with RATE_LIMITERS_LOCK:
+    if name not in RATE_LIMITERS:
+      path = None
+      if API_RATE_PATH:
+        os.makedirs(API_RATE_PATH, exist_ok=True)
+        path = os.path.join(API_RATE_PATH, '%s.json' % name)
+      RATE_LIMITERS[name] = Rate_Limiter(name, qps, path=path)
+    limiter = RATE_LIMITERS[name]
+    if qps < limiter.qps:
+      limiter.qps = qps
+      limiter.burst = min(limiter.burst, max(1, qps))
+    return limiter
@@ -19,15 +19,55 @@
 # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets
 
 import re
+import threading
+from contextlib import contextmanager
 
 from googleapiclient.errors import HttpError
 
+from starthinker.util.auth import get_principal
 from starthinker.util.google_api import API_Sheets
 from starthinker.util.drive import file_delete
 from starthinker.util.drive import file_find
 
+SHEETS_BATCH_SIZE = 100 # ranges per batchUpdate or batchClear request
+
+# caches for the run, keyed by credentials so different users never share
+SHEETS_IDS = {} # ( principal, url or name ) to spreadsheet id
+SHEETS_METADATA = {} # ( principal, spreadsheet id ) to spreadsheets().get
+SHEETS_VALUES = {} # ( principal, spreadsheet id ) to { range: values } from sheets_prefetch
+SHEETS_SESSIONS = {} # ( principal, spreadsheet id ) to pending writes and clears
+SHEETS_LOCK = threading.RLock()
+
+
+def sheets_key(config, auth, sheet_id):
+  return (get_principal(config, auth), sheet_id)
+
+
+def sheets_invalidate(config, auth, sheet_id, metadata=True):
+  """Drops prefetched values, and metadata if tabs may have changed."""
+  with SHEETS_LOCK:
+    SHEETS_VALUES.pop(sheets_key(config, auth, sheet_id), None)
+    if metadata:
+      SHEETS_METADATA.pop(sheets_key(config, auth, sheet_id), None)
+
 
 def sheets_id(config, auth, url_or_name):
+  key = (get_principal(config, auth), url_or_name)
+
+  with SHEETS_LOCK:
+    if key in SHEETS_IDS:
+      return SHEETS_IDS[key]
+
+  sheet_id = sheets_id_find(config, auth, url_or_name)
+
+  # only found sheets are cached, a missing one may be created later
+  if sheet_id:
+    with SHEETS_LOCK:
+      SHEETS_IDS[key] = sheet_id
+  return sheet_id
+
+
+def sheets_id_find(config, auth, url_or_name):
   # check if URL given, convert to ID "https://docs.google.com/spreadsheets/d/1uN9tnb-DZ9zZflZsoW4_34sf34tw3ff/edit#gid=4715"
   if url_or_name.startswith('https://docs.google.com/spreadsheets/d/'):
     m = re.search(
@@ -69,7 +109,14 @@ def sheets_tab_range(sheet_tab, sheet_range):
 def sheets_get(config, auth, sheet_url_or_name):
   sheet_id = sheets_id(config, auth, sheet_url_or_name)
   if sheet_id:
-    return API_Sheets(config, auth).spreadsheets().get(spreadsheetId=sheet_id).execute()
+    key = sheets_key(config, auth, sheet_id)
+    with SHEETS_LOCK:
+      spreadsheet = SHEETS_METADATA.get(key)
+    if spreadsheet is None:
+      spreadsheet = API_Sheets(config, auth).spreadsheets().get(spreadsheetId=sheet_id).execute()
+      with SHEETS_LOCK:
+        SHEETS_METADATA[key] = spreadsheet
+    return spreadsheet
   else:
     return None
 
@@ -87,14 +134,50 @@ def sheets_tab_id(config, auth, sheet_url_or_name, sheet_tab):
   return sheet_id, tab_id
 
 
+def sheets_prefetch(config, auth, sheet_url_or_name, tabs_and_ranges):
+  """Reads many ranges with one batchGet, later sheets_read calls use them.
+
+  Each prefetched range is returned once by sheets_read, any write or clear
+  to the spreadsheet discards what was prefetched.
+
+  Args:
+    * config: (Configuration) Credentials wrapper.
+    * auth: (string) Either user or service.
+    * sheet_url_or_name: (string) Spreadsheet to read.
+    * tabs_and_ranges: (list) Of ( tab, range ) as passed to sheets_read.
+  """
+
+  if config.verbose:
+    print('SHEETS PREFETCH', sheet_url_or_name, len(tabs_and_ranges))
+
+  sheet_id = sheets_id(config, auth, sheet_url_or_name)
+  if sheet_id:
+    sheets_flush(config, auth, sheet_id)
+    ranges = [sheets_tab_range(sheet_tab, sheet_range) for sheet_tab, sheet_range in tabs_and_ranges]
+    response = API_Sheets(config, auth).spreadsheets().values().batchGet(
+      spreadsheetId=sheet_id,
+      ranges=ranges
+    ).execute()
+    with SHEETS_LOCK:
+      values = SHEETS_VALUES.setdefault(sheets_key(config, auth, sheet_id), {})
+      for range, value_range in zip(ranges, response.get('valueRanges', [])):
+        values[range] = value_range.get('values')
+
+
 def sheets_read(config, auth, sheet_url_or_name, sheet_tab, sheet_range='', retries=10):
   if config.verbose:
     print('SHEETS READ', sheet_url_or_name, sheet_tab, sheet_range)
   sheet_id = sheets_id(config, auth, sheet_url_or_name)
   if sheet_id:
+    range = sheets_tab_range(sheet_tab, sheet_range)
+    with SHEETS_LOCK:
+      values = SHEETS_VALUES.get(sheets_key(config, auth, sheet_id), {})
+      if range in values:
+        return values.pop(range)
+    sheets_flush(config, auth, sheet_id)
     return API_Sheets(config, auth).spreadsheets().values().get(
       spreadsheetId=sheet_id,
-      range=sheets_tab_range(sheet_tab, sheet_range)
+      range=range
     ).execute().get('values')
   else:
     raise ValueError('Sheet does not exist for %s: %s' % (config, auth, sheet_url_or_name))
@@ -114,6 +197,13 @@ def sheets_write(config, auth,
   range = sheets_tab_range(sheet_tab, sheet_range)
   body = {'values': list(data)}
 
+  sheets_invalidate(config, auth, sheet_id, metadata=False)
+
+  if not append and sheets_pending(config, auth, sheet_id, 'update', valueInputOption, {'range': range, 'values': body['values']}):
+    return
+
+  sheets_flush(config, auth, sheet_id)
+
   if append:
     API_Sheets(config, auth).spreadsheets().values().append(
       spreadsheetId=sheet_id,
@@ -136,6 +226,10 @@ def sheets_clear(config, auth, sheet_url_or_name, sheet_tab, sheet_range):
     print('SHEETS CLEAR', sheet_url_or_name, sheet_tab, sheet_range)
   sheet_id = sheets_id(config, auth, sheet_url_or_name)
   if sheet_id:
+    sheets_invalidate(config, auth, sheet_id, metadata=False)
+    if sheets_pending(config, auth, sheet_id, 'clear', None, sheets_tab_range(sheet_tab, sheet_range)):
+      return
+    sheets_flush(config, auth, sheet_id)
     API_Sheets(config, auth).spreadsheets().values().clear(
       spreadsheetId=sheet_id,
       range=sheets_tab_range(sheet_tab, sheet_range),
@@ -145,6 +239,102 @@ def sheets_clear(config, auth, sheet_url_or_name, sheet_tab, sheet_range):
     raise ValueError('Sheet does not exist for %s: %s' % (config, auth, sheet_url_or_name))
 
 
+@contextmanager
+def sheets_session(config, auth, sheet_url_or_name):
+  """Batches sheets_write and sheets_clear calls to one spreadsheet.
+
+  Inside the block, writes ( not appends ) and clears are held and sent as
+  values().batchUpdate and values().batchClear requests, in their original
+  order.  Anything held is sent before a read, append, or tab change of the
+  same spreadsheet, every SHEETS_BATCH_SIZE ranges, when the block ends, and
+  by configuration.execute at the end of each task.
+
+  Only use around code that does not read the spreadsheet through another
+  API, for example a BigQuery table linked to it, before the block ends.
+
+  Example:
+    with sheets_session(config, auth, sheet):
+      for tab in tabs:
+        sheets_clear(config, auth, sheet, tab, 'A2:Z')
+  """
+
+  sheet_id = sheets_id(config, auth, sheet_url_or_name)
+  key = sheets_key(config, auth, sheet_id)
+
+  with SHEETS_LOCK:
+    nested = key in SHEETS_SESSIONS
+    if not nested:
+      SHEETS_SESSIONS[key] = {'config': config, 'auth': auth, 'sheet_id': sheet_id, 'requests': []}
+
+  try:
+    yield sheet_id
+  finally:
+    if not nested:
+      try:
+        sheets_flush(config, auth, sheet_id)
+      finally:
+        with SHEETS_LOCK:
+          SHEETS_SESSIONS.pop(key, None)
+
+
+def sheets_pending(config, auth, sheet_id, kind, valueInputOption, data):
+  """Holds a write or clear if a session is open for the spreadsheet.
+
+  Returns:
+    True if held, False if the caller should send it now.
+  """
+
+  key = sheets_key(config, auth, sheet_id)
+  with SHEETS_LOCK:
+    session = SHEETS_SESSIONS.get(key)
+    if session is None:
+      return False
+    session['requests'].append((kind, valueInputOption, data))
+    full = len(session['requests']) >= SHEETS_BATCH_SIZE
+
+  if full:
+    sheets_flush(config, auth, sheet_id)
+  return True
+
+
+def sheets_flush(config=None, auth=None, sheet_id=None):
+  """Sends held writes and clears, consecutive ones of a kind as one request.
+
+  Args:
+    * config, auth, sheet_id: Flush one spreadsheet, or all if omitted.
+  """
+
+  with SHEETS_LOCK:
+    if sheet_id is None:
+      sessions = list(SHEETS_SESSIONS.values())
+    else:
+      session = SHEETS_SESSIONS.get(sheets_key(config, auth, sheet_id))
+      sessions = [session] if session else []
+
+    for session in sessions:
+      batches = []
+      for kind, valueInputOption, data in session['requests']:
+        if batches and batches[-1][:2] == (kind, valueInputOption) and len(batches[-1][2]) < SHEETS_BATCH_SIZE:
+          batches[-1][2].append(data)
+        else:
+          batches.append((kind, valueInputOption, [data]))
+      session['requests'] = []
+
+      for kind, valueInputOption, data in batches:
+        if session['config'].verbose:
+          print('SHEETS BATCH', kind.upper(), len(data))
+        if kind == 'clear':
+          API_Sheets(session['config'], session['auth']).spreadsheets().values().batchClear(
+            spreadsheetId=session['sheet_id'],
+            body={'ranges': data}
+          ).execute()
+        else:
+          API_Sheets(session['config'], session['auth']).spreadsheets().values().batchUpdate(
+            spreadsheetId=session['sheet_id'],
+            body={'valueInputOption': valueInputOption, 'data': data}
+          ).execute()
+
+
 def sheets_tab_copy(config, auth,
                     from_sheet_url_or_name,
                     from_sheet_tab,
@@ -195,9 +385,13 @@ def sheets_tab_copy(config, auth,
       body=body
     ).execute()
 
+    sheets_invalidate(config, auth, to_sheet_id)
+
 
 def sheets_batch_update(config, auth, sheet_url_or_name, data):
   sheet_id = sheets_id(config, auth, sheet_url_or_name)
+  sheets_flush(config, auth, sheet_id)
+  sheets_invalidate(config, auth, sheet_id)
   API_Sheets(config, auth).spreadsheets().batchUpdate(
     spreadsheetId=sheet_id,
     body=data
@@ -206,6 +400,8 @@ def sheets_batch_update(config, auth, sheet_url_or_name, data):
 
 def sheets_values_batch_update(config, auth, sheet_url_or_name, data):
   sheet_id = sheets_id(config, auth, sheet_url_or_name)
+  sheets_flush(config, auth, sheet_id)
+  sheets_invalidate(config, auth, sheet_id)
   API_Sheets(config, auth).spreadsheets().values().batchUpdate(
     spreadsheetId=sheet_id,
     body=data
@@ -216,7 +412,7 @@ def sheets_tab_create(config, auth, sheet_url_or_name, sheet_tab):
   sheet_id, tab_id = sheets_tab_id(config, auth, sheet_url_or_name, sheet_tab)
   if tab_id is None:
     sheets_batch_update(
-        auth, sheet_url_or_name,
+        config, auth, sheet_url_or_name,
         {'requests': [{
             'addSheet': {
                 'properties': {
@@ -236,12 +432,17 @@ def sheets_tab_delete(config, auth, sheet_url_or_name, sheet_tab):
         spreadsheet['sheets']
     ) == 1 and spreadsheet['sheets'][0]['properties']['title'] == sheet_tab:
       file_delete(config, auth, spreadsheet['properties']['title'], parent=None)
+      sheets_invalidate(config, auth, spreadsheet['spreadsheetId'])
+      with SHEETS_LOCK:
+        for key, sheet_id in list(SHEETS_IDS.items()):
+          if sheet_id == spreadsheet['spreadsheetId']:
+            del SHEETS_IDS[key]
     else:
       sheet_id, tab_id = sheets_tab_id(config, auth, sheet_url_or_name, sheet_tab)
       # add check to see if only tab, then delete whole sheet
       if tab_id is not None:
         sheets_batch_update(
-            auth, sheet_url_or_name,
+            config, auth, sheet_url_or_name,
             {'requests': [{
                 'deleteSheet': {
                     'sheetId': tab_id,
@@ -253,7 +454,7 @@ def sheets_tab_rename(config, auth, sheet_url_or_name, old_sheet_tab, new_sheet_
   sheet_id, tab_id = sheets_tab_id(config, auth, sheet_url_or_name, old_sheet_tab)
   if tab_id is not None:
     sheets_batch_update(
-        auth, sheet_url_or_name, {
+        config, auth, sheet_url_or_name, {
             'requests': [{
                 'updateSheetProperties': {
                     'properties': {
@@ -17,6 +17,7 @@
 ###########################################################################
 
 import os
+import codecs
 import errno
 import json
 import httplib2
@@ -28,7 +29,6 @@ from googleapiclient.errors import HttpError
 
 from starthinker.config import BUFFER_SCALE
 from starthinker.util.google_api import API_Storage
-from starthinker.util.csv import find_utf8_split
 
 CHUNKSIZE = int(200 * 1024000 *
                 BUFFER_SCALE)  # scale is controlled in config.py
@@ -65,7 +65,7 @@ def parse_filename(path, url=False):
 
 def media_download(request, chunksize, encoding=None):
   data = BytesIO()
-  leftovers = b''
+  decoder = codecs.getincrementaldecoder(encoding)() if encoding else None
 
   media = MediaIoBaseDownload(data, request, chunksize=chunksize)
 
@@ -78,21 +78,16 @@ def media_download(request, chunksize, encoding=None):
       if progress:
         print('Download %d%%' % int(progress.progress() * 100))
 
+      # getvalue shares the buffer instead of copying it like read
+      chunk = data.getvalue()
       data.seek(0)
+      data.truncate(0)
 
-      if encoding is None:
-        yield data.read()
-
-      elif encoding.lower() == 'utf-8':
-        position = find_utf8_split(data)
-        yield (leftovers + data.read(position)).decode(encoding)
-        leftftovers = data.read()
-
-      else:
-        yield data.read().decode(encoding)
+      # incremental decoder carries characters split across chunks
+      if decoder:
+        chunk = decoder.decode(chunk, final=done)
 
-      data.seek(0)
-      data.truncate(0)
+      yield chunk
     except HttpError as err:
       error = err
       if err.resp.status < 500:
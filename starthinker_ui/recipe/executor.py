@@ -0,0 +1,142 @@
+###########################################################################
+#
+#  Copyright 2020 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+###########################################################################
+
+"""Warm task executors for the job worker.
+
+Starting a fresh python process per task re-imports googleapiclient, the
+task modules, and re-reads discovery documents, costing seconds per task.
+Instead one multiprocessing forkserver imports all of that once and forks a
+child per task.  Each task is still its own process, so:
+
+  * A timeout kills only that task.
+  * A crash only ends that task, the forkserver is untouched.
+  * If the forkserver itself dies, multiprocessing starts a new one.
+
+Task output is written to files next to the recipe file and read
+incrementally by the worker, just like it used to read subprocess pipes.
+
+This module must not import django, it is imported by the forkserver.
+"""
+
+import os
+import sys
+import warnings
+import multiprocessing
+
+from starthinker.tool import recipe
+from starthinker.util.discovery_cache import discovery_preload
+
+EXECUTOR_PRELOAD = [
+  'starthinker_ui.recipe.executor',
+  'googleapiclient.discovery',
+  'starthinker.util.bigquery',
+  'starthinker.util.google_api',
+]
+
+# only the forkserver preloads documents, the worker itself does not need them
+if os.environ.get('STARTHINKER_EXECUTOR'):
+  discovery_preload()
+
+
+def executor_available():
+  return 'forkserver' in multiprocessing.get_all_start_methods()
+
+
+def executor_context(python=None):
+  """Configure the forkserver that all warm tasks are forked from.
+
+  The forkserver is started lazily by the first task.
+
+  Args:
+    * python: (string) Optional interpreter path for the forkserver.
+
+  Returns:
+    A multiprocessing context used to start tasks.
+  """
+
+  os.environ['STARTHINKER_EXECUTOR'] = '1'
+  context = multiprocessing.get_context('forkserver')
+  if python and os.path.exists(python):
+    context.set_executable(python)
+  context.set_forkserver_preload(EXECUTOR_PRELOAD)
+  return context
+
+
+def executor_task(filename, instance, trace, cwd, stdout_path, stderr_path):
+  """Runs inside the forked child, equivalent to calling tool/recipe.py."""
+
+  os.chdir(cwd)
+  warnings.simplefilter('ignore')
+
+  # point the file descriptors at the output files so C level writes land too
+  for fd, path in ((1, stdout_path), (2, stderr_path)):
+    handle = os.open(path, os.O_WRONLY | os.O_APPEND)
+    os.dup2(handle, fd)
+    os.close(handle)
+  sys.stdout = open(1, 'w', buffering=1, closefd=False)
+  sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+  sys.argv = [
+    recipe.__file__,
+    filename,
+    '--instance', str(instance),
+    '--no_input',
+    '--force', # some tasks run after alloted time due to run overs by prior tasks
+    '--verbose'
+  ]
+
+  if trace:
+    sys.argv.append('--trace_file')
+
+  recipe.main()
+
+
+class Executor_Process():
+  """A task running in a warm executor, mimics subprocess.Popen.
+
+  Exposes the stdout, stderr, poll(), and kill() used by the job worker.
+  """
+
+  def __init__(self, context, filename, instance, trace, cwd):
+    self.stdout_path = '%s.stdout' % filename
+    self.stderr_path = '%s.stderr' % filename
+
+    open(self.stdout_path, 'wb').close()
+    open(self.stderr_path, 'wb').close()
+    self.stdout = open(self.stdout_path, 'rb')
+    self.stderr = open(self.stderr_path, 'rb')
+
+    self.process = context.Process(
+      target=executor_task,
+      args=(filename, instance, trace, cwd, self.stdout_path, self.stderr_path)
+    )
+    self.process.start()
+
+  def poll(self):
+    return self.process.exitcode
+
+  def kill(self):
+    self.process.kill()
+    self.process.join()
+
+  def cleanup(self):
+    self.stdout.close()
+    self.stderr.close()
+    for path in (self.stdout_path, self.stderr_path):
+      if os.path.exists(path):
+        os.remove(path)
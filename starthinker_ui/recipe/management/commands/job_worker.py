@@ -43,6 +43,7 @@ from starthinker_ui.recipe.log import log_manager_start, log_manager_end, log_ma
 from starthinker_ui.recipe.log import log_job_timeout, log_job_error, log_job_start, log_job_end, log_job_cancel
 from starthinker_ui.recipe.log import log_verbose, get_instance_name
 from starthinker_ui.recipe.compute import group_instances_delete
+from starthinker_ui.recipe.executor import Executor_Process, executor_available, executor_context
 
 MANAGER_ON = True
 MANAGER_HEALTHY = True
@@ -135,13 +136,20 @@ def make_non_blocking(file_io):
 
 class Workers():
 
-  def __init__(self, uid, jobs_maximum, timeout_seconds, trace=False):
+  def __init__(self, uid, jobs_maximum, timeout_seconds, trace=False, warm=True):
     self.uid = uid or get_instance_name()
     self.timeout_seconds = timeout_seconds
     self.trace = trace
     self.jobs_maximum = jobs_maximum
     self.jobs = []
 
+    # fork tasks from a preloaded interpreter instead of starting python each time
+    self.executor = None
+    if warm and executor_available():
+      self.executor = executor_context(
+        '%s/starthinker_virtualenv/bin/python' % settings.UI_ROOT
+      )
+
     self.lock_thread = threading.Lock()
     self.ping_event = threading.Event()
     self.ping_thread = threading.Thread(target=self.ping)
@@ -200,6 +208,16 @@ class Workers():
     with open(filename, 'w') as job_file:
       job_file.write(json.dumps(job['recipe'], default=str))
 
+    if self.executor:
+      job['job']['process'] = Executor_Process(
+        self.executor,
+        filename,
+        job['instance'],
+        self.trace,
+        settings.UI_ROOT
+      )
+      return
+
     command = [
         '%s/starthinker_virtualenv/bin/python' % settings.UI_ROOT,
         '-u',
@@ -228,6 +246,8 @@ class Workers():
     make_non_blocking(job['job']['process'].stderr)
 
   def cleanup(self, job):
+    if isinstance(job['job'].get('process'), Executor_Process):
+      job['job']['process'].cleanup()
     filename = '%s/%s.json' % (settings.UI_CRON, job['job']['id'])
     if os.path.exists(filename):
       os.remove(filename)
@@ -367,6 +387,14 @@ class Command(BaseCommand):
         help='Default seconds to allow a task to run before timing it out, also controlled by recipe.',
     )
 
+    parser.add_argument(
+        '--cold',
+        action='store_true',
+        dest='cold',
+        default=False,
+        help='Start a new python process per task instead of forking from a warm executor.',
+    )
+
     parser.add_argument(
         '--verbose',
         action='store_true',
@@ -414,6 +442,7 @@ class Command(BaseCommand):
         kwargs['jobs'],
         kwargs['timeout'],
         kwargs['trace'],
+        not kwargs['cold'],
     )
 
     try: